@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+#
+# bench.py
+#
+# Benchmarks for the mastering (mastering/devrooms) and scene generation
+# (obs) tools, on synthetic inputs - no conference recordings or CFP
+# export needed:
+#
+#   ./bench.py                          # run all, print the results
+#   ./bench.py --save-baseline base.json
+#   ./bench.py --baseline base.json     # compare, exit 1 on a regression
+#   ./bench.py --only mastering --duration 300
+#
+# Inputs are generated in a work directory (a temporary one unless
+# --work is given):
+#
+# - mastering/: a livestream (slides that change every SLIDE_SECONDS)
+#   and a camera recording (testsrc2) of --duration seconds, sharing one
+#   audio track - pink noise, switched on and off like speech, so that
+#   both alignment and silence detection have something to find. The
+#   camera starts OFFSET seconds before the livestream. A noise profile
+#   in sox format, an info image and a devroom json with N_TALKS talks.
+# - obs/: a CFP export with N_CFP_TALKS talks, a devroom list and a
+#   schedule export referring to some of them (with retyped titles, for
+#   the resolver), and the templates of the repository.
+#
+# Benchmarks:
+#
+#  mastering.<pipeline>  master-talk-video.py --force, for each pipeline
+#                        mode. Realtime factor (talk seconds per wall
+#                        second), and the same for each kind of step,
+#                        from the timing reports of the talks. The
+#                        full pipeline runs with --dedup-slides too
+#                        (full-dedup), and its .size is the MB of the
+#                        final videos
+#  mastering.align       --align, and how far off the known offset it is
+#  mastering.scan        --scan, source seconds per wall second
+#  mastering.suggest     --suggest-cuts
+#  mastering.noiseprofile --noise-profile, camera seconds per wall second
+#  audio.*               loudness measurement and noise reduction, in
+#                        process, on generated samples. With sox, the
+#                        noise reduction is checked against sox noisered
+#                        (audio.noisered.sox_diff, fails above SOX_DIFF)
+#  scenes.*              gen-session-scene-images.py: --check and
+#                        --resolve (talks/s), rendering with and without
+#                        inkscape --shell (renders/s), and a run with
+#                        nothing to render (s)
+#  talkindex.resolve     title lookups/s
+#
+# A benchmark whose tools (ffmpeg, inkscape, pycairo...) are missing is
+# skipped. Results compared to a baseline are flagged as regressions when
+# they are worse by more than --tolerance.
+#
+import os
+import re
+import sys
+import csv
+import json
+import time
+import glob
+import wave
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+
+REPO = Path(__file__).resolve().parent
+MASTERING = REPO / 'mastering' / 'devrooms'
+OBS = REPO / 'obs'
+
+DURATION = 180 # seconds of livestream
+OFFSET = 7.25 # procam_time = livestream_time + OFFSET
+N_TALKS = 2
+SLIDE_SECONDS = 8
+FRAME_SIZE = '1920x1080'
+N_CFP_TALKS = 120
+N_SCENE_TALKS = 12
+AUDIO_SECONDS = 60 # for the in process audio benchmarks
+TOLERANCE = 0.1
+REPEAT = 3 # in process benchmarks take the best of this many runs
+SOX_DIFF = 0.1 # relative RMS difference allowed from sox noisered
+
+WORDS = ('open source hardware data science android compilers policy community '
+         'scaling building testing kernel tools boards languages systems cloud '
+         'privacy governance sustainable reproducible research maps health '
+         'federated embedded firmware rust python graphs models libre').split()
+
+def run(cmd, cwd=None):
+    # => wall time. Output is kept for the error only
+    start = time.monotonic()
+    result = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True)
+    wall = time.monotonic() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'{" ".join(map(str, cmd))} failed:\n{result.stdout[-2000:]}{result.stderr[-2000:]}')
+    return wall
+
+def hms(seconds):
+    h, rem = divmod(int(seconds), 3600)
+    m, s = divmod(rem, 60)
+    return f'{h:02d}:{m:02d}:{s:02d}'
+
+def slug(text):
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')
+
+def best_time(func):
+    # => shortest wall time of REPEAT calls
+    times = []
+    for r in range(REPEAT):
+        start = time.monotonic()
+        func()
+        times.append(time.monotonic() - start)
+    return min(times)
+
+def missing(requires):
+    # => the first requirement that isn't available, or None.
+    # 'module:name' is a Python module, anything else a command
+    for req in requires:
+        if req.startswith('module:'):
+            if importlib.util.find_spec(req.split(':', 1)[1]) is None:
+                return req
+        elif shutil.which(req) is None:
+            return req
+    return None
+
+#
+# Synthetic inputs
+#
+def gen_noise_profile(fname, seed=3):
+    # sox noiseprof format, a quiet pink-ish floor (log power per bin)
+    rng = np.random.default_rng(seed)
+    bins = 1025
+    values = -14.0 - 3.0 * np.log1p(np.arange(bins) / 64) + rng.normal(0, 0.2, bins)
+    with open(fname, 'w') as f:
+        f.write('Channel 0: ' + ', '.join([f'{v:.6f}' for v in values]) + '\n')
+
+def gen_sources(work, duration, offset):
+    # => (livestream, procam) file names, in work/bench
+    devroom = work / 'bench'
+    devroom.mkdir(parents=True, exist_ok=True)
+    master = devroom / 'master.wav'
+    run(['ffmpeg', '-v', 'error', '-y',
+         '-f', 'lavfi', '-i', f'anoisesrc=d={duration + offset}:c=pink:r=48000:a=0.3:seed=7',
+         # on/off like speech, with pauses of a few seconds
+         '-af', "volume='0.02+0.98*gt(sin(2*PI*t*0.37)*sin(2*PI*t*0.113)+0.2,0)':eval=frame",
+         '-ac', '2', str(master)])
+    livestream = devroom / 'localrec-1.mkv'
+    run(['ffmpeg', '-v', 'error', '-y',
+         '-f', 'lavfi', '-i', f'testsrc=s={FRAME_SIZE}:r=1/{SLIDE_SECONDS}:d={duration},fps=30',
+         '-ss', f'{offset}', '-i', str(master),
+         '-map', '0:v', '-map', '1:a', '-t', f'{duration}',
+         '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '60', '-pix_fmt', 'yuv420p',
+         '-c:a', 'aac', '-b:a', '128k', str(livestream)])
+    procam = devroom / 'procam-1.mp4'
+    run(['ffmpeg', '-v', 'error', '-y',
+         '-f', 'lavfi', '-i', f'testsrc2=s={FRAME_SIZE}:r=25:d={duration + offset}',
+         '-i', str(master),
+         '-map', '0:v', '-map', '1:a',
+         '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '50', '-pix_fmt', 'yuv420p',
+         '-c:a', 'aac', '-b:a', '192k', str(procam)])
+    master.unlink()
+    gen_noise_profile(devroom / 'procam-1-noise-profile')
+    return livestream, procam
+
+def gen_devroom(work, duration, offset, n_talks, name='bench-1.json'):
+    # Devroom json like the real ones: talks share the recording, each
+    # with cuts fullscreen | slides | fullscreen
+    info_image = work / 'info.png'
+    if not info_image.exists():
+        run(['ffmpeg', '-v', 'error', '-y',
+             '-f', 'lavfi', '-i', f'color=c=0x203040:s={FRAME_SIZE}',
+             '-frames:v', '1', str(info_image)])
+    shutil.copy(MASTERING / 'overlay-video-full-screen.png', work / 'overlay-video-full-screen.png')
+    span = duration // n_talks
+    talks = []
+    talk_seconds = 0
+    for idx in range(n_talks):
+        start = idx * span + 2
+        end = (idx + 1) * span - 2
+        talk_seconds += end - start
+        talks.append({
+            'index' : idx + 1,
+            'fullscreen-template' : 'overlay-video-full-screen.png',
+            'info-image' : 'info.png',
+            'cuts' : [hms(start), hms(start + span // 6), hms(end - span // 6), hms(end)]
+        })
+    cfg = {
+        'devroom' : 'bench',
+        'livestream' : 'localrec-1.mkv',
+        'vcam' : 'procam-1.mp4',
+        'noise-profile' : 'procam-1-noise-profile',
+        'proc' : {
+            'vcam-offset' : offset,
+            'noise-reduction' : 0.2,
+            'overlap' : 1,
+            'slides' : {
+                'crop' : { 'xy' : [350, 1], 'wh' : [1568, 882] },
+                'scale' : [1436, 808],
+                'position' : [42, 124]
+            },
+            'video' : {
+                'crop' : { 'xy' : [555, 0], 'wh' : [810, 1080] },
+                'scale' : [360, 480],
+                'position' : [1518, 234]
+            }
+        },
+        'talks' : talks
+    }
+    fname = work / name
+    fname.write_text(json.dumps(cfg, indent=2) + '\n')
+    return fname, talk_seconds
+
+def gen_titles(n, seed=11):
+    rng = random.Random(seed)
+    titles = []
+    while len(titles) < n:
+        title = ' '.join([rng.choice(WORDS) for i in range(rng.randint(3, 8))]).capitalize()
+        title = title.replace(' ', ': ', 1) if rng.random() < 0.3 else title
+        if title not in titles:
+            titles.append(title)
+    return titles
+
+def gen_cfp(work, n_cfp, n_scene, seed=11):
+    # CFP export, devroom list and schedule export, in the layout
+    # gen-session-scene-images.py reads
+    rng = random.Random(seed)
+    (work / 'track-lists').mkdir(parents=True, exist_ok=True)
+    titles = gen_titles(n_cfp, seed)
+    with open(work / 'indiafoss-cfp-track.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Type', 'Title', 'Status', 'Duration', 'Email', 'Name',
+                         'Designation', 'Company', 'Track'])
+        for title in titles:
+            writer.writerow(['Talk', title, 'Accepted', '30', '', f'Speaker {rng.randint(1, 999)}',
+                             'Engineer', rng.choice(['FOSS United', 'Acme Labs', '']),
+                             'Open Data Devroom'])
+            if rng.random() < 0.3:
+                writer.writerow(['', '', '', '', '', f'Speaker {rng.randint(1, 999)}',
+                                 'Researcher', 'Some University', ''])
+            writer.writerow([''] * 9)
+    # The devroom list has titles as typed by hand: a few are retyped,
+    # or cut short
+    listed = []
+    for idx, title in enumerate(titles[:n_scene]):
+        if idx % 4 == 1:
+            title = title.lower()
+        elif idx % 4 == 2:
+            title = title.replace(' ', '  ', 1)
+        elif idx % 4 == 3:
+            title = title[:max(len(title) * 2 // 3, 12)]
+        listed.append(title)
+    (work / 'track-lists' / 'bench.txt').write_text('\n'.join(listed) + '\n')
+    with open(work / 'track-lists' / 'bench-day.csv', 'w', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(['Title', 'Date', 'Start Time', 'End Time', 'Hall', 'Category', 'CFP', 'Speakers'])
+        for idx, title in enumerate(titles[n_scene:2 * n_scene]):
+            t = 9 * 60 + 30 * idx
+            writer.writerow([title, '2025-09-20', f'{t // 60:02d}:{t % 60:02d}', '', 'Audi 1',
+                             'Talk', '', 'Speaker'])
+    (work / 'track-lists' / 'panels.map').write_text('track2panel_svg = {}\n')
+    # The QA template isn't in the repository - the talk template has the
+    # same placeholders, and costs the same to render
+    templates = work / 'templates'
+    if not templates.exists():
+        shutil.copytree(OBS / 'templates', templates)
+    if not (templates / 'talk-qa-section.svg').exists():
+        shutil.copy(templates / 'talk-presentation-section.svg', templates / 'talk-qa-section.svg')
+    return titles
+
+#
+# Benchmarks, each => {metric : (value, unit)}
+#
+def bench_mastering(work, args):
+    results = {}
+    mdir = work / 'mastering'
+    mdir.mkdir(parents=True, exist_ok=True)
+    gen_sources(mdir, args.duration, OFFSET)
+    devroom_json, talk_seconds = gen_devroom(mdir, args.duration, OFFSET, N_TALKS)
+    script = str(MASTERING / 'master-talk-video.py')
+    # clips and audio reuse what full wrote, so full goes first. The
+    # synthetic slides change every SLIDE_SECONDS, for --dedup-slides.
+    runs = [('full', 'full', []), ('full-dedup', 'full', ['--dedup-slides']),
+            ('clips', 'clips', []), ('audio', 'audio', []), ('single', 'single', [])]
+    for name, pipeline, opts in runs:
+        wall = run([sys.executable, script, '--force', '--jobs', str(args.jobs),
+                    '--pipeline', pipeline] + opts + [devroom_json.name], cwd=mdir)
+        results[f'mastering.{name}'] = (talk_seconds / wall, 'x realtime')
+        if pipeline == 'full':
+            size = sum([os.path.getsize(f) for f in glob.glob(str(mdir / 'mix' / 'bench' / 'bench-*.mp4'))])
+            results[f'mastering.{name}.size'] = (size / 2**20, 'MB')
+        # Per kind of step, from the timing reports of the talks
+        kinds = {}
+        for report_file in glob.glob(str(mdir / 'mix' / 'bench' / 'bench-*-timing.json')):
+            report = json.loads(open(report_file, 'r').read())
+            if report.get('pipeline') != pipeline:
+                continue
+            for kind, total in report['totals'].items():
+                kinds[kind] = kinds.get(kind, 0.0) + total['wall']
+        for kind, wall in kinds.items():
+            if wall > 0:
+                results[f'mastering.{name}.{slug(kind)}'] = (talk_seconds / wall, 'x realtime')
+
+    align_json, _ = gen_devroom(mdir, args.duration, 0.0, N_TALKS, 'bench-align.json')
+    wall = run([sys.executable, script, '--align', align_json.name], cwd=mdir)
+    results['mastering.align'] = (args.duration / wall, 'x realtime')
+    found = json.loads(align_json.read_text())['proc']['vcam-offset']
+    results['mastering.align.error'] = (abs(found - OFFSET), 's')
+
+    try:
+        wall = run([sys.executable, script, '--scan', devroom_json.name], cwd=mdir)
+    except RuntimeError:
+        # --scan exits 1 when it finds something, which is not a failure here
+        wall = None
+    if wall:
+        results['mastering.scan'] = ((2 * args.duration + OFFSET) / wall, 'x realtime')
+    wall = run([sys.executable, script, '--suggest-cuts', devroom_json.name], cwd=mdir)
+    results['mastering.suggest'] = (talk_seconds / wall, 'x realtime')
+    # Last: replaces the generated noise profile
+    wall = run([sys.executable, script, '--noise-profile', '--force', devroom_json.name], cwd=mdir)
+    results['mastering.noiseprofile'] = ((args.duration + OFFSET) / wall, 'x realtime')
+    return results
+
+def bench_audio(work, args):
+    sys.path.insert(0, str(MASTERING))
+    import loudness
+    import audiochain
+    rng = np.random.default_rng(5)
+    rate = 48000
+    n = AUDIO_SECONDS * rate
+    envelope = np.repeat(rng.random(n // rate + 1) > 0.3, rate)[:n]
+    samples = (rng.normal(0, 0.1, (n, 2)) * envelope[:, None]).clip(-1, 1)
+    wav_file = work / 'audio.wav'
+    with wave.open(str(wav_file), 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes((samples * 32767).astype('<i2').tobytes())
+    results = {}
+    wall = best_time(lambda: loudness.measure_wav(str(wav_file)))
+    results['audio.loudness'] = (AUDIO_SECONDS / wall, 'x realtime')
+
+    profile_file = work / 'noise-profile'
+    gen_noise_profile(profile_file)
+    profile = audiochain.read_noise_profile(str(profile_file))[0]
+    mono = samples[:, 0].astype(np.float32)
+    def noisered():
+        reducer = audiochain.NoiseReducer(profile, 0.2)
+        for pos in range(0, n, audiochain.BLOCK_SIZE):
+            reducer.process(mono[pos:pos + audiochain.BLOCK_SIZE])
+        reducer.flush()
+    results['audio.noisered'] = (AUDIO_SECONDS / best_time(noisered), 'x realtime')
+    if not missing(['sox']):
+        results['audio.noisered.sox_diff'] = (noisered_vs_sox(work, rng), 'rel')
+    return results
+
+def noisered_vs_sox(work, rng):
+    # The streaming noise reduction must do what sox noisered does (the
+    # --sox-audio path), with the same profile and amount => relative RMS
+    # difference of the two outputs. Fails above SOX_DIFF.
+    sys.path.insert(0, str(MASTERING))
+    import audiochain
+    import noiseprofile
+    rate = 48000
+    n = AUDIO_SECONDS * rate
+    floor = rng.normal(0, 0.005, n)
+    t = np.arange(n) / rate
+    # noise only for the first 2s, which the profile is made of
+    speech = 0.2 * np.sin(2 * np.pi * 220 * t) * (np.sin(2 * np.pi * 0.3 * t) > 0) * (t >= 2)
+    pcm = np.clip(np.round((floor + speech) * 32768), -32768, 32767).astype('<i2')
+    wav_in = work / 'noisered-in.wav'
+    wav_out = work / 'noisered-sox.wav'
+    with wave.open(str(wav_in), 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm.tobytes())
+    samples = pcm.astype(np.float64) / 32768
+    profile_file = work / 'noisered-profile'
+    noiseprofile.write_profile(str(profile_file), noiseprofile.profile(samples[:rate, None]))
+    run(['sox', str(wav_in), str(wav_out), 'noisered', str(profile_file), '0.2'])
+    with wave.open(str(wav_out), 'rb') as w:
+        ref = np.frombuffer(w.readframes(w.getnframes()), dtype='<i2').astype(np.float64) / 32768
+    reducer = audiochain.NoiseReducer(audiochain.read_noise_profile(str(profile_file))[0], 0.2)
+    out = np.concatenate([reducer.process(samples), reducer.flush()])
+    m = min(out.shape[0], ref.shape[0])
+    diff = float(np.sqrt(np.mean(np.square(out[:m] - ref[:m])) / np.mean(np.square(ref[:m]))))
+    if diff > SOX_DIFF:
+        raise RuntimeError(f'noise reduction differs from sox noisered: {diff:.3f} > {SOX_DIFF}')
+    return diff
+
+def bench_talkindex(work, args):
+    sys.path.insert(0, str(OBS))
+    from talkindex import TalkIndex
+    titles = gen_titles(N_CFP_TALKS)
+    index = TalkIndex([{'title' : title} for title in titles])
+    queries = []
+    for idx, title in enumerate(titles):
+        queries += [title, title.lower(), title[:len(title) * 2 // 3], title.replace('a', 'e', 1)]
+    wall = best_time(lambda: [index.resolve(query) for query in queries])
+    return {'talkindex.resolve' : (len(queries) / wall, '/s')}
+
+def bench_scenes(work, args):
+    results = {}
+    odir = work / 'obs'
+    odir.mkdir(parents=True, exist_ok=True)
+    titles = gen_cfp(odir, N_CFP_TALKS, N_SCENE_TALKS)
+    script = str(OBS / 'gen-session-scene-images.py')
+    wall = run([sys.executable, script, '--check'], cwd=odir)
+    results['scenes.check'] = (len(titles) / wall, '/s')
+    wall = run([sys.executable, script, '--resolve', '--devroom', 'bench', '--track', 'bench-day'], cwd=odir)
+    results['scenes.resolve'] = (2 * N_SCENE_TALKS / wall, '/s')
+    for mode, opts in [('shell', []), ('no-shell', ['--no-shell'])]:
+        shutil.rmtree(odir / 'track-ordered', ignore_errors=True)
+        wall = run([sys.executable, script, '--force', '--jobs', str(args.jobs),
+                    '--devroom', 'bench', '--track', 'bench-day'] + opts, cwd=odir)
+        renders = len(glob.glob(str(odir / 'track-ordered' / '*' / '*.png')))
+        results[f'scenes.render.{mode}'] = (renders / wall, '/s')
+    # Nothing changed => nothing to render
+    wall = run([sys.executable, script, '--jobs', str(args.jobs),
+                '--devroom', 'bench', '--track', 'bench-day'], cwd=odir)
+    results['scenes.unchanged'] = (wall, 's')
+    return results
+
+BENCHMARKS = [
+    ('mastering', ['ffmpeg', 'ffprobe', 'module:numpy'], bench_mastering),
+    ('audio', ['module:numpy'], bench_audio),
+    ('talkindex', [], bench_talkindex),
+    ('scenes', ['inkscape', 'module:cairo'], bench_scenes)
+]
+
+#
+# Baseline comparison
+#
+def higher_is_better(unit):
+    return unit not in ['s', 'MB', 'rel']
+
+def compare(results, baseline, tolerance):
+    # => [(metric, value, unit, base value, change, regressed)]
+    rows = []
+    for metric, (value, unit) in sorted(results.items()):
+        base = baseline.get(metric)
+        if base is None or base[0] == 0:
+            rows.append((metric, value, unit, None, None, False))
+            continue
+        change = value / base[0] - 1
+        better = change if higher_is_better(unit) else -change
+        rows.append((metric, value, unit, base[0], change, better < -tolerance))
+    return rows
+
+def print_results(rows):
+    for metric, value, unit, base, change, regressed in rows:
+        line = f'{metric:50s} {value:10.3f} {unit:10s}'
+        if base is not None:
+            line += f' {base:10.3f} {100 * change:+6.1f}%'
+            if regressed:
+                line += '  REGRESSION'
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', action='append', default=[], help="""
+        Run only this benchmark (mastering, audio, talkindex, scenes), or
+        report only the results starting with this (mastering.single).
+        Can be repeated.
+    """)
+    parser.add_argument('--duration', type=int, default=DURATION, help="""
+        Length of the synthetic livestream, in seconds.
+    """)
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="""
+        --jobs passed on to the tools.
+    """)
+    parser.add_argument('--work', help="""
+        Directory for the synthetic inputs and the outputs, kept after the
+        run. Default is a temporary directory, removed after the run.
+    """)
+    parser.add_argument('--output', '-o', help="""
+        Write the results to this file (json).
+    """)
+    parser.add_argument('--baseline', help="""
+        Compare with the results in this file, and exit with 1 if any
+        is worse by more than the tolerance.
+    """)
+    parser.add_argument('--save-baseline', help="""
+        Write the results to this file, to be used with --baseline.
+    """)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="""
+        Allowed change for the worse, as a fraction (0.1 = 10%%).
+    """)
+    args = parser.parse_args()
+
+    work = Path(args.work) if args.work else Path(tempfile.mkdtemp(prefix='bench-'))
+    work.mkdir(parents=True, exist_ok=True)
+    results = {}
+    skipped = []
+    try:
+        for name, requires, bench in BENCHMARKS:
+            if args.only and name not in [o.split('.')[0] for o in args.only]:
+                continue
+            req = missing(requires)
+            if req:
+                print(f'{name}: skipped, needs {req}')
+                skipped.append(name)
+                continue
+            print(f'{name}...', flush=True)
+            results.update(bench(work.resolve(), args))
+    finally:
+        if not args.work:
+            shutil.rmtree(work, ignore_errors=True)
+    if args.only:
+        results = {m : v for m, v in results.items() if any(m.startswith(o) for o in args.only)}
+
+    report = {
+        'machine' : {
+            'host' : platform.node(),
+            'cpus' : os.cpu_count(),
+            'python' : platform.python_version()
+        },
+        'settings' : { 'duration' : args.duration, 'jobs' : args.jobs },
+        'skipped' : skipped,
+        'results' : {m : {'value' : round(v, 4), 'unit' : u} for m, (v, u) in results.items()}
+    }
+    for fname in [args.output, args.save_baseline]:
+        if fname:
+            open(fname, 'w').write(json.dumps(report, indent=2) + '\n')
+
+    baseline = {}
+    if args.baseline:
+        saved = json.loads(open(args.baseline, 'r').read())
+        baseline = {m : (r['value'], r['unit']) for m, r in saved['results'].items()}
+    rows = compare(results, baseline, args.tolerance)
+    print_results(rows)
+    regressions = [row[0] for row in rows if row[5]]
+    if regressions:
+        print(f'{len(regressions)} regressions (tolerance {100 * args.tolerance:.0f}%)')
+        sys.exit(1)
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+#
+# capture_qa.py
+#
+# Python/NumPy version of camera_stream.c - checks that an HDMI capture
+# chain passes a uniform color (fullscreen_color.c on the laptop) through
+# unchanged. For every YUYV frame:
+#
+# - the reference is the pixel at the center of the frame. Changes of
+#   the reference are printed, like camera_stream.c does
+# - mismatches: pixels different from the reference (4 columns at the
+#   left/right edges are skipped - they always fail)
+# - distinct colors: number of different YUV triplets in the frame
+# - per region stats: the frame is split into a grid, and the mismatches
+#   and mean Y/U/V of each cell are computed - shows where a chain
+#   corrupts the picture (edges, one scaler tile...)
+#
+# A frame is a zero copy NumPy view of the V4L2 mmap buffer or of a
+# memory mapped raw file, and all the checks are vectorized - 1080p60
+# runs well faster than realtime.
+#
+#   ./capture_qa.py                            # /dev/video4, 1000 frames
+#   ./capture_qa.py --device /dev/video2 --frames 0   # until Ctrl-C
+#   ./capture_qa.py --size 1920x1080 capture.yuv      # raw YUYV dump(s)
+#   ./capture_qa.py capture.mkv                # anything ffmpeg decodes
+#
+# Raw dumps can be recorded with e.g.
+#
+#   ffmpeg -f v4l2 -input_format yuyv422 -video_size 1920x1080 \
+#          -i /dev/video4 -frames:v 600 -c:v rawvideo -f rawvideo capture.yuv
+#
+import os
+import sys
+import mmap
+import json
+import fcntl
+import ctypes
+import select
+import argparse
+import subprocess
+import numpy as np
+
+BORDER_SKIP = 4 # setting this to 0 fails first and last columns of image
+
+#
+# Minimal V4L2 (linux/videodev2.h) - just what streaming capture needs
+#
+def _IOC(direction, nr, size):
+    return (direction << 30) | (size << 16) | (ord('V') << 8) | nr
+
+def _IOR(nr, size): return _IOC(2, nr, size)
+def _IOW(nr, size): return _IOC(1, nr, size)
+def _IOWR(nr, size): return _IOC(3, nr, size)
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_INTERLACED = 4
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_STREAMING = 0x04000000
+V4L2_CAP_TIMEPERFRAME = 0x1000
+V4L2_PIX_FMT_YUYV = ord('Y') | ord('U') << 8 | ord('Y') << 16 | ord('V') << 24
+
+class v4l2_capability(ctypes.Structure):
+    _fields_ = [('driver', ctypes.c_char * 16), ('card', ctypes.c_char * 32),
+                ('bus_info', ctypes.c_char * 32), ('version', ctypes.c_uint32),
+                ('capabilities', ctypes.c_uint32), ('device_caps', ctypes.c_uint32),
+                ('reserved', ctypes.c_uint32 * 3)]
+
+class v4l2_pix_format(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint32) for name in
+                ['width', 'height', 'pixelformat', 'field', 'bytesperline',
+                 'sizeimage', 'colorspace', 'priv', 'flags', 'ycbcr_enc',
+                 'quantization', 'xfer_func']]
+
+class _format_union(ctypes.Union):
+    # raw_data is 200 bytes, and some members have pointers - 8 byte aligned
+    _fields_ = [('pix', v4l2_pix_format), ('raw_data', ctypes.c_uint8 * 200),
+                ('_align', ctypes.c_void_p)]
+
+class v4l2_format(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32), ('fmt', _format_union)]
+
+class v4l2_fract(ctypes.Structure):
+    _fields_ = [('numerator', ctypes.c_uint32), ('denominator', ctypes.c_uint32)]
+
+class v4l2_captureparm(ctypes.Structure):
+    _fields_ = [('capability', ctypes.c_uint32), ('capturemode', ctypes.c_uint32),
+                ('timeperframe', v4l2_fract), ('extendedmode', ctypes.c_uint32),
+                ('readbuffers', ctypes.c_uint32), ('reserved', ctypes.c_uint32 * 4)]
+
+class _parm_union(ctypes.Union):
+    _fields_ = [('capture', v4l2_captureparm), ('raw_data', ctypes.c_uint8 * 200)]
+
+class v4l2_streamparm(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32), ('parm', _parm_union)]
+
+class v4l2_requestbuffers(ctypes.Structure):
+    _fields_ = [('count', ctypes.c_uint32), ('type', ctypes.c_uint32),
+                ('memory', ctypes.c_uint32), ('capabilities', ctypes.c_uint32),
+                ('flags', ctypes.c_uint8), ('reserved', ctypes.c_uint8 * 3)]
+
+class timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+
+class v4l2_timecode(ctypes.Structure):
+    _fields_ = [('type', ctypes.c_uint32), ('flags', ctypes.c_uint32),
+                ('frames', ctypes.c_uint8), ('seconds', ctypes.c_uint8),
+                ('minutes', ctypes.c_uint8), ('hours', ctypes.c_uint8),
+                ('userbits', ctypes.c_uint8 * 4)]
+
+class _buffer_m(ctypes.Union):
+    _fields_ = [('offset', ctypes.c_uint32), ('userptr', ctypes.c_ulong),
+                ('planes', ctypes.c_void_p), ('fd', ctypes.c_int32)]
+
+class v4l2_buffer(ctypes.Structure):
+    _fields_ = [('index', ctypes.c_uint32), ('type', ctypes.c_uint32),
+                ('bytesused', ctypes.c_uint32), ('flags', ctypes.c_uint32),
+                ('field', ctypes.c_uint32), ('timestamp', timeval),
+                ('timecode', v4l2_timecode), ('sequence', ctypes.c_uint32),
+                ('memory', ctypes.c_uint32), ('m', _buffer_m),
+                ('length', ctypes.c_uint32), ('reserved2', ctypes.c_uint32),
+                ('request_fd', ctypes.c_int32)]
+
+VIDIOC_QUERYCAP = _IOR(0, ctypes.sizeof(v4l2_capability))
+VIDIOC_S_FMT = _IOWR(5, ctypes.sizeof(v4l2_format))
+VIDIOC_REQBUFS = _IOWR(8, ctypes.sizeof(v4l2_requestbuffers))
+VIDIOC_QUERYBUF = _IOWR(9, ctypes.sizeof(v4l2_buffer))
+VIDIOC_QBUF = _IOWR(15, ctypes.sizeof(v4l2_buffer))
+VIDIOC_DQBUF = _IOWR(17, ctypes.sizeof(v4l2_buffer))
+VIDIOC_STREAMON = _IOW(18, ctypes.sizeof(ctypes.c_int))
+VIDIOC_STREAMOFF = _IOW(19, ctypes.sizeof(ctypes.c_int))
+VIDIOC_G_PARM = _IOWR(21, ctypes.sizeof(v4l2_streamparm))
+VIDIOC_S_PARM = _IOWR(22, ctypes.sizeof(v4l2_streamparm))
+
+def v4l2_frames(device, width, height, fps, n_buffers=4):
+    # Capture YUYV frames with memory mapped streaming I/O. Yields a view
+    # of the buffer - only valid until the next frame is asked for.
+    fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+    buffers = []
+    streaming = False
+    try:
+        cap = v4l2_capability()
+        fcntl.ioctl(fd, VIDIOC_QUERYCAP, cap)
+        if not cap.capabilities & V4L2_CAP_VIDEO_CAPTURE:
+            raise RuntimeError(f'{device} is no video capture device')
+        if not cap.capabilities & V4L2_CAP_STREAMING:
+            raise RuntimeError(f'{device} does not support streaming i/o')
+
+        fmt = v4l2_format(type=V4L2_BUF_TYPE_VIDEO_CAPTURE)
+        fmt.fmt.pix.width = width
+        fmt.fmt.pix.height = height
+        fmt.fmt.pix.pixelformat = V4L2_PIX_FMT_YUYV
+        fmt.fmt.pix.field = V4L2_FIELD_INTERLACED
+        fcntl.ioctl(fd, VIDIOC_S_FMT, fmt)
+        if fmt.fmt.pix.pixelformat != V4L2_PIX_FMT_YUYV:
+            raise RuntimeError(f'{device} does not support YUYV')
+        width, height = fmt.fmt.pix.width, fmt.fmt.pix.height
+        stride = max(fmt.fmt.pix.bytesperline, width * 2)
+        print(f'Format set to: {width}x{height} YUYV')
+
+        parm = v4l2_streamparm(type=V4L2_BUF_TYPE_VIDEO_CAPTURE)
+        try:
+            fcntl.ioctl(fd, VIDIOC_G_PARM, parm)
+            if parm.parm.capture.capability & V4L2_CAP_TIMEPERFRAME:
+                parm.parm.capture.timeperframe.numerator = 1
+                parm.parm.capture.timeperframe.denominator = fps
+                fcntl.ioctl(fd, VIDIOC_S_PARM, parm)
+                tpf = parm.parm.capture.timeperframe
+                print(f'Frame rate set to: {tpf.denominator}/{tpf.numerator} fps')
+        except OSError:
+            print(f'Warning: Unable to set {fps} fps')
+
+        req = v4l2_requestbuffers(count=n_buffers, type=V4L2_BUF_TYPE_VIDEO_CAPTURE,
+                                  memory=V4L2_MEMORY_MMAP)
+        fcntl.ioctl(fd, VIDIOC_REQBUFS, req)
+        if req.count < 2:
+            raise RuntimeError(f'Insufficient buffer memory on {device}')
+        for idx in range(req.count):
+            buf = v4l2_buffer(index=idx, type=V4L2_BUF_TYPE_VIDEO_CAPTURE,
+                              memory=V4L2_MEMORY_MMAP)
+            fcntl.ioctl(fd, VIDIOC_QUERYBUF, buf)
+            mm = mmap.mmap(fd, buf.length, mmap.MAP_SHARED,
+                           mmap.PROT_READ | mmap.PROT_WRITE, offset=buf.m.offset)
+            buffers.append(mm)
+            fcntl.ioctl(fd, VIDIOC_QBUF, buf)
+        fcntl.ioctl(fd, VIDIOC_STREAMON, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        streaming = True
+
+        while True:
+            ready, _, _ = select.select([fd], [], [], 2)
+            if not ready:
+                raise RuntimeError('select timeout')
+            buf = v4l2_buffer(type=V4L2_BUF_TYPE_VIDEO_CAPTURE, memory=V4L2_MEMORY_MMAP)
+            try:
+                fcntl.ioctl(fd, VIDIOC_DQBUF, buf)
+            except BlockingIOError:
+                continue
+            data = np.frombuffer(buffers[buf.index], dtype=np.uint8)
+            yield frame_view(data, width, height, stride)
+            fcntl.ioctl(fd, VIDIOC_QBUF, buf)
+    finally:
+        if streaming:
+            fcntl.ioctl(fd, VIDIOC_STREAMOFF, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        # views of the buffers may still be around, the mappings go
+        # away with them
+        os.close(fd)
+
+def frame_view(data, width, height, stride=None):
+    # YUYV bytes => (height, width/2, 4) view: Y0 U Y1 V per pixel pair
+    stride = stride if stride else width * 2
+    rows = np.lib.stride_tricks.as_strided(data, shape=(height, width * 2),
+                                           strides=(stride, 1))
+    return rows.reshape(height, width // 2, 4)
+
+def raw_frames(fname, width, height):
+    # Raw YUYV dump, memory mapped - frames are views into the file
+    frame_size = width * height * 2
+    n_frames = os.path.getsize(fname) // frame_size
+    if n_frames == 0:
+        return
+    data = np.memmap(fname, dtype=np.uint8, mode='r', shape=(n_frames * frame_size,))
+    for idx in range(n_frames):
+        yield frame_view(data[idx * frame_size:(idx + 1) * frame_size], width, height)
+
+def decoded_frames(fname, width, height):
+    # Any other recording, decoded to YUYV by ffmpeg
+    frame_size = width * height * 2
+    proc = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', fname,
+                             '-vf', f'scale={width}:{height}',
+                             '-f', 'rawvideo', '-pix_fmt', 'yuyv422', '-'],
+                            stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            yield frame_view(np.frombuffer(data, dtype=np.uint8), width, height)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+def pixel_codes(pairs):
+    # (..., pairs, 2) of Y<<16 | U<<8 | V - both pixels of a pair share U/V
+    pairs = pairs.astype(np.uint32)
+    uv = (pairs[..., 1] << 8) | pairs[..., 3]
+    return np.stack([(pairs[..., 0] << 16) | uv, (pairs[..., 2] << 16) | uv], axis=-1)
+
+def check_frame(frame, grid=(4, 4)):
+    # Same checks as check_pixel_uniformity() in camera_stream.c, plus
+    # per region stats. Works on the bytes - pixels are only packed
+    # into YUV codes for counting the distinct colors of the mismatches.
+    height, n_pairs = frame.shape[:2]
+    center = frame[height // 2, n_pairs // 2]
+    ref = (int(center[0]), int(center[1]), int(center[3])) # even pixel
+    area = frame[:, BORDER_SKIP // 2:n_pairs - BORDER_SKIP // 2]
+    uv_diff = (area[..., 1] != ref[1]) | (area[..., 3] != ref[2])
+    even_diff = (area[..., 0] != ref[0]) | uv_diff
+    odd_diff = (area[..., 2] != ref[0]) | uv_diff
+    mismatch = int(np.count_nonzero(even_diff)) + int(np.count_nonzero(odd_diff))
+
+    # Grid cells over the checked area. Rows/columns that don't divide
+    # evenly go to the last cell.
+    rows, cols = grid
+    row_edges = np.linspace(0, area.shape[0], rows + 1).astype(int)
+    col_edges = np.linspace(0, area.shape[1], cols + 1).astype(int)
+    def cell_sums(values):
+        # uint32 is enough: 255 * (4k * 4k pixel pairs) < 2^32
+        return np.add.reduceat(np.add.reduceat(values, row_edges[:-1], axis=0, dtype=np.uint32),
+                               col_edges[:-1], axis=1, dtype=np.uint32)
+    sums = cell_sums(area)
+    pairs = np.outer(np.diff(row_edges), np.diff(col_edges))
+    means = np.stack([(sums[..., 0] + sums[..., 2]) / (2 * pairs),
+                      sums[..., 1] / pairs, sums[..., 3] / pairs], axis=-1)
+
+    distinct = 1
+    cell_mismatch = np.zeros((rows, cols), dtype=np.uint32)
+    if mismatch:
+        # Good chains have no mismatches, so this is the rare path
+        bad_pairs = even_diff | odd_diff
+        codes = pixel_codes(area[bad_pairs])
+        bad = codes[np.stack([even_diff[bad_pairs], odd_diff[bad_pairs]], axis=-1)]
+        distinct += len(np.unique(bad))
+        cell_mismatch = cell_sums(even_diff.astype(np.uint8) + odd_diff)
+
+    return {
+        'ref' : ref,
+        'mismatch' : mismatch,
+        'pixels' : int(area.shape[0] * area.shape[1] * 2),
+        'distinct' : distinct,
+        'cell_mismatch' : cell_mismatch.tolist(),
+        'cell_mean' : np.round(means, 1).tolist()
+    }
+
+def check_stream(frames, max_frames=0, grid=(4, 4), report=None, verbose=False):
+    # Prints like camera_stream.c. report (a file) gets one json line per
+    # frame.
+    n_frames = 0
+    success = 0
+    ref = None
+    ref_count = 0
+    for frame in frames:
+        result = check_frame(frame, grid)
+        if result['ref'] != ref:
+            ref = result['ref']
+            ref_count += 1
+            print(f'{n_frames:5d} {ref_count:5d} ref: Y={ref[0]}, U={ref[1]}, V={ref[2]}')
+        if result['mismatch'] > 0:
+            print(f'Mismatches: {result["mismatch"]} out of {result["pixels"]} distinct colors = {result["distinct"]}')
+            if verbose:
+                for row in result['cell_mismatch']:
+                    print('  ' + ' '.join([f'{x:8d}' for x in row]))
+        else:
+            success += 1
+        if report:
+            report.write(json.dumps(dict(result, frame=n_frames)) + '\n')
+        n_frames += 1
+        if max_frames and n_frames >= max_frames:
+            break
+    print(f'Success frames {success}/{n_frames}')
+    return success, n_frames
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', help="""
+        Recorded captures to check: raw YUYV dumps (.yuv/.raw), or anything
+        ffmpeg can decode. Without files, frames are captured from --device.
+    """)
+    parser.add_argument('--device', '-d', default='/dev/video4', help="""
+        V4L2 capture device.
+    """)
+    parser.add_argument('--size', '-s', default='1920x1080', help="""
+        Frame size, WIDTHxHEIGHT.
+    """)
+    parser.add_argument('--fps', type=int, default=60, help="""
+        Frame rate to ask the capture device for.
+    """)
+    parser.add_argument('--frames', '-n', type=int, default=None, help="""
+        Number of frames to check. 0 checks all (for a device: until
+        interrupted). Default is 1000 for a device, all for files.
+    """)
+    parser.add_argument('--grid', default='4x4', help="""
+        Regions for the per region stats, COLSxROWS.
+    """)
+    parser.add_argument('--report', help="""
+        Write the result of every frame to this file, one json per line.
+    """)
+    parser.add_argument('--verbose', '-v', action='store_true', default=False, help="""
+        Show the mismatches per region for frames that fail.
+    """)
+    args = parser.parse_args()
+
+    width, height = [int(x) for x in args.size.split('x')]
+    cols, rows = [int(x) for x in args.grid.split('x')]
+    report = open(args.report, 'w') if args.report else None
+    total_success = 0
+    total_frames = 0
+    try:
+        if not args.files:
+            max_frames = 1000 if args.frames is None else args.frames
+            print(f'Opened camera device: {args.device}')
+            frames = v4l2_frames(args.device, width, height, args.fps)
+            total_success, total_frames = check_stream(frames, max_frames, (rows, cols),
+                                                       report, args.verbose)
+        for fname in args.files:
+            print(f'== {fname}')
+            if os.path.splitext(fname)[1] in ['.yuv', '.raw']:
+                frames = raw_frames(fname, width, height)
+            else:
+                frames = decoded_frames(fname, width, height)
+            success, n_frames = check_stream(frames, args.frames or 0, (rows, cols),
+                                             report, args.verbose)
+            total_success += success
+            total_frames += n_frames
+    except KeyboardInterrupt:
+        pass
+    if len(args.files) > 1:
+        print(f'Total success frames {total_success}/{total_frames}')
+    sys.exit(0 if total_success == total_frames else 1)
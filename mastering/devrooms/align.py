@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+#
+# align.py
+#
+# Finds the time offset between the livestream and the pro camera
+# recording of a devroom, from their audio. Replaces the audalign
+# scripts (align-audio-*.py), which needed hand cut WAVs.
+#
+#   ./align.py aosp/localrec-1.mkv aosp/procam-1.mp4
+#
+# The offset follows the convention of "vcam-offset" in the devroom
+# config:
+#
+#   procam_time = livestream_time + offset
+#
+# The two recorders' clocks don't run at exactly the same rate, so over a
+# day the offset drifts. The drift is modelled as linear ("vcam-drift",
+# seconds per second of livestream):
+#
+#   procam_time = livestream_time + offset + drift * livestream_time
+#
+# How it works:
+#
+# - Both recordings are decoded by ffmpeg as 8kHz mono and reduced to a
+#   100Hz envelope on the fly (log energy per 10ms, minus a 2s moving
+#   average). That's ~1.4MB per hour of recording, and the envelope
+#   doesn't care about the (very different) gain and EQ of the two mics.
+# - Coarse: COARSE_CHUNK pieces of the livestream envelope are
+#   cross-correlated (FFT) with the whole camera envelope, and the
+#   offset most pieces agree on wins.
+# - Fine: 30s of audio at 48kHz is decoded from both recordings around
+#   the coarse match, and correlated within +/- a few envelope steps.
+#   The peak is interpolated to sub-sample precision.
+# - Drift: the livestream envelope is cut in DRIFT_WINDOW windows, and
+#   each is matched against the camera envelope within +/- DRIFT_SEARCH
+#   of the coarse offset. All windows are correlated in one batched FFT.
+#   A line is fitted to the offsets of the windows that matched well,
+#   dropping outliers (e.g. windows of silence, or a part of the day
+#   the camera missed), and the fine match pins it down.
+#
+import json
+import argparse
+import subprocess
+import numpy as np
+
+DECODE_RATE = 8000
+ENV_RATE = 100
+ENV_HOP = DECODE_RATE // ENV_RATE
+ENV_SMOOTH = 2 # seconds, moving average removed from the envelope
+COARSE_CHUNK = 600 # seconds
+FINE_RATE = 48000
+FINE_WINDOW = 30 # seconds
+FINE_MARGIN = 0.05 # seconds, search range around the coarse offset
+BLOCK_SIZE = ENV_HOP * 4096
+DRIFT_WINDOW = 120 # seconds
+DRIFT_STEP = 60 # seconds
+DRIFT_SEARCH = 5 # seconds
+MIN_SCORE = 0.3 # correlation needed for a window to count
+
+def decode(src, rate, start=None, duration=None):
+    # ffmpeg process producing mono float PCM on stdout
+    cmd = ['ffmpeg', '-v', 'error']
+    if start is not None:
+        cmd += ['-ss', f'{start:.6f}']
+    if duration is not None:
+        cmd += ['-t', f'{duration:.6f}']
+    cmd += ['-i', src, '-vn', '-ac', '1', '-ar', str(rate), '-f', 'f32le', '-']
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+def read_all(proc):
+    data = proc.stdout.read()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return np.frombuffer(data, dtype='<f4').astype(np.float64)
+
+def envelope(src):
+    # 100Hz log energy envelope of the whole recording, with the slow
+    # changes (gain, background level) taken out
+    proc = decode(src, DECODE_RATE)
+    energy = []
+    while True:
+        data = proc.stdout.read(BLOCK_SIZE * 4)
+        if len(data) == 0:
+            break
+        block = np.frombuffer(data, dtype='<f4').astype(np.float64)
+        n = block.shape[0] // ENV_HOP * ENV_HOP
+        # the last partial hop of the stream is dropped
+        energy.append(np.mean(np.square(block[:n]).reshape(-1, ENV_HOP), axis=1))
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    env = np.log(np.concatenate(energy) + 1e-10)
+    return env - moving_average(env, ENV_SMOOTH * ENV_RATE)
+
+def moving_average(x, width):
+    c = np.concatenate([[0.0], np.cumsum(x)])
+    lo = np.clip(np.arange(x.shape[0]) - width // 2, 0, x.shape[0])
+    hi = np.clip(np.arange(x.shape[0]) + width // 2 + 1, 0, x.shape[0])
+    return (c[hi] - c[lo]) / (hi - lo)
+
+def correlate(a, b):
+    # Normalized cross correlation, c[k] ~ sum(a[n] * b[n+k]), for all
+    # lags k from -(len(a)-1) to len(b)-1. Returns (lags, ncc, overlap)
+    na, nb = a.shape[0], b.shape[0]
+    n = 1 << (na + nb - 1).bit_length()
+    c = np.fft.irfft(np.conj(np.fft.rfft(a, n)) * np.fft.rfft(b, n), n)
+    lags = np.arange(-(na - 1), nb)
+    c = c[lags % n]
+    # energy of the overlapping parts of a and b, for each lag
+    ea = np.concatenate([[0.0], np.cumsum(np.square(a))])
+    eb = np.concatenate([[0.0], np.cumsum(np.square(b))])
+    n0 = np.maximum(0, -lags)
+    n1 = np.minimum(na, nb - lags)
+    energy = (ea[n1] - ea[n0]) * (eb[n1 + lags] - eb[n0 + lags])
+    ncc = c / np.sqrt(np.maximum(energy, 1e-20))
+    return lags, ncc, n1 - n0
+
+def peak(y, i):
+    # parabolic interpolation around y[i]
+    if i <= 0 or i >= y.shape[0] - 1:
+        return float(i)
+    den = y[i-1] - 2 * y[i] + y[i+1]
+    return i + (0.5 * (y[i-1] - y[i+1]) / den if den != 0 else 0.0)
+
+def coarse_offset(env_sv, env_procam):
+    # Each COARSE_CHUNK of the livestream is searched for in the whole
+    # camera envelope. Chunks are short enough for clock drift not to
+    # smear the match, and the offset most chunks agree on wins - chunks
+    # the camera didn't record just don't vote for anything useful.
+    # (at least a few chunks, so that some fit in the camera recording
+    # even if it only covers part of the livestream)
+    w = min(COARSE_CHUNK * ENV_RATE, env_sv.shape[0] // 4, env_procam.shape[0])
+    nb = env_procam.shape[0]
+    n = 1 << (nb + w - 1).bit_length()
+    fb = np.fft.rfft(env_procam, n)
+    cb = np.concatenate([[0.0], np.cumsum(np.square(env_procam))])
+    eb = cb[w:] - cb[:-w]
+    offsets = []
+    scores = []
+    for start in range(0, env_sv.shape[0] - w + 1, w // 2):
+        a = env_sv[start:start + w]
+        c = np.fft.irfft(np.conj(np.fft.rfft(a, n)) * fb, n)[:nb - w + 1]
+        ncc = c / np.sqrt(np.maximum(np.sum(np.square(a)) * eb, 1e-20))
+        i = int(np.argmax(ncc))
+        offsets.append((i - start) / ENV_RATE)
+        scores.append(ncc[i])
+    offsets = np.array(offsets)
+    scores = np.array(scores)
+    # votes from chunks that agree within DRIFT_SEARCH
+    votes = [np.sum(scores[np.abs(offsets - o) <= DRIFT_SEARCH]) for o in offsets]
+    i = int(np.argmax(votes))
+    agree = np.abs(offsets - offsets[i]) <= DRIFT_SEARCH
+    offset = float(np.median(offsets[agree]))
+    k = int(round(offset * ENV_RATE))
+    overlap = min(env_sv.shape[0], nb - k) - max(0, -k)
+    return offset, float(np.median(scores[agree])), overlap / ENV_RATE
+
+def window_offsets(env_sv, env_procam, offset):
+    # Offset of each DRIFT_WINDOW of the livestream, searched within
+    # DRIFT_SEARCH of offset. Returns (window centers, offsets, scores)
+    # in livestream time.
+    w = DRIFT_WINDOW * ENV_RATE
+    r = DRIFT_SEARCH * ENV_RATE
+    k = int(round(offset * ENV_RATE))
+    # windows whose search range lies inside the camera recording
+    starts = np.arange(0, env_sv.shape[0] - w + 1, DRIFT_STEP * ENV_RATE)
+    starts = starts[(starts + k - r >= 0) & (starts + k + w + r <= env_procam.shape[0])]
+    if starts.shape[0] == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    a = env_sv[starts[:, np.newaxis] + np.arange(w)]
+    b = env_procam[(starts + k - r)[:, np.newaxis] + np.arange(w + 2 * r)]
+    n = 1 << (2 * w + 2 * r - 1).bit_length()
+    c = np.fft.irfft(np.conj(np.fft.rfft(a, n, axis=1)) * np.fft.rfft(b, n, axis=1), n, axis=1)
+    c = c[:, :2 * r + 1] # a fully inside b
+    ea = np.sum(np.square(a), axis=1)
+    cb = np.concatenate([np.zeros((b.shape[0], 1)), np.cumsum(np.square(b), axis=1)], axis=1)
+    eb = cb[:, w:w + 2 * r + 1] - cb[:, :2 * r + 1]
+    ncc = c / np.sqrt(np.maximum(ea[:, np.newaxis] * eb, 1e-20))
+    best = np.argmax(ncc, axis=1)
+    lags = np.array([peak(row, i) for row, i in zip(ncc, best)])
+    offsets = (k - r + lags) / ENV_RATE
+    centers = (starts + w / 2) / ENV_RATE
+    return centers, offsets, ncc[np.arange(ncc.shape[0]), best]
+
+def fit_drift(t, offsets, scores):
+    # Robust line fit, offset = o + drift * t. Returns (o, drift, inliers)
+    good = scores >= MIN_SCORE
+    if np.count_nonzero(good) < 3:
+        return None, 0.0, good
+    inliers = good
+    for _ in range(5):
+        drift, o = np.polyfit(t[inliers], offsets[inliers], 1)
+        resid = np.abs(offsets - (o + drift * t))
+        mad = np.median(resid[inliers])
+        # a frame (40ms) is plenty of slack for the envelope resolution
+        keep = good & (resid <= max(4 * 1.4826 * mad, 0.04))
+        if np.array_equal(keep, inliers) or np.count_nonzero(keep) < 3:
+            break
+        inliers = keep
+    return o, drift, inliers
+
+def fine_offset(livestream, procam, offset, t_sv):
+    # Refine offset on full rate audio, FINE_WINDOW seconds from t_sv
+    # in the livestream
+    t_procam = t_sv + offset - FINE_MARGIN
+    sv = read_all(decode(livestream, FINE_RATE, t_sv, FINE_WINDOW))
+    pc = read_all(decode(procam, FINE_RATE, t_procam, FINE_WINDOW + 2 * FINE_MARGIN))
+    lags, ncc, overlap = correlate(sv, pc)
+    # only lags where the livestream window is fully inside the
+    # camera window
+    sel = (lags >= 0) & (overlap == sv.shape[0])
+    if not sel.any():
+        return offset, 0.0
+    lags, ncc = lags[sel], ncc[sel]
+    i = int(np.argmax(ncc))
+    lag = lags[0] + peak(ncc, i)
+    return t_procam - t_sv + lag / FINE_RATE, float(ncc[i])
+
+def find_offset(livestream, procam, verbose=False):
+    # Returns a dict with the offset at the start of the livestream and
+    # the drift (procam_time = t + offset + drift * t, t = livestream
+    # time), and how well the recordings matched
+    env_sv = envelope(livestream)
+    env_procam = envelope(procam)
+    offset, score, overlap = coarse_offset(env_sv, env_procam)
+    if verbose:
+        print(f'  coarse offset {offset:.2f}s, correlation {score:.3f}, overlap {overlap:.0f}s')
+    t, offsets, scores = window_offsets(env_sv, env_procam, offset)
+    o, drift, inliers = fit_drift(t, offsets, scores)
+    if verbose:
+        for i in range(t.shape[0]):
+            mark = '' if inliers[i] else ' (rejected)'
+            print(f'  window @{t[i]:.0f}s offset {offsets[i]:.3f}s, correlation {scores[i]:.3f}{mark}')
+        print(f'  drift {drift * 1e6:.2f}ppm, {np.count_nonzero(inliers)}/{t.shape[0]} windows')
+    # middle of the overlapping part
+    t_start = max(0.0, -offset)
+    t_end = min(env_sv.shape[0], env_procam.shape[0] - offset * ENV_RATE) / ENV_RATE
+    t_sv = max(t_start, (t_start + t_end - FINE_WINDOW) / 2)
+    local = offset if o is None else o + drift * (t_sv + FINE_WINDOW / 2)
+    fine, fine_score = fine_offset(livestream, procam, local, t_sv)
+    if verbose:
+        print(f'  fine offset {fine:.6f}s at {t_sv:.1f}s, correlation {fine_score:.3f}')
+    return {
+        'offset' : round(fine - drift * (t_sv + FINE_WINDOW / 2), 6),
+        'drift' : round(drift, 9),
+        'coarse-offset' : offset,
+        'score' : round(score, 4),
+        'fine-score' : round(fine_score, 4),
+        'overlap' : overlap,
+        'windows' : [[round(float(t[i]), 1), round(float(offsets[i]), 4), round(float(scores[i]), 3), bool(inliers[i])]
+                     for i in range(t.shape[0])]
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('livestream', help="""
+        Livestream recording (speaker+slides).
+    """)
+    parser.add_argument('procam', help="""
+        Pro camera recording.
+    """)
+    parser.add_argument('--verbose', '-v', action='store_true', default=False, help="""
+        Show the coarse and fine matches.
+    """)
+    args = parser.parse_args()
+    print(json.dumps(find_offset(args.livestream, args.procam, args.verbose), indent=2))
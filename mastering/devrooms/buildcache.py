@@ -0,0 +1,84 @@
+#
+# buildcache.py
+#
+# Make-style dependency cache for the mastering steps.
+#
+# Each step (one command) is identified by a key - a hash of
+#
+#  - the command line
+#  - identity of every input file: size + mtime, or a hash of
+#    the contents
+#  - config values the step depends on (cuts, offsets, crop boxes...)
+#
+# After a step succeeds, the key is recorded in a stamp file next to
+# its (first) output, in a .cache directory. The step is skipped next
+# time if the key matches and all outputs still exist. Steps without
+# output files (e.g. measurements) name their stamp explicitly, and keep
+# their output in it.
+#
+import hashlib
+import json
+import os
+from pathlib import Path
+
+def file_identity(fname, content_hash=False):
+    st = os.stat(fname)
+    if not content_hash:
+        return [st.st_size, st.st_mtime_ns]
+    # Hashing multi GB recordings is slow, so remember the hash for
+    # as long as size+mtime stay the same
+    stamp = stamp_file(fname, '.hash')
+    ident = [st.st_size, st.st_mtime_ns]
+    try:
+        saved = json.loads(open(stamp, 'r').read())
+        if saved['ident'] == ident:
+            return saved['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    stamp.parent.mkdir(parents=True, exist_ok=True)
+    open(stamp, 'w').write(json.dumps({'ident' : ident, 'sha256' : digest}))
+    return digest
+
+def stamp_file(fname, suffix='.json'):
+    fname = Path(fname)
+    return fname.parent / '.cache' / (fname.name + suffix)
+
+def step_key(cmd, inputs, deps, content_hash=False):
+    desc = {
+        'cmd' : list(cmd),
+        'inputs' : [[str(x), file_identity(x, content_hash)] for x in inputs],
+        'deps' : deps
+    }
+    return hashlib.sha256(json.dumps(desc, sort_keys=True, default=str).encode()).hexdigest()
+
+def lookup(key, stamp, outputs):
+    # Returns the saved stamp if the step is up to date, None otherwise
+    for out in outputs:
+        if not os.path.exists(out):
+            return None
+    try:
+        saved = json.loads(open(stamp_file(stamp), 'r').read())
+    except (OSError, ValueError):
+        return None
+    if saved.get('key') != key:
+        return None
+    return saved
+
+def record(key, stamp, output=None):
+    fname = stamp_file(stamp)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    # write + rename, so that a killed run doesn't leave a bad stamp
+    tmp = f'{fname}.tmp'
+    open(tmp, 'w').write(json.dumps({ 'key' : key, 'output' : output }))
+    os.replace(tmp, fname)
+
+def invalidate(stamp):
+    try:
+        os.unlink(stamp_file(stamp))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+#
+# cutsuggest.py
+#
+# Suggests the cuts of a talk - where it starts and ends, and where the
+# video switches between speaker and slides - from what happens in the
+# recordings, with sub-second precision:
+#
+# - slide changes: the slides box of the livestream (proc.slides.crop)
+#   is decoded by ffmpeg as a tiny grayscale image (HASH_WIDTH+1 x
+#   HASH_HEIGHT) at SCAN_RATE fps. A difference hash (one bit per
+#   horizontally adjacent pixel pair) is computed for every frame, and a
+#   hash that differs from the previous frame's in more than CHANGE_BITS
+#   bits is a slide change.
+# - silences: the camera audio is decoded at 8kHz and reduced to the
+#   energy per SILENCE_HOP. Stretches more than SILENCE_DB below the
+#   talk's median level, for at least MIN_SILENCE, are silences.
+#
+# Only the part of the recordings around the hand made cuts is decoded,
+# and talks are scanned in parallel.
+#
+# Suggestions:
+#
+# - start: the end of the silence closest to the first cut, if there is
+#   one within SNAP_EDGE
+# - end: the start of the silence closest to the last cut, likewise
+# - switches (the cuts in between): the slide change closest to the cut,
+#   within SNAP_SWITCH
+#
+# All times are in livestream time, like the cuts.
+#
+import json
+import argparse
+import subprocess
+import concurrent.futures
+import numpy as np
+
+import align
+
+SCAN_RATE = 10 # fps
+HASH_WIDTH = 16
+HASH_HEIGHT = 16
+CHANGE_BITS = 12 # of HASH_WIDTH * HASH_HEIGHT
+AUDIO_RATE = 8000
+SILENCE_HOP = 0.05 # seconds
+SILENCE_DB = 25
+MIN_SILENCE = 1.5 # seconds
+MARGIN = 60 # seconds scanned before/after the hand made cuts
+SNAP_EDGE = 30 # seconds
+SNAP_SWITCH = 15 # seconds
+LEAD = 0.5 # seconds of silence kept before the start / after the end
+
+def slide_changes(vfile, crop, start, duration):
+    # Times (from start) of slide changes in the crop box (w, h, x, y)
+    w, h, x, y = crop
+    cmd = ['ffmpeg', '-v', 'error',
+           '-ss', f'{start:.6f}', '-t', f'{duration:.6f}', '-i', vfile, '-an',
+           '-vf', f'crop={w}:{h}:{x}:{y},fps={SCAN_RATE},'
+                  f'scale={HASH_WIDTH + 1}:{HASH_HEIGHT}:flags=area,format=gray',
+           '-f', 'rawvideo', '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    data = proc.stdout.read()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    frame_size = (HASH_WIDTH + 1) * HASH_HEIGHT
+    n = len(data) // frame_size
+    if n < 2:
+        return np.zeros(0)
+    frames = np.frombuffer(data[:n * frame_size], dtype=np.uint8)
+    frames = frames.reshape(n, HASH_HEIGHT, HASH_WIDTH + 1).astype(np.int16)
+    hashes = frames[:, :, 1:] > frames[:, :, :-1]
+    bits = np.count_nonzero(hashes[1:] != hashes[:-1], axis=(1, 2))
+    # a change is seen at the first frame that shows the new slide
+    return (np.flatnonzero(bits > CHANGE_BITS) + 1) / SCAN_RATE
+
+def silences(vfile, start, duration):
+    # [(start, end)] (from start) of the silences in the audio
+    proc = align.decode(vfile, AUDIO_RATE, start, duration)
+    hop = int(AUDIO_RATE * SILENCE_HOP)
+    energy = []
+    while True:
+        data = proc.stdout.read(hop * 4096 * 4)
+        if len(data) == 0:
+            break
+        block = np.frombuffer(data, dtype='<f4')
+        n = block.shape[0] // hop * hop
+        energy.append(np.mean(np.square(block[:n], dtype=np.float64).reshape(-1, hop), axis=1))
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    if not energy:
+        return []
+    level = 10 * np.log10(np.concatenate(energy) + 1e-12)
+    quiet = level < np.median(level) - SILENCE_DB
+    padded = np.concatenate([[False], quiet, [False]])
+    edges = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    return [(s * SILENCE_HOP, e * SILENCE_HOP) for s, e in zip(edges[::2], edges[1::2])
+            if (e - s) * SILENCE_HOP >= MIN_SILENCE]
+
+def closest(candidates, t, limit):
+    best = None
+    for c in candidates:
+        if abs(c - t) <= limit and (best is None or abs(c - t) < abs(best - t)):
+            best = c
+    return best
+
+def suggest_talk(livestream, procam, crop, cuts, offset):
+    # cuts in seconds of livestream, offset: procam_time = livestream_time + offset
+    t0 = max(cuts[0] - MARGIN, 0)
+    duration = cuts[-1] + MARGIN - t0
+    changes = [t0 + t for t in slide_changes(livestream, crop, t0, duration)]
+    # (the camera may have started after the window did)
+    procam_start = max(t0 + offset, 0)
+    quiet = [(procam_start + s - offset, procam_start + e - offset)
+             for s, e in silences(procam, procam_start, duration)]
+
+    suggested = list(cuts)
+    notes = ['kept'] * len(cuts)
+    start = closest([e for s, e in quiet], cuts[0], SNAP_EDGE)
+    if start is not None:
+        suggested[0] = max(start - LEAD, 0)
+        notes[0] = 'silence end'
+    end = closest([s for s, e in quiet], cuts[-1], SNAP_EDGE)
+    if end is not None:
+        suggested[-1] = end + LEAD
+        notes[-1] = 'silence start'
+    for idx in range(1, len(cuts) - 1):
+        change = closest(changes, cuts[idx], SNAP_SWITCH)
+        if change is not None:
+            suggested[idx] = change
+            notes[idx] = 'slide change'
+    return {
+        'cuts' : [round(t, 3) for t in suggested],
+        'notes' : notes,
+        'slide_changes' : [round(t, 3) for t in changes],
+        'silences' : [[round(s, 3), round(e, 3)] for s, e in quiet]
+    }
+
+def suggest_all(livestream, procam, crop, talks, jobs=None):
+    # talks: [(cuts, offset)] => suggestions, scanned in parallel (the
+    # work is in the ffmpeg processes)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(lambda t: suggest_talk(livestream, procam, crop, t[0], t[1]),
+                                 talks))
+
+def seconds(ts):
+    h, m, s = ts.split(':')
+    return int(h)*3600 + int(m)*60 + float(s)
+
+def timestamp(seconds):
+    # HH:MM:SS.fff, as accepted in the cuts
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f'{int(h):02d}:{int(m):02d}:{s:06.3f}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('livestream', help="""
+        Livestream recording (speaker+slides).
+    """)
+    parser.add_argument('procam', help="""
+        Pro camera recording.
+    """)
+    parser.add_argument('--crop', required=True, help="""
+        Slides box in the livestream, as W:H:X:Y.
+    """)
+    parser.add_argument('--offset', type=float, default=0, help="""
+        vcam-offset: procam_time = livestream_time + offset.
+    """)
+    parser.add_argument('cuts', nargs='+', help="""
+        Hand made cuts of one talk, HH:MM:SS[.fff].
+    """)
+    args = parser.parse_args()
+    crop = [int(x) for x in args.crop.split(':')]
+    result = suggest_talk(args.livestream, args.procam, crop,
+                          [seconds(c) for c in args.cuts], args.offset)
+    result['cuts'] = [timestamp(t) for t in result['cuts']]
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+# framescan.py
+#
+# QA scan of the source recordings (livestream, camera) for problems
+# that are otherwise only found after rendering: black frames, frozen
+# picture and capture dropouts.
+#
+#   ./framescan.py aosp/localrec-1.mkv          # print suspicious spans
+#   ./framescan.py --json aosp/procam-1.mp4
+#
+# How it works:
+#
+# - ffmpeg decodes the video as small grayscale frames (SCAN_WIDTH x
+#   SCAN_HEIGHT) at SCAN_RATE fps. Scaling and dropping frames in ffmpeg
+#   keeps the data tiny (~0.2MB per second of video).
+# - The recording is split in chunks, scanned by parallel ffmpeg +
+#   NumPy workers. Each chunk overlaps the previous one by a frame, so
+#   no frame to frame difference is lost at the boundaries.
+# - Per frame signatures, computed on batches of frames at once: mean
+#   luma, and mean absolute difference to the previous frame.
+# - Dropouts are found from the packet timestamps (ffprobe, no decoding):
+#   a gap of more than DROP_GAP frame intervals.
+#
+# Spans are (kind, start, end) in seconds of the recording, kind is
+# one of black, frozen or dropout.
+#
+import os
+import json
+import argparse
+import subprocess
+import concurrent.futures
+import numpy as np
+
+SCAN_WIDTH = 160
+SCAN_HEIGHT = 90
+SCAN_RATE = 5 # fps
+BATCH_FRAMES = 256
+BLACK_LUMA = 20 # mean luma (0..255) below this is black
+FROZEN_DIFF = 0.2 # mean abs difference below this is a frozen frame
+MIN_BLACK = 1.0 # seconds
+MIN_FROZEN = 10.0 # seconds
+DROP_GAP = 2.5 # frame intervals
+CHUNK = 600 # seconds per worker
+
+def probe(vfile):
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                             '-show_entries', 'format=duration,start_time:stream=r_frame_rate',
+                             '-of', 'json', vfile],
+                            capture_output=True, text=True, check=True)
+    info = json.loads(result.stdout)
+    num, den = info['streams'][0]['r_frame_rate'].split('/')
+    start_time = float(info['format'].get('start_time', 0))
+    return float(info['format']['duration']), float(num) / float(den), start_time
+
+def scan_chunk(vfile, start, duration):
+    # => (time, mean luma, mean abs diff to previous frame) per frame, at
+    # SCAN_RATE from start. The frame before start is decoded too, for
+    # the difference of the first frame.
+    lead = 1.0 / SCAN_RATE if start > 0 else 0.0
+    cmd = ['ffmpeg', '-v', 'error',
+           '-ss', f'{start - lead:.6f}', '-t', f'{duration + lead:.6f}', '-i', vfile,
+           '-an', '-vf', f'fps={SCAN_RATE},scale={SCAN_WIDTH}:{SCAN_HEIGHT},format=gray',
+           '-f', 'rawvideo', '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    frame_size = SCAN_WIDTH * SCAN_HEIGHT
+    luma = []
+    diff = []
+    prev = None
+    while True:
+        data = proc.stdout.read(frame_size * BATCH_FRAMES)
+        n = len(data) // frame_size
+        if n == 0:
+            break
+        frames = np.frombuffer(data[:n * frame_size], dtype=np.uint8)
+        frames = frames.reshape(n, SCAN_HEIGHT, SCAN_WIDTH).astype(np.int16)
+        luma.append(frames.mean(axis=(1, 2)))
+        if prev is not None:
+            frames_prev = np.concatenate([prev[None], frames[:-1]])
+        else:
+            frames_prev = np.concatenate([frames[:1], frames[:-1]])
+        # the very first frame has nothing to compare with
+        d = np.abs(frames - frames_prev).mean(axis=(1, 2))
+        if prev is None:
+            d[0] = np.inf
+        diff.append(d)
+        prev = frames[-1]
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    luma = np.concatenate(luma) if luma else np.zeros(0)
+    diff = np.concatenate(diff) if diff else np.zeros(0)
+    skip = 1 if lead > 0 else 0
+    times = start + np.arange(len(luma) - skip) / SCAN_RATE
+    return times, luma[skip:], diff[skip:]
+
+def dropouts(vfile, frame_rate, start_time):
+    # Gaps in the packet timestamps, without decoding anything
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                             '-show_entries', 'packet=pts_time', '-of', 'csv=p=0', vfile],
+                            capture_output=True, text=True, check=True)
+    times = np.array(sorted([float(x) for x in result.stdout.split() if x not in ['', 'N/A']]))
+    times -= start_time
+    if len(times) < 2:
+        return []
+    gaps = np.diff(times)
+    idx = np.nonzero(gaps > DROP_GAP / frame_rate)[0]
+    return [('dropout', round(times[i], 3), round(times[i + 1], 3)) for i in idx]
+
+def runs(mask, min_len):
+    # [start, end) index ranges where mask is set for at least min_len
+    padded = np.concatenate([[False], mask, [False]])
+    edges = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    return [(s, e) for s, e in zip(edges[::2], edges[1::2]) if e - s >= min_len]
+
+def scan(vfile, jobs=None, min_black=MIN_BLACK, min_frozen=MIN_FROZEN):
+    duration, frame_rate, start_time = probe(vfile)
+    starts = np.arange(0, duration, CHUNK)
+    jobs = jobs if jobs else os.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # ffmpeg does the decoding, and NumPy releases the GIL, so threads
+        # are enough
+        drops = executor.submit(dropouts, vfile, frame_rate, start_time)
+        chunks = list(executor.map(lambda s: scan_chunk(vfile, s, min(CHUNK, duration - s)),
+                                   starts))
+        times = np.concatenate([c[0] for c in chunks])
+        luma = np.concatenate([c[1] for c in chunks])
+        diff = np.concatenate([c[2] for c in chunks])
+        spans = drops.result()
+    step = 1.0 / SCAN_RATE
+    for s, e in runs(luma < BLACK_LUMA, int(min_black * SCAN_RATE)):
+        spans.append(('black', round(times[s], 3), round(times[e - 1] + step, 3)))
+    # A frozen frame is one with no change from the previous one - the
+    # span starts at the frame before
+    for s, e in runs(diff < FROZEN_DIFF, int(min_frozen * SCAN_RATE)):
+        spans.append(('frozen', round(times[max(s - 1, 0)], 3), round(times[e - 1] + step, 3)))
+    spans.sort(key=lambda span: span[1])
+    return {
+        'file' : vfile,
+        'duration' : duration,
+        'frame_rate' : frame_rate,
+        'frames_scanned' : int(len(luma)),
+        'spans' : spans
+    }
+
+def hms(seconds):
+    sign = '-' if seconds < 0 else ''
+    seconds = abs(seconds)
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f'{sign}{int(h):02d}:{int(m):02d}:{s:06.3f}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('video', nargs='+', help="""
+        Recording(s) to scan.
+    """)
+    parser.add_argument('--jobs', '-j', type=int, default=None, help="""
+        Number of chunks scanned in parallel. Default is the number of CPUs.
+    """)
+    parser.add_argument('--min-frozen', type=float, default=MIN_FROZEN, help="""
+        Shortest frozen span to report, in seconds.
+    """)
+    parser.add_argument('--json', action='store_true', default=False, help="""
+        Print the result as json.
+    """)
+    args = parser.parse_args()
+    for vfile in args.video:
+        result = scan(vfile, args.jobs, min_frozen=args.min_frozen)
+        if args.json:
+            print(json.dumps(result, indent=2))
+            continue
+        print(f'{vfile}: {len(result["spans"])} suspicious spans')
+        for kind, start, end in result['spans']:
+            print(f'  {kind:8s} {hms(start)} - {hms(end)} ({end - start:.1f}s)')
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+#
+# loudness.py
+#
+# EBU R128 loudness measurement (ITU-R BS.1770), in one streaming pass
+# over a WAV file, using NumPy.
+#
+# Measures what the first pass of ffmpeg's loudnorm filter reports -
+# integrated loudness, loudness range, true peak and the gating
+# threshold - so that the values can be fed straight into the
+# second (apply) pass of loudnorm, without scraping ffmpeg's stderr.
+#
+#   ./loudness.py filtered_a.wav             # print measurement as json
+#   ./loudness.py --loudnorm filtered_a.wav  # print loudnorm filter options
+#
+# How it works:
+#
+# - K-weighting is done with the FFT (overlap-save), using a long
+#   truncated impulse response of the two BS.1770 biquads. The high pass
+#   stage decays below 1e-7 in ~3300 samples at 48kHz, so 8192 taps is
+#   exact for all practical purposes.
+# - Filtered energy is summed per 100ms segment. The 400ms gating blocks
+#   (75% overlap) and 3s short term windows (for LRA) are sums of
+#   segments - so only one float per channel per 100ms is kept in memory.
+# - True peak uses 4x oversampling with a polyphase windowed sinc.
+#
+import os
+import sys
+import json
+import struct
+import argparse
+import numpy as np
+
+# loudnorm targets used for the talk videos. -16 is technically for
+# podcasts (see README)
+TARGET_I = -16
+TARGET_LRA = 11
+TARGET_TP = -1.5
+
+IR_TAPS = 8192
+OVERSAMPLE = 4
+TP_TAPS_PER_PHASE = 12
+BLOCK_SIZE = 1<<16 # samples per channel processed at a time
+
+def k_weighting(rate):
+    # Coefficients of the two K-weighting biquads for any sample rate
+    # (same design as libebur128 - matches the BS.1770 table at 48kHz)
+    f0 = 1681.974450955533
+    G = 3.999843853973347
+    Q = 0.7071752369554196
+    K = np.tan(np.pi * f0 / rate)
+    Vh = np.power(10.0, G / 20.0)
+    Vb = np.power(Vh, 0.4996667741545416)
+    a0 = 1.0 + K / Q + K * K
+    shelf_b = [(Vh + Vb * K / Q + K * K) / a0,
+               2.0 * (K * K - Vh) / a0,
+               (Vh - Vb * K / Q + K * K) / a0]
+    shelf_a = [1.0,
+               2.0 * (K * K - 1.0) / a0,
+               (1.0 - K / Q + K * K) / a0]
+
+    f0 = 38.13547087602444
+    Q = 0.5003270373238773
+    K = np.tan(np.pi * f0 / rate)
+    a0 = 1.0 + K / Q + K * K
+    hp_b = [1.0, -2.0, 1.0]
+    hp_a = [1.0,
+            2.0 * (K * K - 1.0) / a0,
+            (1.0 - K / Q + K * K) / a0]
+    return [(shelf_b, shelf_a), (hp_b, hp_a)]
+
+def impulse_response(biquads, taps):
+    # Runs the (tiny) recursion once, sample by sample
+    x = np.zeros(taps)
+    x[0] = 1.0
+    for b, a in biquads:
+        y = np.zeros(taps)
+        x1 = x2 = y1 = y2 = 0.0
+        for n in range(taps):
+            y[n] = b[0]*x[n] + b[1]*x1 + b[2]*x2 - a[1]*y1 - a[2]*y2
+            x2, x1 = x1, x[n]
+            y2, y1 = y1, y[n]
+        x = y
+    return x
+
+def oversampling_filter(factor, taps_per_phase):
+    # Windowed sinc low pass at the original Nyquist, split in phases
+    n_taps = factor * taps_per_phase
+    n = np.arange(n_taps) - (n_taps - 1) / 2.0
+    h = np.sinc(n / factor) * np.kaiser(n_taps, 8.0)
+    # each phase has unity DC gain
+    h = h.reshape(taps_per_phase, factor).T
+    return h / h.sum(axis=1, keepdims=True)
+
+class LoudnessMeter:
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.channels = channels
+        # 100ms segments
+        self.seg_len = rate // 10
+        self.ir = impulse_response(k_weighting(rate), IR_TAPS)
+        self.ir_fft = {}
+        self.tp_filter = oversampling_filter(OVERSAMPLE, TP_TAPS_PER_PHASE)
+        # state carried between blocks
+        self.kw_tail = np.zeros((IR_TAPS - 1, channels))
+        self.tp_tail = np.zeros((TP_TAPS_PER_PHASE - 1, channels))
+        self.partial = np.zeros((0, channels))
+        self.segments = [] # per 100ms: energy per channel
+        self.peak = 0.0
+
+    def _ir_fft(self, nfft):
+        if nfft not in self.ir_fft:
+            self.ir_fft[nfft] = np.fft.rfft(self.ir, nfft)
+        return self.ir_fft[nfft]
+
+    def feed(self, samples):
+        # samples: (n, channels) floats, full scale = 1.0
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.ndim == 1:
+            samples = samples[:, np.newaxis]
+        n = samples.shape[0]
+        if n == 0:
+            return
+
+        # K-weighting - overlap save
+        buf = np.concatenate([self.kw_tail, samples])
+        nfft = 1 << int(np.ceil(np.log2(buf.shape[0])))
+        spec = np.fft.rfft(buf, nfft, axis=0) * self._ir_fft(nfft)[:, np.newaxis]
+        weighted = np.fft.irfft(spec, nfft, axis=0)[IR_TAPS - 1:buf.shape[0]]
+        self.kw_tail = buf[-(IR_TAPS - 1):]
+
+        # energy per 100ms segment
+        weighted = np.concatenate([self.partial, weighted])
+        n_seg = weighted.shape[0] // self.seg_len
+        used = n_seg * self.seg_len
+        if n_seg > 0:
+            sq = np.square(weighted[:used]).reshape(n_seg, self.seg_len, self.channels)
+            self.segments.append(sq.sum(axis=1))
+        self.partial = weighted[used:]
+
+        # True peak - oversampled polyphase FIR
+        buf = np.concatenate([self.tp_tail, samples])
+        peak = np.abs(samples).max()
+        for phase in self.tp_filter:
+            for c in range(self.channels):
+                y = np.convolve(buf[:, c], phase, mode='valid')
+                peak = max(peak, np.abs(y).max())
+        self.tp_tail = buf[-(TP_TAPS_PER_PHASE - 1):]
+        self.peak = max(self.peak, peak)
+
+    def result(self):
+        if len(self.segments) > 0:
+            seg = np.concatenate(self.segments)
+        else:
+            seg = np.zeros((0, self.channels))
+        # channel weights are all 1 for mono/stereo
+        seg = seg.sum(axis=1)
+
+        # 400ms gating blocks, 75% overlap
+        input_i, input_thresh = -70.0, -70.0
+        if seg.shape[0] >= 4:
+            block = np.convolve(seg, np.ones(4), mode='valid') / (0.4 * self.rate)
+            input_i, input_thresh = gated_loudness(block, -10.0)
+
+        # 3s short term loudness, for the loudness range
+        input_lra = 0.0
+        if seg.shape[0] >= 30:
+            short = np.convolve(seg, np.ones(30), mode='valid') / (3.0 * self.rate)
+            short = short[loudness(short) > -70.0]
+            if short.shape[0] > 0:
+                rel_gate = loudness(short.mean()) - 20.0
+                st = loudness(short)
+                st = st[st > rel_gate]
+                if st.shape[0] > 0:
+                    low, high = np.percentile(st, [10, 95])
+                    input_lra = high - low
+
+        input_tp = 20.0 * np.log10(self.peak) if self.peak > 0 else -99.0
+        return {
+            'input_i' : round(float(input_i), 2),
+            'input_tp' : round(float(input_tp), 2),
+            'input_lra' : round(float(input_lra), 2),
+            'input_thresh' : round(float(input_thresh), 2),
+            # ffmpeg's first pass reports the gain its dynamic mode would
+            # need on top of the measured values. We don't run the dynamic
+            # mode, so there's nothing to add. In linear mode loudnorm
+            # computes the offset by itself from measured_I.
+            'target_offset' : 0.0
+        }
+
+def loudness(energy):
+    with np.errstate(divide='ignore'):
+        return -0.691 + 10.0 * np.log10(energy)
+
+def gated_loudness(block, rel_gate):
+    # Returns gated loudness, and the relative gate threshold
+    block = block[loudness(block) > -70.0]
+    if block.shape[0] == 0:
+        return -70.0, -70.0
+    thresh = loudness(block.mean()) + rel_gate
+    gated = block[loudness(block) > thresh]
+    if gated.shape[0] == 0:
+        return -70.0, float(thresh)
+    return float(loudness(gated.mean())), float(thresh)
+
+def read_wav_header(f):
+    # Returns (rate, channels, dtype, data offset, data size)
+    # data size is None if unknown (streamed wav from ffmpeg)
+    riff, size, wave = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ValueError('Not a WAV file')
+    offset = 12
+    fmt = None
+    while True:
+        hdr = f.read(8)
+        if len(hdr) < 8:
+            raise ValueError('No data in WAV file')
+        chunk_id, chunk_size = struct.unpack('<4sI', hdr)
+        offset += 8
+        if chunk_id == b'data':
+            break
+        data = f.read(chunk_size + (chunk_size & 1))
+        offset += chunk_size + (chunk_size & 1)
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', data[:16])
+            if fmt[0] == 0xFFFE: # WAVE_FORMAT_EXTENSIBLE, real format in GUID
+                fmt = (struct.unpack('<H', data[24:26])[0],) + fmt[1:]
+    if fmt is None:
+        raise ValueError('No format in WAV file')
+    tag, channels, rate, _, _, bits = fmt
+    if tag == 1 and bits == 16:
+        dtype = np.dtype('<i2')
+    elif tag == 1 and bits == 32:
+        dtype = np.dtype('<i4')
+    elif tag == 3 and bits == 32:
+        dtype = np.dtype('<f4')
+    elif tag == 3 and bits == 64:
+        dtype = np.dtype('<f8')
+    else:
+        raise ValueError(f'Unsupported WAV format {tag}/{bits} bits')
+    if chunk_size in (0, 0xFFFFFFFF):
+        chunk_size = None
+    return rate, channels, dtype, offset, chunk_size
+
+def to_float(samples):
+    if samples.dtype.kind == 'f':
+        return samples
+    return samples / float(np.iinfo(samples.dtype).max + 1)
+
+def measure_wav(fname):
+    if fname == '-':
+        return measure_stream(sys.stdin.buffer)
+    with open(fname, 'rb') as f:
+        rate, channels, dtype, offset, size = read_wav_header(f)
+    # size is missing, or may be bogus, if ffmpeg couldn't seek back to
+    # write the header
+    avail = os.path.getsize(fname) - offset
+    size = avail if size is None else min(size, avail)
+    frames = size // (channels * dtype.itemsize)
+    meter = LoudnessMeter(rate, channels)
+    if frames > 0:
+        pcm = np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=(frames, channels))
+        for start in range(0, frames, BLOCK_SIZE):
+            meter.feed(to_float(pcm[start:start + BLOCK_SIZE]))
+    return meter.result()
+
+def measure_stream(f):
+    rate, channels, dtype, offset, size = read_wav_header(f)
+    frame_size = channels * dtype.itemsize
+    meter = LoudnessMeter(rate, channels)
+    while True:
+        data = f.read(BLOCK_SIZE * frame_size)
+        frames = len(data) // frame_size
+        if frames == 0:
+            break
+        pcm = np.frombuffer(data[:frames * frame_size], dtype=dtype).reshape(frames, channels)
+        meter.feed(to_float(pcm))
+    return meter.result()
+
+def loudnorm_args(param):
+    # Options for the second (apply) pass of ffmpeg's loudnorm
+    # ffmpeg rejects values outside these ranges
+    clamp = lambda v, lo, hi: min(max(v, lo), hi)
+    loudnorm = f'linear=true:I={TARGET_I}:LRA={TARGET_LRA}:tp={TARGET_TP}:'
+    loudnorm += f'measured_I={clamp(param["input_i"], -99, 0)}:'
+    loudnorm += f'measured_LRA={clamp(param["input_lra"], 0, 99)}:'
+    loudnorm += f'measured_tp={clamp(param["input_tp"], -99, 99)}:'
+    loudnorm += f'measured_thresh={clamp(param["input_thresh"], -99, 0)}:'
+    loudnorm += f'offset={clamp(param["target_offset"], -99, 99)}:'
+    loudnorm += 'print_format=summary'
+    return loudnorm
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('wav', nargs='+', help="""
+        WAV file(s) to measure. Use - to read a WAV stream from stdin.
+    """)
+    parser.add_argument('--loudnorm', action='store_true', default=False, help="""
+        Print the options for ffmpeg's loudnorm filter instead of the
+        measurement.
+    """)
+    args = parser.parse_args()
+    for wav in args.wav:
+        param = measure_wav(wav)
+        if args.loudnorm:
+            print(loudnorm_args(param))
+        else:
+            print(json.dumps(param, indent=2) if len(args.wav) == 1 else json.dumps(dict(param, file=wav)))
@@ -28,38 +28,645 @@ import sys
 import subprocess
 from pathlib import Path
 from pprint import pprint
-import re
 import json
 import argparse
+import os
+import re
+import contextlib
+import math
+from fractions import Fraction
+import concurrent.futures
 from enum import Enum
 
-from enum import Enum
+import buildcache
+import loudness
+import audiochain
+import align
+import smartcut
+import framescan
+import cutsuggest
+import stagetimer
+import stepgraph
+import renderfarm
+import slidestatic
+import noiseprofile
 
 class Pipeline(Enum):
     full = "full"
     clips = "clips"
     audio = "audio"
+    single = "single"
 
     def __str__(self):
         # This makes the help message and error messages more user-friendly
         return self.value
 
-def add_proc(message, cmd, capture_output=False, verbose=False):
+# Per process settings, set up by the talk scheduler.
+#  threads - ffmpeg threads to use per command (None => ffmpeg decides)
+#  log     - file to send all output to, so that output from talks
+#            processed in parallel doesn't interleave
+#  cache   - skip steps whose command, inputs and config haven't changed
+#            since the last run. 'mtime' identifies inputs by size+mtime,
+#            'content' by a hash of the contents. None disables the cache
+#  force   - run all steps, even if they are up to date
+#  cut     - 'smart' cuts the clips by stream copy between keyframes,
+#            'encode' re-encodes every clip in full
+#  audio   - 'fused' runs the audio steps as one streaming pass
+#            (audiochain.py), 'sox' as separate ffmpeg/sox commands
+#  chunks  - encode the fullscreen video, the composite and the stitch
+#            in this many chunks in parallel (see encode_chunks)
+#  slides  - 'all' composites every frame of the slides, 'dedup' only
+#            the ones that change (slidestatic.py)
+#  sources - talk segments cut (or found up to date) by cut_devroom_sources
+#            in this run, whose cut steps the talks leave out
+proc_opts = {
+    'threads' : None,
+    'log' : None,
+    'cache' : 'mtime',
+    'force' : False,
+    'cut' : 'smart',
+    'audio' : 'fused',
+    'chunks' : 1,
+    'slides' : 'all',
+    'sources' : set()
+}
+
+# ffmpeg video encoder options, by profile. A devroom config can replace
+# a profile with its own "encode" entry, e.g. for a hardware encoder:
+#
+#   "encode" : {
+#     "final" : { "c:v" : "h264_nvenc", "preset" : "p6", "cq" : 21 }
+#   }
+#
+# Any ffmpeg output option can go in a profile ("threads", "x265-params",
+# ...). With --jobs, the scheduler's -threads comes later and wins.
+#
+#  intermediate - files that are only decoded again by later steps.
+#                 Fast to write, near lossless, and all intra so that
+#                 cutting clips out of them is cheap and frame exact
+#  final        - the published video
+ENCODE_PROFILES = {
+    'intermediate' : {
+        'c:v' : 'libx264', 'preset' : 'ultrafast', 'crf' : 12, 'g' : 1,
+        'pix_fmt' : 'yuv420p'
+    },
+    'final' : {
+        'c:v' : 'libx264', 'preset' : 'medium', 'crf' : 20,
+        'maxrate' : '8M', 'bufsize' : '16M', 'pix_fmt' : 'yuv420p'
+    }
+}
+
+def encode_args(cfg, profile):
+    opts = cfg.get('encode', {}).get(profile, ENCODE_PROFILES[profile])
+    args = []
+    for opt, value in opts.items():
+        args += [f'-{opt}', str(value)]
+    return args
+
+def add_proc(message, cmd, capture_output=False, verbose=False,
+             inputs=None, outputs=None, deps=None, stamp=None, threads=None,
+             atomic=False):
     global skip_proc
-    print(message)
-    if capture_output:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return result
+    # Steps that declare their inputs can be skipped if nothing changed
+    key = None
+    if proc_opts['cache'] and inputs is not None:
+        stamp = stamp if stamp else outputs[0]
+        key = buildcache.step_key(cmd, inputs, deps, proc_opts['cache'] == 'content')
+        saved = None if proc_opts['force'] else buildcache.lookup(key, stamp, outputs)
+        if saved:
+            print(f'{message} up to date', flush=True)
+            stagetimer.cached(message)
+            if capture_output:
+                return subprocess.CompletedProcess(cmd, 0, '', saved['output'])
+            return
+        buildcache.invalidate(stamp)
+
+    print(message, flush=True)
+    threads = threads if threads else proc_opts['threads']
+    if cmd[0] == 'ffmpeg' and threads:
+        # -threads is an output option, must come before the output file
+        threads = str(threads)
+        cmd = cmd[:-1] + ['-threads', threads, '-filter_complex_threads', threads] + cmd[-1:]
+    if atomic:
+        # Write the output (last argument) under a temporary name in the
+        # same directory, and rename it when complete: whoever watches the
+        # output never sees a partial file
+        final = Path(cmd[-1])
+        partial = final.parent / f'.partial-{final.name}'
+        cmd = cmd[:-1] + [str(partial)]
+    log = proc_opts['log']
+    # Timed as a stage, with ffmpeg progress printed as it goes
+    result = stagetimer.run(message, cmd, verbose, log, capture_output)
+    if atomic:
+        os.replace(partial, final)
+    if capture_output and log:
+        log.write(result.stderr)
+    if key:
+        buildcache.record(key, stamp, result.stderr if capture_output else None)
+    return result if capture_output else None
+
+def ts_seconds(ts):
+    # HH:MM:SS[.fff] => seconds
+    h, m, sec = ts.split(':')
+    return int(h)*3600 + int(m)*60 + float(sec)
+
+def parse_cut(ts):
+    # HH:MM:SS, or HH:MM:SS.fff for cuts placed to a fraction of a second
+    return datetime.strptime(ts, '%H:%M:%S.%f' if '.' in ts else '%H:%M:%S')
+
+def boxes_overlap(cfg):
+    (sw, sh), (sx, sy) = cfg['proc']['slides']['scale'], cfg['proc']['slides']['position']
+    (vw, vh), (vx, vy) = cfg['proc']['video']['scale'], cfg['proc']['video']['position']
+    return sx < vx + vw and vx < sx + sw and sy < vy + vh and vy < sy + sh
+
+def composite_filters(cfg, info_in, slides_in, video_in, out, slides_select=None):
+    # Filter chain that stuffs the slides (cropped from the livestream) and
+    # the procam video into the OBS template with speaker info
+    #
+    # slides_select drops the slides frames that repeat the previous one
+    # (slidestatic.py). The output follows the frames of overlay's main
+    # input, so the camera is then overlaid first, and the slides on top
+    # - only when the two boxes don't overlap, as that would put the
+    # camera under the slides.
+    slides_cw, slides_ch = cfg['proc']['slides']['crop']['wh']
+    slides_cx, slides_cy = cfg['proc']['slides']['crop']['xy']
+    slides_sx, slides_sy = cfg['proc']['slides']['scale']
+    slides_px, slides_py = cfg['proc']['slides']['position']
+    video_cw, video_ch = cfg['proc']['video']['crop']['wh']
+    video_cx, video_cy = cfg['proc']['video']['crop']['xy']
+    video_sx, video_sy = cfg['proc']['video']['scale']
+    video_px, video_py = cfg['proc']['video']['position']
+    slides=f'{slides_in}crop={slides_cw}:{slides_ch}:{slides_cx}:{slides_cy},scale={slides_sx}:{slides_sy}[v1];'
+    video=f'{video_in}crop={video_cw}:{video_ch}:{video_cx}:{video_cy},scale={video_sx}:{video_sy}[v2];'
+    if slides_select and not boxes_overlap(cfg):
+        slides = f'{slides_in}{slides_select},' + slides[len(slides_in):]
+        mix_video = f'{info_in}[v2]overlay={video_px}:{video_py}[mix1];'
+        mix_slides = f'[mix1][v1]overlay={slides_px}:{slides_py}:eof_action=repeat{out}'
+        return slides + video + mix_video + mix_slides
+    mix_slides=f'{info_in}[v1]overlay={slides_px}:{slides_py}[mix1];'
+    mix_video=f'[mix1][v2]overlay={video_px}:{video_py}{out}'
+    return slides + video + mix_slides + mix_video
+
+def probe_frame_rate(vfile):
+    result = subprocess.run(['ffprobe', '-v', 'error',
+                             '-select_streams', 'v:0',
+                             '-show_entries', 'stream=r_frame_rate',
+                             '-of', 'csv=p=0', vfile],
+                            capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+def cut_clip(cfg, message, src, start, duration, out, verbose=False):
+    # The sources are intermediates, seeking on the input is exact, and
+    # doesn't decode everything before the clip
+    if proc_opts['cut'] != 'smart':
+        add_proc(message,
+                 ['ffmpeg',
+                  '-ss', smartcut.ts(start), '-t', smartcut.ts(duration),
+                  '-i', src,
+                  '-an'] +
+                 encode_args(cfg, 'intermediate') +
+                 ['-y', out
+                 ],
+                 verbose=verbose,
+                 inputs = [src], outputs = [out]
+        )
+        return
+
+    # Stream copy between keyframes, re-encode only the frames around
+    # them (all intra intermediates need no re-encode at all)
+    pieces = smartcut.plan(smartcut.frames(src, start, start + duration),
+                           start, start + duration)
+    if len(pieces) == 1:
+        mode, p_start, p_end = pieces[0]
+        add_proc(f'{message} ({mode})',
+                 smartcut.piece_cmd(src, mode, p_start, p_end,
+                                    encode_args(cfg, 'intermediate'), out),
+                 verbose=verbose,
+                 inputs = [src], outputs = [out]
+        )
+        return
+    parts = []
+    for mode, p_start, p_end in pieces:
+        part = f'{out}.part{len(parts)}.ts'
+        add_proc(f'{message} ({mode} {p_end - p_start:.3f}s)',
+                 smartcut.piece_cmd(src, mode, p_start, p_end,
+                                    encode_args(cfg, 'intermediate'), part),
+                 verbose=verbose,
+                 inputs = [src], outputs = [part]
+        )
+        parts.append(part)
+    add_proc(f'{message} (joining {len(parts)} pieces)',
+             smartcut.concat_cmd(parts, f'{out}.parts', out),
+             verbose=verbose,
+             inputs = parts, outputs = [out]
+    )
+
+def chunk_bounds(duration, frame_rate, n):
+    # Split [0, duration) in n chunks of about the same length =>
+    # [(start, length)], no length for the last one. Boundaries are half
+    # way between two frames, and rounded to microseconds: each chunk
+    # ends where the next starts, so every frame goes to exactly one.
+    fps = Fraction(frame_rate)
+    total = int(duration * fps)
+    bounds = [0.0] + [round(float((round(k * total / n) - Fraction(1, 2)) / fps), 6)
+                      for k in range(1, n)]
+    chunks = []
+    for idx, start in enumerate(bounds):
+        length = round(bounds[idx + 1] - start, 6) if idx + 1 < len(bounds) else None
+        chunks.append((start, length))
+    return chunks
+
+def encode_chunks(message, steps, output, verbose=False):
+    # Run the chunk encodes [(cmd, part, inputs, deps)] in parallel, each
+    # with its share of the CPUs, and join the parts by stream copy. The
+    # parts are MPEG-TS, which concatenates without any fixups.
+    threads = max(1, (proc_opts['threads'] or os.cpu_count() or 1) // len(steps))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        futures = [executor.submit(add_proc, f'{message} (chunk {idx + 1}/{len(steps)})', cmd,
+                                   verbose=verbose, inputs=inputs, outputs=[part],
+                                   deps=deps, threads=threads)
+                   for idx, (cmd, part, inputs, deps) in enumerate(steps)]
+        for future in futures:
+            future.result()
+    parts = [step[1] for step in steps]
+    add_proc(f'{message} (joining {len(parts)} chunks)',
+             smartcut.concat_cmd(parts, f'{output}.chunks', output),
+             verbose=verbose,
+             inputs = parts, outputs = [output]
+    )
+
+def encode_video(message, cmd, timed_inputs, probe_rate, duration, verbose=False,
+                 inputs=None, outputs=None, deps=None):
+    # An encode of the talk's timeline, as one command, or in chunks: each
+    # seeks the timed inputs (the videos, not the still images) to its
+    # start, and stops at its end. probe_rate() gives the frame rate the
+    # chunks are aligned to, only needed for chunks. cmd can be a function
+    # of the start (seconds), for filters that need the talk's time.
+    make_cmd = cmd if callable(cmd) else lambda start: cmd
+    if proc_opts['chunks'] <= 1:
+        add_proc(message, make_cmd(0.0), verbose=verbose, inputs=inputs, outputs=outputs,
+                 deps=deps)
+        return
+    steps = []
+    for idx, (start, length) in enumerate(chunk_bounds(duration, probe_rate(), proc_opts['chunks'])):
+        part = f'{outputs[0]}.chunk{idx}.ts'
+        chunk = []
+        chunk_cmd = make_cmd(start)
+        for arg, next_arg in zip(chunk_cmd, chunk_cmd[1:] + [None]):
+            if arg == '-i' and next_arg in timed_inputs and start > 0:
+                chunk += ['-ss', smartcut.ts(start)]
+            chunk.append(arg)
+        chunk = chunk[:-2] + (['-t', smartcut.ts(length)] if length else []) + ['-y', part]
+        steps.append((chunk, part, inputs, deps))
+    encode_chunks(message, steps, outputs[0], verbose)
+
+def concat_listing(entries):
+    # concat demuxer list for [(file, inpoint, outpoint)], None for the
+    # whole file
+    lines = []
+    for fname, inpoint, outpoint in entries:
+        lines.append(f"file '{Path(fname).name}'")
+        if inpoint:
+            lines.append(f'inpoint {inpoint:.6f}')
+        if outpoint is not None:
+            lines.append(f'outpoint {outpoint:.6f}')
+    return lines
+
+def split_entries(entries, overlap, frame_rate, n):
+    # Split a concat list in n chunks of about the same length. Clip bodies
+    # are split on a frame (they are all intra). The demuxer seeks an
+    # inpoint to the frame at or before it, and stops before an outpoint,
+    # so the frame's time is rounded down for the outpoint, and up for the
+    # inpoint. Crossfades are not split - a chunk that would end in one
+    # ends after it.
+    fps = Fraction(frame_rate)
+    lengths = [overlap if outpoint is None else outpoint - inpoint
+               for fname, inpoint, outpoint in entries]
+    total = sum(lengths)
+    targets = [k * total / n for k in range(1, n)]
+    chunks = [[]]
+    pos = 0.0
+    for (fname, inpoint, outpoint), length in zip(entries, lengths):
+        end = pos + length
+        if outpoint is None:
+            chunks[-1].append((fname, inpoint, outpoint))
+            if targets and targets[0] < end:
+                targets = [t for t in targets if t >= end]
+                chunks.append([])
+            pos = end
+            continue
+        while targets and targets[0] < end:
+            t = targets.pop(0)
+            frame_time = round((inpoint + t - pos) * fps) / fps
+            cut_out = math.floor(frame_time * 10**6) / 10**6
+            cut_in = math.ceil(frame_time * 10**6) / 10**6
+            if cut_out <= inpoint or cut_in >= outpoint:
+                continue
+            chunks[-1].append((fname, inpoint, cut_out))
+            chunks.append([])
+            pos += cut_in - inpoint
+            inpoint = cut_in
+        chunks[-1].append((fname, inpoint, outpoint))
+        pos = end
+    return [chunk for chunk in chunks if chunk]
+
+def stitch_clips(cfg, clips, overlap, work_prefix, output, verbose=False):
+    # Crossfade the clips into one video, with at most two decoders open
+    # at any time, however many clips there are.
+    #
+    # Consecutive clips overlap by `overlap` seconds. Each overlap is
+    # crossfaded on its own (just those frames of the two clips) into a
+    # short intermediate. The final encode then reads, one after the
+    # other, the body of each clip and the crossfade that follows it:
+    #
+    #   clip0 body | fade 0>1 | clip1 body | fade 1>2 | ... | clipN body
+    #
+    # The bodies are inpoint/outpoint ranges in a concat demuxer list -
+    # exact, since the clips are all intra.
+    durations = [ts_seconds(clip[3]) for clip in clips]
+    entries = []
+    fades = []
+    for idx, clip in enumerate(clips):
+        out_vfile = clip[-1]
+        inpoint = overlap if idx > 0 else 0
+        outpoint = durations[idx] - overlap if idx < len(clips) - 1 else durations[idx]
+        entries.append((out_vfile, inpoint, outpoint))
+        if idx == len(clips) - 1 or overlap <= 0:
+            continue
+        next_vfile = clips[idx + 1][-1]
+        fade_vfile = f'{work_prefix}-fade{idx}.mp4'
+        add_proc(f'Crossfading segments {idx} and {idx + 1}...',
+                 ['ffmpeg',
+                  '-ss', smartcut.ts(outpoint), '-t', smartcut.ts(overlap), '-i', out_vfile,
+                  '-t', smartcut.ts(overlap), '-i', next_vfile,
+                  '-filter_complex',
+                  f'[0:v]setpts=PTS-STARTPTS[a];[1:v]setpts=PTS-STARTPTS[b];'
+                  f'[a][b]xfade=transition=fade:duration={overlap}:offset=0',
+                  '-an'] +
+                 encode_args(cfg, 'intermediate') +
+                 ['-y', fade_vfile
+                 ],
+                 verbose=verbose,
+                 inputs = [out_vfile, next_vfile], outputs = [fade_vfile]
+        )
+        fades.append(fade_vfile)
+        entries.append((fade_vfile, None, None))
+
+    # With chunks, each chunk of the timeline is encoded from its own
+    # list, in parallel
+    if proc_opts['chunks'] > 1:
+        chunks = split_entries(entries, overlap, probe_frame_rate(clips[0][-1]),
+                               proc_opts['chunks'])
     else:
+        chunks = [entries]
+    steps = []
+    for idx, chunk in enumerate(chunks):
+        pieces = concat_listing(chunk)
+        # The step depends on the list through its deps. Rewrite it only
+        # when it changes, for the benefit of anything watching mtimes
+        list_file = f'{work_prefix}.txt' if len(chunks) == 1 else f'{work_prefix}-chunk{idx}.txt'
+        listing = '\n'.join(pieces) + '\n'
+        if not os.path.exists(list_file) or open(list_file, 'r').read() != listing:
+            open(list_file, 'w').write(listing)
+        part = output if len(chunks) == 1 else f'{output}.chunk{idx}.ts'
+        stitch_cmd = ['ffmpeg',
+                      '-f', 'concat', '-safe', '0', '-i', list_file,
+                      '-map', '0:v:0'] + encode_args(cfg, 'final') + (
+                     ['-movflags', '+faststart'] if len(chunks) == 1 else []) + [
+                      '-y', part
+                     ]
         if verbose:
-            subprocess.run(cmd, check=True)
+            pprint(stitch_cmd)
+            print(listing)
+        inputs = []
+        for fname, inpoint, outpoint in chunk:
+            if fname not in inputs:
+                inputs.append(fname)
+        steps.append((stitch_cmd, part, inputs, {'pieces' : pieces}))
+    if len(steps) == 1:
+        stitch_cmd, part, inputs, deps = steps[0]
+        add_proc('Merging video segments with crossfades...',
+                 stitch_cmd,
+                 verbose=verbose,
+                 inputs = [clip[-1] for clip in clips] + fades,
+                 outputs = [output],
+                 deps = deps)
+        return
+    encode_chunks('Merging video segments with crossfades...', steps, output, verbose)
+
+def single_pass_cmd(cfg, clips, seg_speaker_only, overlap,
+                    vid_slides, t_start_sv, vid_procam, t_start_procam, seg_duration,
+                    fullscreen_template, info_image, audio, audio_args, output):
+    # One filter graph from the original sources: every output frame
+    # is decoded and encoded exactly once, no intermediate videos.
+    #
+    # Inputs are seeked on the input side, so the timestamps of both
+    # sources start at 0 at the start of the talk - same as the cut
+    # segments used by the multi-pass pipeline.
+    #
+    # Inputs:
+    #  0 - livestream (slides), 1 - procam, 2 - fullscreen template
+    #  3 - info image, 4 - filtered audio (normalized with audio_args)
+    frame_rate = probe_frame_rate(vid_procam)
+    n_fs = len([c for c in clips if c[1] == seg_speaker_only])
+    n_mix = len(clips) - n_fs
+    graph = ''
+    if n_mix > 0:
+        graph += '[1:v]split=2[pcfs][pcmix];'
+    else:
+        graph += '[1:v]null[pcfs];'
+    graph += f'[pcfs][2:v]overlay=0:0,split={n_fs}'
+    graph += ''.join([f'[fs{i}]' for i in range(n_fs)]) + ';'
+    if n_mix > 0:
+        graph += composite_filters(cfg, '[3:v]', '[0:v]', '[pcmix]', '[mix];')
+        graph += f'[mix]split={n_mix}'
+        graph += ''.join([f'[mix{i}]' for i in range(n_mix)]) + ';'
+
+    fs_idx = 0
+    mix_idx = 0
+    for seg_idx, src_vfile, start, duration, out_vfile in clips:
+        if src_vfile == seg_speaker_only:
+            src_vid = f'[fs{fs_idx}]'
+            fs_idx += 1
         else:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
+            src_vid = f'[mix{mix_idx}]'
+            mix_idx += 1
+        graph += f'{src_vid}trim=start={start.total_seconds()}:duration={ts_seconds(duration)},'
+        # template images have no frame rate and a different timebase
+        # than the camera, which xfade does not accept
+        graph += f'setpts=PTS-STARTPTS,settb=AVTB,fps={frame_rate}[clip{seg_idx}];'
+
+    # Same crossfades as the stitch of the multi-pass pipeline
+    src_vid = '[clip0]'
+    for seg_idx, src_vfile, start, duration, out_vfile in clips[1:]:
+        next_src_vid = f'vfade{seg_idx}'
+        graph += f'{src_vid}[clip{seg_idx}]xfade=transition=fade:duration={overlap}:offset={start.total_seconds()}[{next_src_vid}];'
+        src_vid = f'[{next_src_vid}]'
+
+    return ['ffmpeg',
+            '-ss', t_start_sv, '-t', seg_duration, '-i', vid_slides,
+            '-ss', t_start_procam, '-t', seg_duration, '-i', vid_procam,
+            '-i', fullscreen_template,
+            '-i', info_image,
+            '-i', audio,
+            '-filter_complex', graph[:-1],
+            '-map', src_vid,
+            '-map', '4:a:0'] + encode_args(cfg, 'final') + audio_args + [
+            '-movflags', '+faststart',
+            '-y', output
+           ]
+
+def static_slides(message, vfile, crop, duration, prefix, verbose=False):
+    # => (static runs, frame rate) of the slides, or None when they are
+    # not static long enough to be worth it. The scan is cached like the
+    # other steps, and its summary kept in <prefix>.json
+    crc_file = f'{prefix}.crc'
+    add_proc(message, slidestatic.scan_cmd(vfile, crop, crc_file),
+             verbose=verbose,
+             inputs = [vfile], outputs = [crc_file])
+    kept = slidestatic.kept_frames(crc_file)
+    runs = slidestatic.static_runs(kept, duration)
+    info = slidestatic.summary(runs, kept, duration)
+    open(f'{prefix}.json', 'w').write(json.dumps(info, indent=2) + '\n')
+    print(f'  Slides static {100 * info["static"]:.0f}% of the talk, {info["changes"]} changes')
+    if info['static'] < slidestatic.MIN_STATIC:
+        print('  Not static enough, compositing every frame')
+        return None
+    return runs, probe_frame_rate(vfile)
+
+def measure_loudness(message, wav, stamp):
+    # Native EBU R128 measurement, cached like the ffmpeg steps
+    key = None
+    if proc_opts['cache']:
+        key = buildcache.step_key(['loudness', wav], [wav], None,
+                                  proc_opts['cache'] == 'content')
+        saved = None if proc_opts['force'] else buildcache.lookup(key, stamp, [])
+        if saved:
+            print(f'{message} up to date', flush=True)
+            stagetimer.cached(message)
+            return json.loads(saved['output'])
+    print(message, flush=True)
+    with stagetimer.stage(message):
+        param = loudness.measure_wav(wav)
+    if key:
+        buildcache.record(key, stamp, json.dumps(param))
+    return param
+
+def fused_audio(message, src, start, duration, noise_profile, nr_factor,
+                extra_audio_filters, output):
+    # Streaming denoise + pan + filters + measurement, cached like the
+    # ffmpeg steps. The stamp keeps the loudness measurement.
+    key = None
+    if proc_opts['cache']:
+        key = buildcache.step_key(['audiochain', start, duration, extra_audio_filters],
+                                  [src, noise_profile], {'noise-reduction' : nr_factor},
+                                  proc_opts['cache'] == 'content')
+        saved = None if proc_opts['force'] else buildcache.lookup(key, output, [output])
+        if saved:
+            print(f'{message} up to date', flush=True)
+            stagetimer.cached(message)
+            return json.loads(saved['output'])
+        buildcache.invalidate(output)
+    print(message, flush=True)
+    with stagetimer.stage(message, 'audiochain', ts_seconds(duration)):
+        param = audiochain.run_chain(src, start, duration, noise_profile, nr_factor,
+                                     extra_audio_filters, output, log=proc_opts['log'])
+    if key:
+        buildcache.record(key, output, json.dumps(param))
+    return param
+
+def talk_offset(cfg, this_talk):
+    # procam_time = sv_time + offset + drift * sv_time (see align.py).
+    # The offset is taken at the middle of the talk, so the drift within
+    # the talk is split between its start and end.
+    offset = cfg['proc']['vcam-offset']
+    drift = cfg['proc'].get('vcam-drift', 0)
+    cuts = this_talk['cuts']
+    t_mid = (ts_seconds(cuts[0]) + ts_seconds(cuts[-1])) / 2
+    return round(offset + drift * t_mid, 6)
+
+def talk_segment(cfg, this_talk):
+    # Start of the talk in the livestream and in the camera recording,
+    # and its length
+    offset = talk_offset(cfg, this_talk)
+    procam_offset = timedelta(seconds=abs(offset))
+    video_cuts = this_talk['cuts']
+    start_sv = parse_cut(video_cuts[0])
+    end_sv = parse_cut(video_cuts[-1])
+
+    seg_duration = datetime.min + (end_sv-start_sv)
+    seg_duration = seg_duration.strftime('%H:%M:%S.%f')[:-3]
+    if offset < 0:
+        start_procam = start_sv - procam_offset
+    else:
+        start_procam = start_sv + procam_offset
+
+    t_start_sv = start_sv.strftime('%H:%M:%S.%f')[:-3]
+    t_start_procam = start_procam.strftime('%H:%M:%S.%f')[:-3]
+    return t_start_sv, t_start_procam, seg_duration
+
+def source_cut_steps(cfg, this_talk):
+    # ffmpeg output options to cut out the talk from the two source
+    # videos. No audio needed from livestream.
+    devroom = cfg['devroom']
+    vid_slides = f'{devroom}/{cfg["livestream"]}'
+    vid_procam = f'{devroom}/{cfg["vcam"]}'
+    tpath = Path(f'mix/{devroom}/{this_talk["index"]}')
+    t_start_sv, t_start_procam, seg_duration = talk_segment(cfg, this_talk)
+    return [
+        ('Cutting livestream...', vid_slides,
+         ['-ss', t_start_sv, '-t', seg_duration, '-an', '-c:v', 'copy'],
+         f'{tpath}/seg_vid_slides.mp4'),
+        ('Cutting camera video...', vid_procam,
+         ['-ss', t_start_procam, '-t', seg_duration, '-c', 'copy'],
+         f'{tpath}/seg_procam.mp4')
+    ]
+
+def cut_devroom_sources(cfg, talks, verbose=False):
+    # Cutting talk by talk makes ffmpeg demux the multi hour source from
+    # the start for every talk. Instead, cut all the talks of the devroom
+    # with one ffmpeg per source - one output per talk, so the source is
+    # read once, sequentially.
+    #
+    # The per talk output options are the same as a per talk cut, so
+    # the per talk cache records are kept, and only stale talks are cut.
+    content_hash = proc_opts['cache'] == 'content'
+    per_source = {}
+    for talk in talks:
+        Path(f'mix/{cfg["devroom"]}/{talk["index"]}').mkdir(parents=True, exist_ok=True)
+        deps = {'vcam-offset' : talk_offset(cfg, talk)}
+        for message, src, opts, out in source_cut_steps(cfg, talk):
+            cmd = ['ffmpeg', '-i', src] + opts + ['-y', out]
+            key = None
+            if proc_opts['cache']:
+                key = buildcache.step_key(cmd, [src], deps, content_hash)
+                if not proc_opts['force'] and buildcache.lookup(key, out, [out]):
+                    proc_opts['sources'].add(out)
+                    continue
+            per_source.setdefault(src, []).append((opts, out, key))
+
+    if not per_source:
+        return
+    stagetimer.start_report()
+    for src, cuts in per_source.items():
+        cmd = ['ffmpeg', '-i', src]
+        for opts, out, key in cuts:
+            cmd += opts + ['-y', out]
+        for opts, out, key in cuts:
+            buildcache.invalidate(out)
+        add_proc(f'Cutting {len(cuts)} talks from {src}...', cmd, verbose=verbose)
+        for opts, out, key in cuts:
+            if key:
+                buildcache.record(key, out)
+            # not to be cut again by the talk, even with --force
+            proc_opts['sources'].add(out)
+    report = stagetimer.write_report(f'mix/{cfg["devroom"]}/{cfg["devroom"]}-sources-timing.json',
+                                     devroom=cfg['devroom'], talks=[t['index'] for t in talks])
+    print_timing(report)
 
 def master_video(cfg, this_talk, pipeline, verbose=False):
     devroom = cfg['devroom']
-    noise_profile_file = cfg["noise-profile"]
-    noise_profile = f'{devroom}/{noise_profile_file}'
+    noise_profile = noise_profile_path(cfg)
     # global audio filter
     extra_audio_filters = ','+cfg['audio_filter'] if 'audio_filter' in cfg else ''
 
@@ -68,8 +675,7 @@ def master_video(cfg, this_talk, pipeline, verbose=False):
     vid_slides = f'{devroom}/{livestream}'
     vid_procam = f'{devroom}/{procam}'
     nr_factor = cfg['proc']['noise-reduction']
-    offset = cfg['proc']['vcam-offset']
-    procam_offset = timedelta(seconds=abs(offset))
+    offset = talk_offset(cfg, this_talk)
 
     # override audio filters - may need to do per speaker at some time point in time
     extra_audio_filters = ','+this_talk['audio_filter'] if 'audio_filter' in this_talk else extra_audio_filters
@@ -81,6 +687,7 @@ def master_video(cfg, this_talk, pipeline, verbose=False):
     tpath = Path(f'mix/{devroom}/{talk_idx}')
     fpath = Path(f'mix/{devroom}')
     tpath.mkdir( parents=True, exist_ok=True)
+    stagetimer.start_report()
     # MP4 av suffix means the file has both a/v
     # otherwise only video
     seg_vid_slides = f'{tpath}/seg_vid_slides.mp4'
@@ -91,24 +698,13 @@ def master_video(cfg, this_talk, pipeline, verbose=False):
     seg_vid_slides_realign = f'{tpath}/seg_vid_slides_realign.mp4'
     seg_interleaved = f'{tpath}/seg_interleaved.mp4'
     seg_filtered_a = f'{tpath}/filtered_a.wav'
-    seg_corrected_a = f'{tpath}/corrected_a.wav'
     seg_talk_av = f'{fpath}/{devroom}-{talk_idx}.mp4'
 
     video_cuts = this_talk['cuts']
-    start_sv = datetime.strptime(video_cuts[0], '%H:%M:%S')
-    end_sv = datetime.strptime(video_cuts[-1], '%H:%M:%S')
-
-    seg_duration = datetime.min + (end_sv-start_sv)
-    seg_duration = seg_duration.strftime('%H:%M:%S.%f')[:-3]
-    if offset < 0:
-        start_procam = start_sv - procam_offset
-    else:
-        start_procam = start_sv + procam_offset
-
-    t_start_sv = start_sv.strftime('%H:%M:%S.%f')[:-3]
-    t_start_procam = start_procam.strftime('%H:%M:%S.%f')[:-3]
+    start_sv = parse_cut(video_cuts[0])
+    t_start_sv, t_start_procam, seg_duration = talk_segment(cfg, this_talk)
     print('Talk ', talk_idx)
-    print(f'  Video Offset : {cfg["proc"]["vcam-offset"]}')
+    print(f'  Video Offset : {offset}')
     print(f'  Start : sv @ {t_start_sv} procam @ {t_start_procam}')
     print(f'  Length: {seg_duration}')
     print(f'  Noise Reduction : {nr_factor}')
@@ -120,8 +716,8 @@ def master_video(cfg, this_talk, pipeline, verbose=False):
     seg_idx = 0
     clips = []
     for start_pos, end_pos in zip(video_cuts, video_cuts[1:]):
-        st = datetime.strptime(start_pos, '%H:%M:%S')
-        et = datetime.strptime(end_pos, '%H:%M:%S')
+        st = parse_cut(start_pos)
+        et = parse_cut(end_pos)
         # move start time by the video overlap on the
         # second clip and beyond
         if not is_first_seg:
@@ -139,37 +735,124 @@ def master_video(cfg, this_talk, pipeline, verbose=False):
         is_fs_video = not is_fs_video # alternate clips
         seg_idx += 1
 
+    # The steps of the talk, as a dependency graph (stepgraph.py): the
+    # source cuts run together, and the audio branch alongside the video
+    # encodes. They join at the final mux. An encode keeps all but one of
+    # the CPUs busy, the other steps about one. The budget is at least 2,
+    # so that audio always runs alongside video.
+    budget = max(proc_opts['threads'] if proc_opts['threads'] else (os.cpu_count() or 1), 2)
+    encode_cost = max(budget - 1, 1)
+    graph = stepgraph.StepGraph(budget)
+
     if pipeline == Pipeline.full:
         # Cut out a segment (of interest) of the two source videos
-        # no audio needed from livestream
-        add_proc('Cutting livestream...',
-                 ['ffmpeg',
-                  '-i', vid_slides,
-                  '-ss', t_start_sv, '-t', seg_duration,
-                  '-an', '-c:v', 'copy',
-                  '-y', seg_vid_slides
-                 ],
-                 verbose = verbose
-        )
-        add_proc('Cutting camera video...',
-                 ['ffmpeg',
-                  '-i', vid_procam,
-                  '-ss', t_start_procam, '-t', seg_duration,
-                  '-c', 'copy', 
-                  '-y', seg_procam_av
-                 ],
-                 verbose = verbose
-        )
+        # (already done if the devroom sources were cut in one go)
+        for (message, src, opts, out), name in zip(source_cut_steps(cfg, this_talk),
+                                                   ['cut-livestream', 'cut-procam']):
+            if out in proc_opts['sources']:
+                continue
+            graph.add(name, lambda message=message, src=src, opts=opts, out=out:
+                      add_proc(message,
+                               ['ffmpeg', '-i', src] + opts + ['-y', out],
+                               verbose = verbose,
+                               inputs = [src], outputs = [out],
+                               deps = {'vcam-offset' : offset}
+                      ))
+
+    # Audio branch, before the video steps so that it starts as soon as
+    # it can. The fused audio chain reads the camera recording directly,
+    # and measures the loudness as it goes
+    audio_pipelines = [Pipeline.audio, Pipeline.full, Pipeline.single]
+    sox_audio = proc_opts['audio'] == 'sox'
+    if not sox_audio and pipeline in audio_pipelines:
+        graph.add('loudness', lambda:
+                  fused_audio('Denoising + filtering audio track (streaming)...',
+                              vid_procam, t_start_procam, seg_duration,
+                              noise_profile, nr_factor, extra_audio_filters,
+                              seg_filtered_a))
+
+    if sox_audio and pipeline == Pipeline.full:
+        # Extract only the audio
+        graph.add('extract-audio', lambda:
+                  add_proc('Extracting audio track...',
+                           ['ffmpeg',
+                            '-i', seg_procam_av,
+                            '-vn',
+                            '-acodec', 'pcm_s16le',
+                            '-y', seg_procam_a
+                           ],
+                           verbose = verbose,
+                           inputs = [seg_procam_av], outputs = [seg_procam_a]
+                  ), ['cut-procam'])
+    elif sox_audio and pipeline == Pipeline.single:
+        # No camera segment in this mode, extract audio straight
+        # from the source
+        graph.add('extract-audio', lambda:
+                  add_proc('Extracting audio track...',
+                           ['ffmpeg',
+                            '-ss', t_start_procam, '-t', seg_duration,
+                            '-i', vid_procam,
+                            '-vn',
+                            '-acodec', 'pcm_s16le',
+                            '-y', seg_procam_a
+                           ],
+                           verbose = verbose,
+                           inputs = [vid_procam], outputs = [seg_procam_a]
+                  ))
+
+    if sox_audio and pipeline in audio_pipelines:
+        # Denoise audio using existing profile
+        graph.add('denoise', lambda:
+                  add_proc('Denoising audio track...',
+                           ['sox',
+                            '--multi-threaded',
+                            seg_procam_a, seg_procam_nn_a,
+                            'noisered', noise_profile,
+                            str(nr_factor)
+                           ],
+                           verbose = verbose,
+                           inputs = [seg_procam_a, noise_profile], outputs = [seg_procam_nn_a],
+                           deps = {'noise-reduction' : nr_factor}
+                  ), ['extract-audio'])
+        # camera audio is mono - replicate in both L/R for better
+        # volume
+        graph.add('pan', lambda:
+                  add_proc('Replicating R=L in audio track...',
+                           ['ffmpeg',
+                            '-i', seg_procam_nn_a,
+                            '-af', f'pan=stereo|FL=FL|FR=FL{extra_audio_filters}',
+                            '-acodec', 'pcm_s16le',
+                            '-y', seg_filtered_a
+                           ],
+                           verbose = verbose,
+                           inputs = [seg_procam_nn_a], outputs = [seg_filtered_a]
+                  ), ['denoise'])
 
+    if sox_audio or pipeline == Pipeline.clips:
+        # Measure audio characteristics, the corrections are applied
+        # while muxing the final video
+        graph.add('loudness', lambda:
+                  measure_loudness('Measuring loudness of audio track...',
+                                   seg_filtered_a, f'{tpath}/loudness'), ['pan'])
+
+    # With --chunks, the encodes of the talk's timeline are split on the
+    # camera's frames
+    seg_frame_rate = lambda: probe_frame_rate(seg_procam_av)
+    if pipeline == Pipeline.full:
         # Cut out the segment - combined with the fullscreen template
-        add_proc('Generating fullscreen video...',
-                 ['ffmpeg', '-i', seg_procam_av, '-i', fullscreen_template, '-an',
-                  '-filter_complex',
-                  '[0:v][1:v]overlay=0:0',
-                  '-y', seg_speaker_only
-                 ],
-                 verbose = verbose
-        )
+        graph.add('fullscreen', lambda:
+                  encode_video('Generating fullscreen video...',
+                               ['ffmpeg', '-i', seg_procam_av, '-i', fullscreen_template, '-an',
+                                '-filter_complex',
+                                '[0:v][1:v]overlay=0:0'] +
+                               encode_args(cfg, 'intermediate') +
+                               ['-y', seg_speaker_only
+                               ],
+                               [seg_procam_av], seg_frame_rate, ts_seconds(seg_duration),
+                               verbose = verbose,
+                               inputs = [seg_procam_av, fullscreen_template],
+                               outputs = [seg_speaker_only]
+                  ), ['cut-procam'], encode_cost)
 
     # Create a video that stuffs
     #  - procam video
@@ -177,185 +860,473 @@ def master_video(cfg, this_talk, pipeline, verbose=False):
     #  - OBS template with speaker info
     # into one video
     #
-    slides_cw, slides_ch = cfg['proc']['slides']['crop']['wh']
-    slides_cx, slides_cy = cfg['proc']['slides']['crop']['xy']
-    slides_sx, slides_sy = cfg['proc']['slides']['scale']
-    slides_px, slides_py = cfg['proc']['slides']['position']
-    video_cw, video_ch = cfg['proc']['video']['crop']['wh']
-    video_cx, video_cy = cfg['proc']['video']['crop']['xy']
-    video_sx, video_sy = cfg['proc']['video']['scale']
-    video_px, video_py = cfg['proc']['video']['position']
-    slides=f'[1:v]crop={slides_cw}:{slides_ch}:{slides_cx}:{slides_cy},scale={slides_sx}:{slides_sy}[v1];'
-    video=f'[2:v]crop={video_cw}:{video_ch}:{video_cx}:{video_cy},scale={video_sx}:{video_sy}[v2];'
-    mix_slides=f'[0:v][v1]overlay={slides_px}:{slides_py}[mix1];'
-    mix_video=f'[mix1][v2]overlay={video_px}:{video_py}[outv]'
-    if pipeline == Pipeline.full:
-        add_proc('Regenerating slides+camera video...',
-                 ['ffmpeg', '-i', info_image, '-i', seg_vid_slides, '-i', seg_procam_av,
-                  '-filter_complex',
-                  slides +
-                  video +
-                  mix_slides +
-                  mix_video,
-                  '-map', '[outv]',
-                  '-y', seg_vid_slides_realign
-                 ],
-                 verbose = verbose
-        )
+    # With --dedup-slides, the slides frames that repeat the previous one
+    # are dropped before compositing (slidestatic.py)
+    mix_deps = {
+        'slides' : cfg['proc']['slides'],
+        'video' : cfg['proc']['video']
+    }
+    if pipeline == Pipeline.full and proc_opts['slides'] == 'dedup':
+        slides_crop = cfg['proc']['slides']['crop']
+        graph.add('static-slides', lambda:
+                  static_slides('Finding static slides...', seg_vid_slides,
+                                slides_crop['wh'] + slides_crop['xy'], ts_seconds(seg_duration),
+                                f'{tpath}/static-slides', verbose),
+                  ['cut-livestream'])
+
+    def composite_cmd(start):
+        static = graph.results.get('static-slides')
+        select = slidestatic.select_filter(static[0], static[1], start) if static else None
+        return ['ffmpeg', '-i', info_image, '-i', seg_vid_slides, '-i', seg_procam_av,
+                '-filter_complex',
+                composite_filters(cfg, '[0:v]', '[1:v]', '[2:v]', '[outv]', select),
+                '-map', '[outv]'] + encode_args(cfg, 'intermediate') + [
+                '-y', seg_vid_slides_realign
+               ]
 
     if pipeline == Pipeline.full:
-        # Extract only the audio
-        add_proc('Extracting audio track...',
-                 ['ffmpeg',
-                  '-i', seg_procam_av,
-                  '-vn',
-                  '-acodec', 'pcm_s16le',
-                  '-y', seg_procam_a
-                 ],
-                 verbose = verbose
-        )
+        graph.add('composite', lambda:
+                  encode_video('Regenerating slides+camera video...',
+                               composite_cmd,
+                               [seg_vid_slides, seg_procam_av], seg_frame_rate,
+                               ts_seconds(seg_duration),
+                               verbose = verbose,
+                               inputs = [info_image, seg_vid_slides, seg_procam_av],
+                               outputs = [seg_vid_slides_realign],
+                               deps = mix_deps
+                  ), ['cut-livestream', 'cut-procam', 'static-slides'], encode_cost)
 
-    result = None
-    if pipeline in [Pipeline.audio, Pipeline.full]:
-        # Denoise audio using existing profile
-        add_proc('Denoising audio track...',
-                 ['sox',
-                  '--multi-threaded',
-                  seg_procam_a, seg_procam_nn_a,
-                  'noisered', noise_profile,
-                  str(nr_factor)
-                 ],
-                 verbose = verbose
-        )
-        # camera audio is mono - replicate in both L/R for better
-        # volume
-        add_proc('Replicating R=L in audio track...',
-                 ['ffmpeg',
-                  '-i', seg_procam_nn_a,
-                  '-af', f'pan=stereo|FL=FL|FR=FL{extra_audio_filters}',
-                  '-acodec', 'pcm_s16le',
-                  '-y', seg_filtered_a
-                 ],
-                 verbose = verbose
-        )
-        # Measure audio characteristics using loudnorm
-        result = add_proc('Measuring loudness of audio track...',
-                          ['ffmpeg',
-                           '-i', seg_filtered_a,
-                           '-filter:a', 'loudnorm=print_format=json',
-                           '-f', 'null', '/dev/null'
-                          ],
-                          capture_output = True,
-                          verbose = verbose
-                         )
-
-    if result:
-        output = result.stderr
-        # Extract measured values and prepare corrections
-        param = json.loads(re.sub('^.*({.*}).*$','\\1', output, flags=re.DOTALL))
-        loudnorm = 'linear=true:I=-16:LRA=11:tp=-1.5:'
-        loudnorm += f'measured_I={param["input_i"]}:'
-        loudnorm += f'measured_LRA={param["input_lra"]}:'
-        loudnorm += f'measured_tp={param["input_tp"]}:'
-        loudnorm += f'measured_thresh={param["input_thresh"]}:'
-        loudnorm += f'offset={param["target_offset"]}:'
-        loudnorm += 'print_format=summary'
-
-        # Normalize audio volume
-        # we use level -16 which is technically for podcasts, but not video
-        # video recommended level is -23, but that turns out to be low
-        # for desktops and phones - but pretty good for TVs
-        # (you can see this in the VU meter in audacity)
-        add_proc('Normalizing audio volume...',
+    if pipeline in [Pipeline.clips, Pipeline.full]:
+        # Generate all the cuts of the video files - independent of
+        # each other
+        clip_cost = encode_cost if proc_opts['cut'] != 'smart' else 1
+        for seg_idx, src_vfile, start, duration, out_vfile in clips:
+            graph.add(f'clip{seg_idx}', lambda seg_idx=seg_idx, src_vfile=src_vfile,
+                                               start=start, duration=duration, out_vfile=out_vfile:
+                      cut_clip(cfg, f'Generating segment {seg_idx} start={str(start)} duration={duration}',
+                               src_vfile, start.total_seconds(), ts_seconds(duration),
+                               out_vfile, verbose),
+                      ['fullscreen' if src_vfile == seg_speaker_only else 'composite'],
+                      clip_cost)
+
+        # Merge the cuts into one video with crossfades!
+        graph.add('stitch', lambda:
+                  stitch_clips(cfg, clips, overlap, f'{tpath}/stitch', seg_interleaved, verbose),
+                  [f'clip{clip[0]}' for clip in clips], encode_cost)
+
+    # Normalize audio volume
+    # we use level -16 which is technically for podcasts, but not video
+    # video recommended level is -23, but that turns out to be low
+    # for desktops and phones - but pretty good for TVs
+    # (you can see this in the VU meter in audacity)
+    def audio_args():
+        param = graph.results['loudness']
+        return ['-af', f'loudnorm={loudness.loudnorm_args(param)}',
+                '-ar', '48000'] # loudnorm upsamples to 96kHz+
+
+    def final_single():
+        single_cmd = single_pass_cmd(cfg, clips, seg_speaker_only, overlap,
+                                     vid_slides, t_start_sv,
+                                     vid_procam, t_start_procam, seg_duration,
+                                     fullscreen_template, info_image,
+                                     seg_filtered_a, audio_args(), seg_talk_av)
+        if verbose:
+            pprint(single_cmd)
+        add_proc('Rendering FINAL VIDEO in a single pass...',
+                 single_cmd,
+                 verbose=verbose,
+                 inputs = [vid_slides, vid_procam, fullscreen_template,
+                           info_image, seg_filtered_a],
+                 outputs = [seg_talk_av],
+                 deps = dict(mix_deps, **{'vcam-offset' : offset}),
+                 atomic = True)
+
+    def final_mux():
+        # Add corrected audio to interleaved slide video
+        add_proc('Merging corrected audio into video to generate FINAL VIDEO...',
                  ['ffmpeg',
+                  '-i', seg_interleaved,
                   '-i', seg_filtered_a,
-                  '-af',
-                  f'loudnorm={loudnorm}',
-                  '-ar', '48000', # loudnorm upsamples to 96kHz+
-                  '-y', seg_corrected_a
+                  '-c:v', 'copy',
+                  '-map', '0:v:0',
+                  '-map', '1:a:0'] +
+                 audio_args() +
+                 ['-y', seg_talk_av
                  ],
-                 verbose=verbose
+                 verbose=verbose,
+                 inputs = [seg_interleaved, seg_filtered_a], outputs = [seg_talk_av],
+                 atomic = True
         )
 
-    if pipeline in [Pipeline.clips, Pipeline.full]:
-        # Generate all the cuts of the video files
-        for seg_idx, src_vfile, start, duration, out_vfile in clips:
-            add_proc(f'Generating segment {seg_idx} start={str(start)} duration={duration}',
-                     ['ffmpeg',
-                      '-i', src_vfile,
-                      '-ss', str(start), '-t', duration,
-                      '-an',
-                      '-y', out_vfile
-                     ],
-                     verbose=verbose
-            )
+    # The final step reads the loudness measurement, done by then
+    if pipeline == Pipeline.single:
+        graph.add('final', final_single, ['loudness'], encode_cost)
+    else:
+        graph.add('final', final_mux, ['stitch', 'loudness'])
+    graph.run()
 
-    if pipeline in [Pipeline.clips, Pipeline.full]:
-        # Merge the cuts into one video with crossfades!
-        src_vid = "[0:v]"
-        filter_complex = ""
-        stitch_cmd = ['ffmpeg']
-        stitch_cmd.append('-i')
-        stitch_cmd.append(clips[0][-1])
-        for seg_idx, src_vfile, start, duration, out_vfile in clips[1:]:
-            next_src_vid = f"vfade{seg_idx}"
-            filter_complex += f"{src_vid}[{seg_idx}:v]xfade=transition=fade:duration={overlap}:offset={start.seconds}[{next_src_vid}];"
-            stitch_cmd.append('-i')
-            stitch_cmd.append(out_vfile)
-            src_vid = f'[{next_src_vid}]'
-        stitch_cmd.append('-filter_complex')
-        stitch_cmd.append(filter_complex)
-        stitch_cmd.append('-map')
-        stitch_cmd.append(f'{src_vid}')
-        stitch_cmd.append('-movflags')
-        stitch_cmd.append('+faststart')
-        stitch_cmd.append('-y')
-        stitch_cmd.append(seg_interleaved)
-        if verbose:
-            pprint(stitch_cmd)
-        add_proc('Merging video segments with crossfades...',
-                 stitch_cmd,
-                 verbose=verbose)
-
-    # Add corrected audio to interleaved slide video
-    add_proc('Merging corrected audio into video to generate FINAL VIDEO...',
-             ['ffmpeg',
-              '-i', seg_interleaved,
-              '-i', seg_corrected_a,
-              '-c:v', 'copy',
-              '-map', '0:v:0',
-              '-map', '1:a:0',
-              '-y', seg_talk_av
-             ],
-             verbose=verbose
-    )
     print('DONE!')
     print(f'Output generated : {seg_talk_av}')
+    report = stagetimer.write_report(f'{fpath}/{devroom}-{talk_idx}-timing.json',
+                                     devroom=devroom, talk=talk_idx, pipeline=str(pipeline),
+                                     duration=ts_seconds(seg_duration))
+    print_timing(report)
+
+def print_timing(report):
+    print(f'Timing (wall {report["wall"]:.1f}s, slowest: {report["slowest"]})')
+    for name, total in sorted(report['totals'].items(), key=lambda t: -t[1]['wall']):
+        print(f'  {total["wall"]:9.1f}s wall {total["cpu"]:9.1f}s cpu  {name} ({total["stages"]})')
+
+def noise_profile_path(cfg):
+    # A devroom without "noise-profile" gets <camera recording>-noise-profile
+    if 'noise-profile' not in cfg:
+        cfg['noise-profile'] = f'{Path(cfg["vcam"]).stem}-noise-profile'
+    return f'{cfg["devroom"]}/{cfg["noise-profile"]}'
 
-parser = argparse.ArgumentParser()
-parser.add_argument("devroom_json", help="""
-    Devroom configuration file (json).
-""")
-parser.add_argument('--verbose', '-v', action='store_true', default=False, help="""
-    Enable verbose messages, showing ffmpeg execution, progress, warnings, etc.
-""")
-parser.add_argument('--index', '-i', type=int, help="""
-    Generate video only for talk having this index in the json file. If not
-    specified, all talk videos are processed.
-""")
-parser.add_argument('--pipeline', '-p', type=Pipeline, choices=list(Pipeline),
-    help="""Run a part of the processing pipeline.""")
-args = parser.parse_args()
-
-if args.pipeline is None:
-    args.pipeline = Pipeline(Pipeline.full)
-
-cfg = json.loads(open(args.devroom_json,'r').read())
-
-if args.index:
+def noise_profile_devroom(cfg, force=False):
+    # The noise profile of the devroom. When there is none, it is built
+    # from the quietest stretch of the camera recording (noiseprofile.py).
+    # Profiles made by hand are kept, unless force.
+    devroom = cfg['devroom']
+    profile = noise_profile_path(cfg)
+    if os.path.exists(profile) and not force:
+        return profile
+    vid_procam = f'{devroom}/{cfg["vcam"]}'
+    print(f'Building noise profile {profile} from {vid_procam}...', flush=True)
+    info = noiseprofile.build(vid_procam, profile)
+    print(f'  from {noiseprofile.timestamp(info["start"])} + {info["duration"]}s :'
+          f' {info["level_db"]:.1f}dB, flatness {info["flatness"]:.2f}'
+          f'{"" if info["stationary"] else " (no stationary stretch found, listen to it)"}')
+    return profile
+
+def align_devroom(devroom_json, verbose=False):
+    # Find vcam-offset and vcam-drift from the audio of the two
+    # recordings, and store them in the config. The file is edited in
+    # place (not re-dumped) to keep its layout.
+    text = open(devroom_json, 'r').read()
+    cfg = json.loads(text)
+    devroom = cfg['devroom']
+    vid_slides = f'{devroom}/{cfg["livestream"]}'
+    vid_procam = f'{devroom}/{cfg["vcam"]}'
+    print(f'Aligning {vid_procam} to {vid_slides}...', flush=True)
+    result = align.find_offset(vid_slides, vid_procam, verbose)
+    n_windows = len(result['windows'])
+    n_inliers = len([w for w in result['windows'] if w[-1]])
+    print(f'  vcam-offset : {cfg["proc"]["vcam-offset"]} => {result["offset"]}'
+          f' (correlation {result["score"]}, overlap {result["overlap"]:.0f}s)')
+    print(f'  vcam-drift  : {cfg["proc"].get("vcam-drift", 0)} => {result["drift"]}'
+          f' ({result["drift"] * 1e6:.2f}ppm, {n_inliers}/{n_windows} windows agree)')
+    cfg['proc']['vcam-offset'] = result['offset']
+    cfg['proc']['vcam-drift'] = result['drift']
     for talk in cfg['talks']:
-        if args.index == talk['index']:
-            master_video(cfg, talk, args.pipeline, args.verbose)
-else:
+        print(f'    talk {talk["index"]} : offset {talk_offset(cfg, talk)}')
+
+    text, n = re.subn(r'("vcam-offset"\s*:\s*)-?[0-9.eE+-]+',
+                      lambda m: f'{m.group(1)}{result["offset"]}', text, count=1)
+    if n != 1:
+        raise ValueError(f'{devroom_json}: no vcam-offset to update')
+    text, n = re.subn(r'("vcam-drift"\s*:\s*)-?[0-9.eE+-]+',
+                      lambda m: f'{m.group(1)}{result["drift"]}', text, count=1)
+    if n == 0:
+        # add it after vcam-offset, lined up the same way (and with a
+        # comma in between if vcam-offset was the last key)
+        def add_drift(m):
+            indent, pad, value, comma = m.groups()
+            pad = ' ' * max(1, len(pad) + len('offset') - len('drift'))
+            return (f'{indent}"vcam-offset"{m.group(2)}:{value},\n'
+                    f'{indent}"vcam-drift"{pad}: {result["drift"]}{comma}')
+        text, n = re.subn(r'^([ \t]*)"vcam-offset"([ \t]*):([^,\n]*)(,?)[ \t]*$', add_drift,
+                          text, count=1, flags=re.MULTILINE)
+        if n != 1:
+            raise ValueError(f'{devroom_json}: no vcam-drift, and vcam-offset is not '
+                             'on a line of its own to add it after')
+    open(devroom_json, 'w').write(text)
+    return result
+
+def scan_devroom(devroom_json, jobs=None):
+    # Look for black, frozen and dropped frames in the two recordings,
+    # and report them per talk, in livestream time (same as the cuts)
+    cfg = json.loads(open(devroom_json, 'r').read())
+    devroom = cfg['devroom']
+    vid_slides = f'{devroom}/{cfg["livestream"]}'
+    vid_procam = f'{devroom}/{cfg["vcam"]}'
+    results = {}
+    for name, vfile in [('livestream', vid_slides), ('vcam', vid_procam)]:
+        print(f'Scanning {vfile}...', flush=True)
+        results[name] = framescan.scan(vfile, jobs)
+        print(f'  {len(results[name]["spans"])} suspicious spans in '
+              f'{framescan.hms(results[name]["duration"])}')
+
+    n_problems = 0
     for talk in cfg['talks']:
-        master_video(cfg, talk, args.pipeline, args.verbose)
+        t_start = ts_seconds(talk['cuts'][0])
+        t_end = ts_seconds(talk['cuts'][-1])
+        offset = talk_offset(cfg, talk)
+        found = []
+        for name, result in results.items():
+            shift = offset if name == 'vcam' else 0
+            for kind, start, end in result['spans']:
+                start, end = start - shift, end - shift
+                if end > t_start and start < t_end:
+                    found.append((start, end, name, kind))
+        print(f'Talk {talk["index"]} ({talk["cuts"][0]} - {talk["cuts"][-1]}) : '
+              f'{len(found) if found else "OK"}')
+        for start, end, name, kind in sorted(found):
+            print(f'  {name:10s} {kind:8s} {framescan.hms(start)} - {framescan.hms(end)}'
+                  f' (talk +{framescan.hms(max(start - t_start, 0))}, {end - start:.1f}s)')
+        n_problems += len(found)
+
+    fpath = Path(f'mix/{devroom}')
+    fpath.mkdir(parents=True, exist_ok=True)
+    report = f'{fpath}/framescan-{Path(devroom_json).stem}.json'
+    open(report, 'w').write(json.dumps(results, indent=2))
+    print(f'Report : {report}')
+    return n_problems
+
+def suggest_cuts_devroom(devroom_json, jobs=None):
+    # Suggest cuts from slide changes and silences, and store them as
+    # "suggested-cuts" next to the "cuts" of each talk. The cuts
+    # themselves are left alone - copy over what looks right. The file
+    # is edited in place (not re-dumped) to keep its layout.
+    text = open(devroom_json, 'r').read()
+    cfg = json.loads(text)
+    devroom = cfg['devroom']
+    vid_slides = f'{devroom}/{cfg["livestream"]}'
+    vid_procam = f'{devroom}/{cfg["vcam"]}'
+    crop = cfg['proc']['slides']['crop']['wh'] + cfg['proc']['slides']['crop']['xy']
+    print(f'Suggesting cuts from {vid_slides} and {vid_procam}...', flush=True)
+    talks = [([ts_seconds(c) for c in talk['cuts']], talk_offset(cfg, talk))
+             for talk in cfg['talks']]
+    results = cutsuggest.suggest_all(vid_slides, vid_procam, crop, talks, jobs)
+
+    for talk, result in zip(cfg['talks'], results):
+        suggested = [cutsuggest.timestamp(t) for t in result['cuts']]
+        print(f'  talk {talk["index"]} : {len(result["slide_changes"])} slide changes,'
+              f' {len(result["silences"])} silences')
+        for cut, new, note in zip(talk['cuts'], suggested, result['notes']):
+            print(f'    {cut} => {new} ({note})')
+
+        m = re.search(rf'"index"\s*:\s*"?{talk["index"]}"?(?![0-9])', text)
+        cuts = m and re.compile(r'^([ \t]*)"cuts"\s*:\s*\[[^\]]*\]',
+                                re.MULTILINE).search(text, m.end())
+        if cuts and re.search(r'"index"\s*:', text[m.end():cuts.start()]):
+            cuts = None # the cuts of a later talk
+        if not cuts:
+            print(f'    talk {talk["index"]} : no "cuts" list found after its "index"'
+                  f' in {devroom_json}, suggested cuts not stored')
+            continue
+        line = ', '.join([f'"{t}"' for t in suggested])
+        entry = f'"suggested-cuts" : [\n{cuts.group(1)}   {line}\n{cuts.group(1)}]'
+        old = re.compile(r',\s*"suggested-cuts"\s*:\s*\[[^\]]*\]').match(text, cuts.end())
+        if old:
+            text = text[:old.start()] + f',\n{cuts.group(1)}{entry}' + text[old.end():]
+        else:
+            text = text[:cuts.end()] + f',\n{cuts.group(1)}{entry}' + text[cuts.end():]
+    open(devroom_json, 'w').write(text)
+    return results
+
+def render_talk(cfg, talk, pipeline, verbose, opts):
+    # Worker for the talk scheduler - one talk per process,
+    # with all the output going to a per talk log
+    devroom = cfg['devroom']
+    fpath = Path(f'mix/{devroom}')
+    fpath.mkdir(parents=True, exist_ok=True)
+    log_file = f'{fpath}/{devroom}-{talk["index"]}.log'
+    with open(log_file, 'w') as log:
+        proc_opts.update(opts)
+        proc_opts['log'] = log
+        with contextlib.redirect_stdout(log):
+            master_video(cfg, talk, pipeline, verbose)
+    return log_file
+
+def schedule_talks(jobs, pipeline, verbose, n_jobs):
+    if n_jobs <= 1:
+        for cfg, talk in jobs:
+            master_video(cfg, talk, pipeline, verbose)
+        return True
+
+    # Split the cores between the jobs, so that the encodes don't fight
+    # each other for CPUs
+    threads = max(1, (os.cpu_count() or 1) // n_jobs)
+    print(f'Rendering {len(jobs)} talks, {n_jobs} at a time, {threads} threads each')
+    success = True
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {}
+        for cfg, talk in jobs:
+            opts = dict(proc_opts, threads=threads)
+            future = executor.submit(render_talk, cfg, talk, pipeline, verbose, opts)
+            futures[future] = f'{cfg["devroom"]}-{talk["index"]}'
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                log_file = future.result()
+                print(f'  {name} : DONE (log: {log_file})')
+            except Exception as e:
+                print(f'  {name} : FAILED ({e})')
+                success = False
+    return success
+
+def enqueue_talks(farm, talks, args):
+    # One render farm job per talk: this script, on that talk only, with
+    # the same options, but not --force: a retry would start over instead
+    # of going on from the steps that are done. It runs in the current
+    # directory - the devroom directories and mix/ must be on the shared
+    # storage too.
+    queue = renderfarm.Queue(farm)
+    opts = ['--pipeline', str(args.pipeline), '--chunks', str(args.chunks)]
+    for flag in ['cache_hash', 'sox_audio', 'encode_clips', 'dedup_slides', 'verbose']:
+        if getattr(args, flag):
+            opts.append('--' + flag.replace('_', '-'))
+    n_queued = 0
+    for devroom_json, cfg, talk in talks:
+        job_id = f'{cfg["devroom"]}-{talk["index"]}'
+        cmd = ['python3', os.path.relpath(os.path.abspath(__file__)), devroom_json,
+               '--index', str(talk['index'])] + opts
+        if queue.enqueue(job_id, os.getcwd(), cmd, reset=args.requeue):
+            print(f'  {job_id} : queued')
+            n_queued += 1
+        else:
+            print(f'  {job_id} : already in the queue ({queue.state(job_id)[0]})')
+    print(f'{n_queued} talks queued in {queue.root}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("devroom_json", nargs='+', help="""
+        Devroom configuration file(s) (json).
+    """)
+    parser.add_argument('--verbose', '-v', action='store_true', default=False, help="""
+        Enable verbose messages, showing ffmpeg execution, progress, warnings, etc.
+    """)
+    parser.add_argument('--index', '-i', type=int, help="""
+        Generate video only for talk having this index in the json file. If not
+        specified, all talk videos are processed.
+    """)
+    parser.add_argument('--pipeline', '-p', type=Pipeline, choices=list(Pipeline),
+        help="""Run a part of the processing pipeline.""")
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="""
+        Number of talks to render in parallel. The CPU cores are split between
+        the jobs. Output of each talk goes to mix/<devroom>/<devroom>-<index>.log
+        when more than one job is used.
+    """)
+    parser.add_argument('--force', action='store_true', default=False, help="""
+        Run every step, even if its command, inputs and config are unchanged
+        since the last run.
+    """)
+    parser.add_argument('--cache-hash', action='store_true', default=False, help="""
+        Identify input files by a hash of their contents instead of
+        size+modification time when deciding whether a step is up to date.
+    """)
+    parser.add_argument('--align', action='store_true', default=False, help="""
+        Find the offset between the livestream and the camera recording from
+        their audio, and how it drifts over the day. Write them to vcam-offset
+        and vcam-drift in the devroom configuration(s), and exit.
+    """)
+    parser.add_argument('--scan', action='store_true', default=False, help="""
+        Scan the livestream and camera recordings for black, frozen and
+        dropped frames, report them per talk, and exit. Uses --jobs workers
+        per recording.
+    """)
+    parser.add_argument('--suggest-cuts', action='store_true', default=False, help="""
+        Suggest cuts from slide changes in the livestream and silences in the
+        camera audio, around the existing cuts. Write them to suggested-cuts
+        of each talk in the devroom configuration(s), and exit.
+    """)
+    parser.add_argument('--noise-profile', action='store_true', default=False, help="""
+        Build the noise profile of the devroom(s) from the quietest stretch of
+        the camera recording, and exit. Profiles that exist are kept, unless
+        --force. A missing profile is built anyway before rendering.
+    """)
+    parser.add_argument('--sox-audio', action='store_true', default=False, help="""
+        Process audio with separate extract/sox noisered/ffmpeg steps, with
+        intermediate WAV files, instead of the streaming audio chain.
+    """)
+    parser.add_argument('--encode-clips', action='store_true', default=False, help="""
+        Re-encode every clip in full, instead of stream copying it between
+        keyframes and re-encoding only the frames around them.
+    """)
+    parser.add_argument('--chunks', type=int, default=1, help="""
+        Encode the fullscreen video, the slides+camera composite and the
+        final stitch of each talk in this many chunks, in parallel, joined
+        without re-encoding. For a single urgent talk on a many core machine.
+    """)
+    parser.add_argument('--dedup-slides', action='store_true', default=False, help="""
+        Find where the slides stand still, and composite only the slides
+        frames that change. Faster, and a smaller final video for talks
+        with mostly static slides.
+    """)
+    parser.add_argument('--farm', help="""
+        Queue the talks as jobs in this render farm directory, on shared
+        storage, instead of rendering them. Run renderfarm.py work on the
+        hosts that render them.
+    """)
+    parser.add_argument('--requeue', action='store_true', default=False, help="""
+        With --farm, queue the talks that are already done (or dead) in the
+        render farm again.
+    """)
+    args = parser.parse_args()
+    if args.farm and args.force:
+        parser.error('--force is not passed on to render farm jobs '
+                     '(a retry would redo every step), use --requeue')
+
+    proc_opts['force'] = args.force
+    proc_opts['chunks'] = max(args.chunks, 1)
+    if args.dedup_slides:
+        proc_opts['slides'] = 'dedup'
+    if args.cache_hash:
+        proc_opts['cache'] = 'content'
+    if args.sox_audio:
+        proc_opts['audio'] = 'sox'
+    if args.encode_clips:
+        proc_opts['cut'] = 'encode'
+
+    if args.align:
+        for devroom_json in args.devroom_json:
+            align_devroom(devroom_json, args.verbose)
+        sys.exit(0)
+
+    if args.suggest_cuts:
+        for devroom_json in args.devroom_json:
+            suggest_cuts_devroom(devroom_json, args.jobs if args.jobs > 1 else None)
+        sys.exit(0)
+
+    if args.noise_profile:
+        for devroom_json in args.devroom_json:
+            cfg = json.loads(open(devroom_json,'r').read())
+            profile = noise_profile_path(cfg)
+            if os.path.exists(profile) and not args.force:
+                print(f'{profile} exists, kept (--force to build it again)')
+                continue
+            noise_profile_devroom(cfg, args.force)
+        sys.exit(0)
+
+    if args.scan:
+        n_problems = 0
+        for devroom_json in args.devroom_json:
+            n_problems += scan_devroom(devroom_json, args.jobs if args.jobs > 1 else None)
+        sys.exit(0 if n_problems == 0 else 1)
+
+    if args.pipeline is None:
+        args.pipeline = Pipeline(Pipeline.full)
+
+    jobs = []
+    farm_talks = []
+    for devroom_json in args.devroom_json:
+        cfg = json.loads(open(devroom_json,'r').read())
+        talks = []
+        for talk in cfg['talks']:
+            if args.index and args.index != talk['index']:
+                continue
+            talks.append(talk)
+            jobs.append((cfg, talk))
+            farm_talks.append((devroom_json, cfg, talk))
+        if talks and args.pipeline in [Pipeline.full, Pipeline.audio, Pipeline.single] and not args.farm:
+            noise_profile_devroom(cfg)
+        if args.pipeline == Pipeline.full and not args.farm:
+            cut_devroom_sources(cfg, talks, args.verbose)
+
+    if args.farm:
+        enqueue_talks(args.farm, farm_talks, args)
+        sys.exit(0)
+
+    if not schedule_talks(jobs, args.pipeline, args.verbose, args.jobs):
+        sys.exit(1)
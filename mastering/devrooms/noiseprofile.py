@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+#
+# noiseprofile.py
+#
+# Builds the noise profile of a camera recording (the "noise-profile"
+# of a devroom), instead of listening for a silent stretch by hand and
+# running sox noiseprof on it (denoise-audio-*.sh):
+#
+#   ./noiseprofile.py aosp/procam-1.mp4 aosp/procam-1-noise-profile
+#
+# - Search: the audio is decoded once, downmixed and decimated to
+#   SCAN_RATE, and cut in HOP long frames. For all frames of a block at
+#   once: the level (dB RMS) and the spectral flatness (geometric over
+#   arithmetic mean of the power spectrum - near 1 for noise, low for
+#   speech, music and hum).
+# - The noise window is the PROFILE_SECONDS stretch with the lowest
+#   level, among the stationary ones: level spread under STATIONARY_DB
+#   and mean flatness of at least MIN_FLATNESS. Stretches with digital
+#   silence (a muted or dropped input) and the first/last EDGE seconds
+#   (handling noise) don't count. If no stretch is stationary, the
+#   quietest one is used.
+# - Profile: only that stretch is decoded again, at the recording's own
+#   rate and channels, like the WAV that sox noisered (--sox-audio)
+#   gets. The profile is computed the way sox noiseprof does: the mean
+#   log power per frequency bin of WINDOW_SIZE sample frames, without a
+#   window function, in the same "Channel N: v0, v1, ..." format.
+#
+# Where the stretch was goes to <profile>.json, to listen to it.
+#
+import os
+import json
+import argparse
+import subprocess
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import align
+import audiochain
+
+SCAN_RATE = 8000
+HOP = 0.05 # seconds
+BLOCK_HOPS = 1200 # hops per block read from ffmpeg
+PROFILE_SECONDS = 1.0
+STATIONARY_DB = 3.0
+MIN_FLATNESS = 0.3
+SILENCE_DB = -90 # digital silence
+EDGE = 5.0 # seconds
+WINDOW_SIZE = audiochain.WINDOW_SIZE
+
+def frame_stats(frames):
+    # frames: (n, hop samples) => level (dB), spectral flatness, per frame
+    level = 10 * np.log10(np.mean(np.square(frames), axis=1) + 1e-12)
+    window = np.hanning(frames.shape[1])
+    spec = np.fft.rfft(frames * window, axis=1)
+    power = (np.square(spec.real) + np.square(spec.imag))[:, 1:] + 1e-20
+    flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    return level, flatness
+
+def scan(src):
+    # => level, flatness per HOP of the whole recording, in one pass
+    proc = align.decode(src, SCAN_RATE)
+    hop = int(SCAN_RATE * HOP)
+    levels = []
+    flatness = []
+    leftover = np.zeros(0, dtype=np.float32)
+    while True:
+        data = proc.stdout.read(hop * BLOCK_HOPS * 4)
+        if len(data) == 0:
+            break
+        block = np.concatenate([leftover, np.frombuffer(data, dtype='<f4')])
+        n = block.shape[0] // hop
+        leftover = block[n * hop:]
+        if n == 0:
+            continue
+        level, flat = frame_stats(block[:n * hop].astype(np.float64).reshape(n, hop))
+        levels.append(level)
+        flatness.append(flat)
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    if not levels:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate(levels), np.concatenate(flatness)
+
+def quietest(level, flatness):
+    # => (start in seconds, info) of the stretch to profile, None if the
+    # recording is too short
+    n = int(round(PROFILE_SECONDS / HOP))
+    edge = int(round(EDGE / HOP))
+    if level.shape[0] - 2 * edge < n:
+        edge = 0
+    if level.shape[0] < n:
+        return None
+    levels = sliding_window_view(level, n)
+    mean = levels.mean(axis=1)
+    spread = levels.max(axis=1) - levels.min(axis=1)
+    flat = sliding_window_view(flatness, n).mean(axis=1)
+    valid = levels.min(axis=1) > SILENCE_DB
+    valid[:edge] = False
+    valid[max(valid.shape[0] - edge, 0):] = False
+    if not valid.any():
+        valid[:] = True
+    stationary = valid & (spread < STATIONARY_DB) & (flat >= MIN_FLATNESS)
+    candidates = stationary if stationary.any() else valid
+    idx = int(np.argmin(np.where(candidates, mean, np.inf)))
+    return idx * HOP, {
+        'start' : round(idx * HOP, 3),
+        'duration' : PROFILE_SECONDS,
+        'level_db' : round(float(mean[idx]), 2),
+        'spread_db' : round(float(spread[idx]), 2),
+        'flatness' : round(float(flat[idx]), 3),
+        'stationary' : bool(stationary[idx])
+    }
+
+def probe_audio(src):
+    # => sample rate, channels of the first audio stream
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+                             '-show_entries', 'stream=sample_rate,channels',
+                             '-of', 'json', src],
+                            capture_output=True, text=True, check=True)
+    stream = json.loads(result.stdout)['streams'][0]
+    return int(stream['sample_rate']), int(stream['channels'])
+
+def profile(samples):
+    # samples: (n, channels) => [mean log power per bin] per channel, as
+    # sox noiseprof: complete WINDOW_SIZE frames, no window function,
+    # bins with no power left out of their mean
+    n = samples.shape[0] // WINDOW_SIZE
+    if n == 0:
+        raise ValueError(f'Need at least {WINDOW_SIZE} samples for a noise profile')
+    result = []
+    for channel in samples.T:
+        frames = channel[:n * WINDOW_SIZE].reshape(n, WINDOW_SIZE)
+        spec = np.fft.rfft(frames, axis=1)
+        power = np.square(spec.real) + np.square(spec.imag)
+        positive = power > 0
+        with np.errstate(divide='ignore'):
+            logs = np.where(positive, np.log(np.where(positive, power, 1.0)), 0.0)
+        count = positive.sum(axis=0)
+        result.append(np.where(count > 0, logs.sum(axis=0) / np.maximum(count, 1), 0.0))
+    return result
+
+def write_profile(fname, channels):
+    # sox noiseprof format, written + renamed
+    lines = [f'Channel {idx}: ' + ', '.join([f'{v:f}' for v in values])
+             for idx, values in enumerate(channels)]
+    tmp = f'{fname}.{os.getpid()}.tmp'
+    open(tmp, 'w').write('\n'.join(lines) + '\n')
+    audiochain.read_noise_profile(tmp)
+    os.replace(tmp, fname)
+
+def build(src, output):
+    # => info on the stretch the profile was built from
+    level, flatness = scan(src)
+    found = quietest(level, flatness)
+    if found is None:
+        raise ValueError(f'{src}: too short for a noise profile')
+    start, info = found
+    rate, channels = probe_audio(src)
+    proc = subprocess.Popen(['ffmpeg', '-v', 'error',
+                             '-ss', f'{start:.6f}', '-t', f'{PROFILE_SECONDS:.6f}', '-i', src,
+                             '-vn', '-f', 'f32le', '-'], stdout=subprocess.PIPE)
+    data = proc.stdout.read()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    samples = np.frombuffer(data[:len(data) // (4 * channels) * 4 * channels], dtype='<f4')
+    write_profile(output, profile(samples.astype(np.float64).reshape(-1, channels)))
+    info = dict(info, source=src, rate=rate, channels=channels)
+    open(f'{output}.json', 'w').write(json.dumps(info, indent=2) + '\n')
+    return info
+
+def timestamp(seconds):
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f'{int(h):02d}:{int(m):02d}:{s:06.3f}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording', help="""
+        Camera recording (or any audio/video file).
+    """)
+    parser.add_argument('profile', help="""
+        Noise profile file to write, in sox noiseprof format.
+    """)
+    args = parser.parse_args()
+    info = build(args.recording, args.profile)
+    print(f'{args.profile}: from {timestamp(info["start"])} ({info["level_db"]:.1f}dB, '
+          f'flatness {info["flatness"]:.2f}{"" if info["stationary"] else ", NOT stationary"})')
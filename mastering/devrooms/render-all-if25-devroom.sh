@@ -1,10 +1,33 @@
-./master-talk-video.py aosp-1.json
-./master-talk-video.py aosp-2.json
-./master-talk-video.py open-hardware.json
-./master-talk-video.py foss-in-science-1.json
-./master-talk-video.py foss-in-science-2.json
-./master-talk-video.py open-data-1.json
-./master-talk-video.py open-data-2.json
+# All devroom talks go into one scheduler, so that talks from
+# different devrooms can render at the same time
+#
+# With FARM=<dir on shared storage>, everything is queued in that render
+# farm instead, for renderfarm.py workers on any number of hosts
+JOBS=${JOBS:-4}
+DEVROOMS="aosp-1.json aosp-2.json
+    open-hardware.json
+    foss-in-science-1.json foss-in-science-2.json
+    open-data-1.json open-data-2.json"
+
+if [ -n "$FARM" ]; then
+  # absolute, the compilers and policy jobs are added from their directories
+  mkdir -p "$FARM"
+  FARM=$(realpath "$FARM")
+  ./master-talk-video.py --farm "$FARM" $DEVROOMS
+  cd compilers
+  for idx in 1 2 3 4 6 7; do
+    ../renderfarm.py add "$FARM" compilers-$idx -- sh talk-proc.sh C000$idx.MP4
+  done
+  # clip-talk-5.sh trims the output of talk 5: same job
+  ../renderfarm.py add "$FARM" compilers-5 -- sh -c "sh talk-proc.sh C0005.MP4 && sh clip-talk-5.sh"
+  cd ../policy
+  for idx in `seq 1 6`; do
+    ../renderfarm.py add "$FARM" policy-$idx -- sh -c "sh cut-$idx.sh && sh talk-proc.sh talk$idx-seg.mp4"
+  done
+  exit 0
+fi
+
+./master-talk-video.py --jobs $JOBS $DEVROOMS
 
 cd compilers
 for idx in `seq 1 7`; do 
@@ -16,6 +39,6 @@ sh clip-talk-5.sh
 cd ../policy
 for idx in `seq 1 6`; do 
   echo $idx;
-  sh cut-$idx
+  sh cut-$idx.sh
   sh talk-proc.sh talk$idx-seg.mp4
 done
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+#
+# renderfarm.py
+#
+# A render farm for devroom batches: a job queue in a directory on shared
+# storage (NFS), and workers on any number of hosts that take jobs from
+# it.
+#
+#   ./master-talk-video.py --farm /mnt/share/farm aosp-1.json aosp-2.json
+#   ./renderfarm.py work /mnt/share/farm --slots 2    # on every host
+#   ./renderfarm.py status /mnt/share/farm
+#   ./renderfarm.py retry /mnt/share/farm             # dead jobs again
+#   ./renderfarm.py add /mnt/share/farm compilers-1 -- sh talk-proc.sh C0001.MP4
+#
+# A job is a command (one talk: master-talk-video.py --index N ..., or
+# any command given to add) and the directory to run it in, relative to
+# the queue, so hosts may mount the share anywhere. Workers on one host
+# are just as good for testing: run work in a few terminals.
+#
+# The queue is plain files, no database - SQLite locking is not to be
+# trusted on NFS, while link and rename are:
+#
+#   jobs/<id>.json                the job
+#   leases/<id>.<attempt>.json    a claim on the job, by a worker
+#   failed/<id>.<attempt>.json    why an attempt failed
+#   done/<id>.json                the job is done
+#   logs/<id>.<attempt>.log       output of an attempt
+#
+# - Claiming attempt n of a job writes its lease to a temporary file and
+#   links it to the lease name, which fails if that exists: only one
+#   worker gets it, and the lease is complete from the start (an O_EXCL
+#   create would show an empty lease, taken for an expired one, until
+#   it's written). There's no stealing of leases: when a lease expires
+#   (worker gone), attempt n counts as failed and the next claim is n+1.
+# - A lease lasts LEASE seconds. The worker renews it every HEARTBEAT
+#   while the job runs. If it finds a later attempt has started (its
+#   lease expired anyway, e.g. the share was unreachable for a while), it
+#   stops the job: the job runs in a session of its own, so the ffmpeg
+#   processes it started are stopped with it. If the lease can't be
+#   renewed MISSED_BEATS times in a row (share unreachable), it stops the
+#   job too, before the lease runs out, and marks the attempt failed if
+#   it can.
+# - Failed jobs are retried, up to the job's attempts. Then they are dead
+#   until `retry`.
+# - Records are written to a temporary file and renamed, so readers never
+#   see half of one. The final video of a talk is rendered to a temporary
+#   name and renamed too (see add_proc), and steps are cached, so a retry
+#   redoes only what the failed attempt didn't finish.
+#
+# Lease times are wall clock, so the hosts' clocks must agree (NTP) to
+# well within LEASE.
+#
+import os
+import sys
+import json
+import time
+import glob
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+
+LEASE = 120 # seconds
+HEARTBEAT = 20 # seconds
+MISSED_BEATS = LEASE // HEARTBEAT - 1
+POLL = 10 # seconds between looks at the queue when idle
+ATTEMPTS = 3
+
+def write_json(fname, data):
+    # Atomic: write a temporary file, and rename it over
+    tmp = f'{fname}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(data, indent=2) + '\n')
+    os.replace(tmp, fname)
+
+def create_json(fname, data):
+    # Atomic and exclusive: write a temporary file, and link it => False
+    # if fname exists
+    tmp = f'{fname}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(data, indent=2) + '\n')
+    try:
+        os.link(tmp, fname)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.unlink(tmp)
+
+def read_json(fname):
+    try:
+        return json.loads(open(fname, 'r').read())
+    except (OSError, ValueError):
+        return None
+
+class Queue:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        for sub in ['jobs', 'leases', 'failed', 'done', 'logs']:
+            os.makedirs(os.path.join(self.root, sub), exist_ok=True)
+
+    def path(self, sub, name):
+        return os.path.join(self.root, sub, name)
+
+    def job_ids(self):
+        # Oldest first
+        jobs = glob.glob(self.path('jobs', '*.json'))
+        jobs.sort(key=lambda fname: (os.path.getmtime(fname), fname))
+        return [os.path.basename(fname)[:-len('.json')] for fname in jobs]
+
+    def attempts(self, job_id):
+        # Attempt numbers claimed so far
+        found = []
+        for fname in glob.glob(self.path('leases', f'{glob.escape(job_id)}.*.json')):
+            attempt = os.path.basename(fname)[len(job_id) + 1:-len('.json')]
+            if attempt.isdigit():
+                found.append(int(attempt))
+        return sorted(found)
+
+    def state(self, job_id, now=None):
+        # => (state, last attempt, its lease): state is one of queued,
+        # running, retry (failed, will run again), dead, done
+        now = now if now else time.time()
+        if os.path.exists(self.path('done', f'{job_id}.json')):
+            return 'done', None, None
+        job = read_json(self.path('jobs', f'{job_id}.json'))
+        attempts = self.attempts(job_id)
+        if not attempts:
+            return 'queued', 0, None
+        attempt = attempts[-1]
+        lease = read_json(self.path('leases', f'{job_id}.{attempt}.json'))
+        failed = os.path.exists(self.path('failed', f'{job_id}.{attempt}.json'))
+        if not failed and lease and lease['expires'] > now:
+            return 'running', attempt, lease
+        max_attempts = job['attempts'] if job else ATTEMPTS
+        return ('dead' if attempt >= max_attempts else 'retry'), attempt, lease
+
+    def enqueue(self, job_id, cwd, cmd, attempts=ATTEMPTS, reset=False):
+        # => True if the job was (re)queued. A job that is already in the
+        # queue is left alone, unless reset (and it's not running).
+        job_file = self.path('jobs', f'{job_id}.json')
+        if os.path.exists(job_file):
+            state = self.state(job_id)[0]
+            if not reset or state == 'running':
+                return False
+            self.clear(job_id)
+        write_json(job_file, {
+            'id' : job_id,
+            'cwd' : os.path.relpath(os.path.abspath(cwd), self.root),
+            'cmd' : cmd,
+            'attempts' : attempts,
+            'queued' : time.time()
+        })
+        return True
+
+    def clear(self, job_id):
+        # Forget the attempts and the result of a job
+        for sub, pattern in [('done', f'{job_id}.json'), ('leases', f'{job_id}.*.json'),
+                             ('failed', f'{job_id}.*.json')]:
+            for fname in glob.glob(self.path(sub, glob.escape(pattern).replace(r'[*]', '*'))):
+                os.unlink(fname)
+
+    def claim(self, worker):
+        # => (job, attempt) for the next job this worker should run, or None
+        now = time.time()
+        for job_id in self.job_ids():
+            state, attempt, lease = self.state(job_id, now)
+            if state not in ['queued', 'retry']:
+                continue
+            if state == 'retry' and not os.path.exists(self.path('failed', f'{job_id}.{attempt}.json')):
+                # The worker went away, without a word
+                write_json(self.path('failed', f'{job_id}.{attempt}.json'), {
+                    'worker' : lease['worker'] if lease else None,
+                    'error' : 'lease expired',
+                    'time' : now
+                })
+            attempt += 1
+            if not create_json(self.path('leases', f'{job_id}.{attempt}.json'),
+                               self.lease(worker, now)):
+                continue # someone else got it
+            job = read_json(self.path('jobs', f'{job_id}.json'))
+            if job is None:
+                continue
+            return job, attempt
+        return None
+
+    def lease(self, worker, now):
+        return {
+            'worker' : worker,
+            'host' : socket.gethostname(),
+            'started' : now,
+            'expires' : now + LEASE
+        }
+
+    def heartbeat(self, job_id, attempt, lease):
+        # Renew the lease => False if another attempt took over
+        if self.attempts(job_id)[-1:] != [attempt]:
+            return False
+        lease['expires'] = time.time() + LEASE
+        write_json(self.path('leases', f'{job_id}.{attempt}.json'), lease)
+        return True
+
+    def finish(self, job_id, attempt, worker, returncode, started, error=None):
+        record = {
+            'worker' : worker,
+            'host' : socket.gethostname(),
+            'attempt' : attempt,
+            'returncode' : returncode,
+            'wall' : round(time.time() - started, 3),
+            'time' : time.time()
+        }
+        if returncode == 0 and not error:
+            write_json(self.path('done', f'{job_id}.json'), record)
+        else:
+            record['error'] = error if error else f'exit code {returncode}'
+            write_json(self.path('failed', f'{job_id}.{attempt}.json'), record)
+
+    def pending(self):
+        # Jobs that are not done or dead yet
+        return [job_id for job_id in self.job_ids()
+                if self.state(job_id)[0] in ['queued', 'running', 'retry']]
+
+def run_job(queue, job, attempt, worker):
+    # Run the job's command, renewing the lease as it goes => exit code
+    # (None if the job was taken over, or its lease couldn't be renewed)
+    job_id = job['id']
+    lease = queue.lease(worker, time.time())
+    started = lease['started']
+    log_file = queue.path('logs', f'{job_id}.{attempt}.log')
+    print(f'{worker}: {job_id} attempt {attempt} (log: {log_file})', flush=True)
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(job['cmd'], cwd=os.path.join(queue.root, job['cwd']),
+                                stdout=log, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+        last_beat = time.monotonic()
+        missed = 0
+        while True:
+            try:
+                returncode = proc.wait(timeout=1)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if time.monotonic() - last_beat >= HEARTBEAT:
+                last_beat = time.monotonic()
+                try:
+                    renewed = queue.heartbeat(job_id, attempt, lease)
+                    missed = 0
+                except OSError as e:
+                    missed += 1
+                    print(f'{worker}: {job_id} attempt {attempt}: lease not renewed'
+                          f' ({missed}/{MISSED_BEATS}): {e}', flush=True)
+                    if missed < MISSED_BEATS:
+                        continue
+                    print(f'{worker}: {job_id} attempt {attempt} lost its lease, stopping', flush=True)
+                    os.killpg(proc.pid, signal.SIGTERM)
+                    proc.wait()
+                    try:
+                        queue.finish(job_id, attempt, worker, proc.returncode, started,
+                                     error=f'lease not renewed: {e}')
+                    except OSError:
+                        pass # it expires anyway
+                    return None
+                if not renewed:
+                    print(f'{worker}: {job_id} attempt {attempt} was taken over, stopping', flush=True)
+                    os.killpg(proc.pid, signal.SIGTERM)
+                    proc.wait()
+                    return None
+    queue.finish(job_id, attempt, worker, returncode, started)
+    print(f'{worker}: {job_id} attempt {attempt} {"DONE" if returncode == 0 else "FAILED"}', flush=True)
+    return returncode
+
+def work(root, slots=1, exit_when_idle=False):
+    # Run jobs from the queue, slots of them at a time
+    queue = Queue(root)
+    def slot(idx):
+        worker = f'{socket.gethostname()}-{os.getpid()}-{idx}'
+        while True:
+            try:
+                claimed = queue.claim(worker)
+                if claimed:
+                    run_job(queue, claimed[0], claimed[1], worker)
+                    continue
+                if exit_when_idle and not queue.pending():
+                    return
+            except OSError as e:
+                # the share comes and goes: keep the slot
+                print(f'{worker}: {e}', flush=True)
+            time.sleep(POLL)
+    threads = [threading.Thread(target=slot, args=(idx,), daemon=True) for idx in range(slots)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def status(root):
+    queue = Queue(root)
+    now = time.time()
+    counts = {}
+    for job_id in queue.job_ids():
+        state, attempt, lease = queue.state(job_id, now)
+        counts[state] = counts.get(state, 0) + 1
+        line = f'  {job_id:30s} {state:8s}'
+        if state == 'running':
+            line += f' attempt {attempt} on {lease["worker"]} for {now - lease["started"]:.0f}s'
+        elif state in ['retry', 'dead']:
+            failure = read_json(queue.path('failed', f'{job_id}.{attempt}.json'))
+            error = failure['error'] if failure else 'lease expired'
+            line += f' attempt {attempt}: {error} (log: logs/{job_id}.{attempt}.log)'
+        elif state == 'done':
+            done = read_json(queue.path('done', f'{job_id}.json'))
+            line += f' on {done["worker"]} in {done["wall"]:.0f}s'
+        print(line)
+    print(', '.join([f'{n} {state}' for state, n in sorted(counts.items())]))
+    return counts
+
+def retry(root, job_ids=None):
+    # Requeue dead jobs (or the given ones, unless running)
+    queue = Queue(root)
+    for job_id in job_ids if job_ids else queue.job_ids():
+        state = queue.state(job_id)[0]
+        if (job_ids and state != 'running') or state == 'dead':
+            queue.clear(job_id)
+            # Touch the job, it goes to the back of the queue
+            os.utime(queue.path('jobs', f'{job_id}.json'))
+            print(f'{job_id} requeued')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['work', 'status', 'retry', 'add'], help="""
+        work: run jobs from the queue. status: list the jobs. retry: requeue
+        the dead jobs, or the given ones. add: queue a job id and command
+        (after --), run in the current directory.
+    """)
+    parser.add_argument('queue', help="""
+        Queue directory, on storage shared by all the workers.
+    """)
+    parser.add_argument('jobs', nargs='*', help="""
+        Job ids, for retry. For add, the job id and its command.
+    """)
+    parser.add_argument('--slots', '-j', type=int, default=1, help="""
+        Jobs run at a time by this worker.
+    """)
+    parser.add_argument('--exit-when-idle', action='store_true', default=False, help="""
+        Exit when no job is queued or running, instead of waiting for more.
+    """)
+    args = parser.parse_args()
+    if args.command == 'work':
+        work(args.queue, args.slots, args.exit_when_idle)
+    elif args.command == 'status':
+        counts = status(args.queue)
+        sys.exit(1 if counts.get('dead') else 0)
+    elif args.command == 'add':
+        if len(args.jobs) < 2:
+            parser.error('add needs a job id and a command')
+        if not Queue(args.queue).enqueue(args.jobs[0], os.getcwd(), args.jobs[1:]):
+            print(f'{args.jobs[0]} already in the queue')
+    else:
+        retry(args.queue, args.jobs)
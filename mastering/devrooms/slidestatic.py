@@ -0,0 +1,94 @@
+#
+# slidestatic.py
+#
+# Finds where the slides of a talk stand still, so that the composite
+# doesn't redo the same work for every frame of a slide that is shown
+# for a minute (--dedup-slides).
+#
+# Analysis: one ffmpeg pass over the livestream segment, cropped to the
+# slides box (proc.slides.crop), through mpdecimate. mpdecimate drops a
+# frame when no 8x8 block differs much from the last frame it kept -
+# compression noise of the livestream is not a change, a cursor or a
+# new bullet point is. The frames it keeps are written as a framecrc
+# listing (tiny 16x16 frames, only their timestamps are of use).
+#
+# Between two kept frames, the slides repeat the first one: a static
+# run. Runs shorter than MIN_RUN are left alone. If the runs cover less
+# than MIN_STATIC of the talk (a demo, a video), the talk is composited
+# as usual.
+#
+# Encode: the slides branch of the composite selects only the frames
+# that are not inside a run, before cropping and scaling them. overlay
+# holds the last slides frame it got, so the output still has every
+# frame of the camera. The static slides are then exactly the same in
+# every output frame, instead of carrying the livestream's compression
+# noise, which the final encode turns into skipped blocks: a smaller
+# file, encoded faster.
+#
+# Runs are kept in seconds of the livestream segment, and the select
+# expression is built for the start of each chunk (--chunks): ffmpeg
+# restarts timestamps at 0 when seeking an input.
+#
+import re
+from fractions import Fraction
+
+DECIMATE = 'mpdecimate=hi=768:lo=320:frac=0.33:max=0'
+MIN_RUN = 1.0 # seconds
+MIN_STATIC = 0.3 # of the talk
+
+def scan_cmd(vfile, crop, output):
+    # ffmpeg command writing the kept frames of the slides box as framecrc
+    w, h, x, y = crop
+    return ['ffmpeg', '-i', vfile, '-an',
+            '-vf', f'crop={w}:{h}:{x}:{y},{DECIMATE},scale=16:16',
+            '-fps_mode', 'passthrough',
+            '-f', 'framecrc', '-y', output]
+
+def kept_frames(crc_file):
+    # => times (seconds) of the frames listed in a framecrc file
+    tb = None
+    times = []
+    for line in open(crc_file, 'r'):
+        m = re.match(r'#tb 0: (\d+)/(\d+)', line)
+        if m:
+            tb = Fraction(int(m.group(1)), int(m.group(2)))
+            continue
+        if line.startswith('#') or tb is None:
+            continue
+        fields = [f.strip() for f in line.split(',')]
+        if len(fields) >= 3 and fields[0] == '0':
+            times.append(float(int(fields[2]) * tb))
+    return sorted(times)
+
+def static_runs(kept, duration):
+    # => [(start, end)]: the slides frames after start and before end
+    # repeat the one at start
+    runs = []
+    for start, end in zip(kept, kept[1:] + [duration]):
+        if end - start >= MIN_RUN:
+            runs.append((start, end))
+    return runs
+
+def summary(runs, kept, duration):
+    static = sum([end - start for start, end in runs])
+    return {
+        'changes' : len(kept),
+        'static' : round(static / duration, 3) if duration > 0 else 0.0,
+        'runs' : [[round(start, 6), round(end, 6)] for start, end in runs]
+    }
+
+def select_filter(runs, frame_rate, start=0.0):
+    # select filter keeping the slides frames outside the runs, for an
+    # encode that starts at start (seconds of the segment). The first
+    # frame is always kept, overlay needs one to start with. None if
+    # nothing is dropped.
+    half = float(Fraction(frame_rate)) ** -1 / 2
+    spans = []
+    for run_start, run_end in runs:
+        lo = run_start - start + half
+        hi = run_end - start - half
+        if hi > max(lo, 0):
+            spans.append(f'between(t,{lo:.6f},{hi:.6f})')
+    if not spans:
+        return None
+    return f"select='eq(n,0)+not({'+'.join(spans)})'"
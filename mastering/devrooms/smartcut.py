@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+# smartcut.py
+#
+# Frame exact cutting of H.264/H.265 video without re-encoding all of it.
+#
+# Stream copy can only start a piece at a keyframe. So a cut [start, end)
+# is split at the keyframes inside it:
+#
+#   start ... kf_first ......... kf_last ... end
+#   |-encode-|------- copy -------|--encode--|
+#
+# Only the frames before the first keyframe, and from the last keyframe
+# on, are decoded and encoded again. The tail is re-encoded too, as a
+# stream copy can't end on an arbitrary frame if the encoder reorders
+# frames (B-frames). The pieces are written as MPEG-TS (parameter sets
+# in band, so encoded and copied pieces can differ in them) and joined
+# with the concat demuxer.
+#
+# If every frame is a keyframe (the "intermediate" encode profile of
+# master-talk-video.py), a cut is a single stream copy.
+#
+#   ./smartcut.py talk.mp4 final-talk.mp4 --drop 00:01:34-00:02:02
+#
+import sys
+import argparse
+import subprocess
+
+# Pieces shorter than this aren't worth a separate file, and keyframes
+# closer than this to the start/end of a cut are taken to be on it
+MIN_PIECE = 0.001
+
+def ts(seconds):
+    # seconds => HH:MM:SS.ffffff, as used on the ffmpeg command line
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f'{int(h):02d}:{int(m):02d}:{s:09.6f}'
+
+def start_time(vfile):
+    result = subprocess.run(['ffprobe', '-v', 'error',
+                             '-show_entries', 'format=start_time',
+                             '-of', 'csv=p=0', vfile],
+                            capture_output=True, text=True, check=True)
+    value = result.stdout.strip()
+    return float(value) if value not in ['', 'N/A'] else 0.0
+
+def frames(vfile, start=None, end=None):
+    # (time, is keyframe) of the frames of the first video stream, in
+    # seconds from the start of the file. Only packet headers are read -
+    # nothing is decoded - and only around [start, end) if given.
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0']
+    t0 = start_time(vfile)
+    if start is not None:
+        # -read_intervals seeks to the keyframe before start
+        interval = f'{t0 + start}%'
+        if end is not None:
+            interval += f'{t0 + end}'
+        cmd += ['-read_intervals', interval]
+    result = subprocess.run(cmd + [vfile], capture_output=True, text=True, check=True)
+    pkts = []
+    for line in result.stdout.splitlines():
+        fields = line.split(',')
+        if len(fields) < 2 or fields[0] == 'N/A':
+            continue
+        pkts.append((round(float(fields[0]) - t0, 6), 'K' in fields[1]))
+    return sorted(pkts)
+
+def plan(pkts, start, end):
+    # Split [start, end) into ('encode'|'copy', start, end) pieces
+    inside = [(t, key) for t, key in pkts if start - MIN_PIECE <= t < end - MIN_PIECE]
+    kfs = [t for t, key in inside if key]
+    if inside and len(kfs) == len(inside) and abs(kfs[0] - start) < MIN_PIECE:
+        # All intra, copy the whole cut
+        return [('copy', start, end)]
+    if len(kfs) < 2:
+        # Too few keyframes to copy anything between them
+        return [('encode', start, end)]
+    kf_first = start if abs(kfs[0] - start) < MIN_PIECE else kfs[0]
+    kf_last = kfs[-1]
+    pieces = []
+    if kf_first > start:
+        pieces.append(('encode', start, kf_first))
+    pieces.append(('copy', kf_first, kf_last))
+    pieces.append(('encode', kf_last, end))
+    return pieces
+
+def piece_cmd(src, mode, start, end, encode, out):
+    # ffmpeg command for one piece. Input seeking makes encoded pieces
+    # frame exact, and copied pieces start on their keyframe.
+    cmd = ['ffmpeg', '-ss', ts(start), '-t', ts(end - start), '-i', src, '-an']
+    cmd += ['-c', 'copy'] if mode == 'copy' else encode
+    return cmd + ['-avoid_negative_ts', 'make_zero', '-y', out]
+
+def concat_cmd(parts, list_file, out):
+    # Join pieces with the concat demuxer, writing the list it reads
+    with open(list_file, 'w') as f:
+        for part in parts:
+            # paths in the list are relative to the list file
+            f.write(f"file '{part.split('/')[-1]}'\n")
+    return ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_file,
+            '-c', 'copy', '-movflags', '+faststart', '-y', out]
+
+def encoded_duration(pieces):
+    return sum([end - start for mode, start, end in pieces if mode == 'encode'])
+
+def keep_ranges(drops, duration):
+    # Complement of the dropped ranges within [0, duration)
+    keep = []
+    pos = 0.0
+    for start, end in sorted(drops):
+        if start > pos:
+            keep.append((pos, start))
+        pos = max(pos, end if end is not None else duration)
+    if pos < duration:
+        keep.append((pos, duration))
+    return keep
+
+def parse_range(text):
+    # "HH:MM:SS[.fff]-HH:MM:SS[.fff]", the end may be left out
+    def seconds(value):
+        h, m, s = value.split(':')
+        return int(h)*3600 + int(m)*60 + float(s)
+    start, end = text.split('-')
+    return seconds(start), seconds(end) if end else None
+
+def probe_duration(vfile):
+    result = subprocess.run(['ffprobe', '-v', 'error',
+                             '-show_entries', 'format=duration',
+                             '-of', 'csv=p=0', vfile],
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+def drop_ranges(src, out, drops, encode, verbose=False):
+    # Remove ranges from a finished video. Video is smart cut, the audio
+    # (cheap to encode) is cut in one pass with aselect and muxed in.
+    run = lambda cmd: subprocess.run(cmd, check=True,
+                                     capture_output=not verbose)
+    duration = probe_duration(src)
+    pkts = frames(src)
+    parts = []
+    stats = []
+    for start, end in keep_ranges(drops, duration):
+        pieces = plan(pkts, start, end)
+        stats.append([start, end, encoded_duration(pieces)])
+        for mode, p_start, p_end in pieces:
+            part = f'{out}.part{len(parts)}.ts'
+            run(piece_cmd(src, mode, p_start, p_end, encode, part))
+            parts.append(part)
+    video = f'{out}.video.mp4'
+    run(concat_cmd(parts, f'{out}.parts', video))
+
+    between = '+'.join([f'between(t,{s},{e if e is not None else duration})' for s, e in drops])
+    run(['ffmpeg', '-i', video, '-i', src,
+         '-map', '0:v:0', '-map', '1:a:0?',
+         '-c:v', 'copy',
+         '-af', f"aselect='not({between})',asetpts=N/SR/TB",
+         '-movflags', '+faststart',
+         '-y', out])
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('src', help="""
+        Video to cut.
+    """)
+    parser.add_argument('out', help="""
+        Output video.
+    """)
+    parser.add_argument('--drop', action='append', required=True, help="""
+        Range to remove, as HH:MM:SS[.fff]-HH:MM:SS[.fff]. The end can be left
+        out to drop everything from the start on. Can be given more than once.
+    """)
+    parser.add_argument('--venc', default='-c:v libx264 -preset medium -crf 20 -maxrate 8M -bufsize 16M -pix_fmt yuv420p', help="""
+        ffmpeg options to encode the frames around the cuts. Should match
+        how the video was encoded. Default is the "final" encode profile of
+        master-talk-video.py.
+    """)
+    parser.add_argument('--verbose', '-v', action='store_true', default=False, help="""
+        Show ffmpeg output.
+    """)
+    args = parser.parse_args()
+    stats = drop_ranges(args.src, args.out, [parse_range(r) for r in args.drop],
+                        args.venc.split(), args.verbose)
+    for start, end, encoded in stats:
+        print(f'kept {ts(start)} - {ts(end)}, re-encoded {encoded:.3f}s', file=sys.stderr)
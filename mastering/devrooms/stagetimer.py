@@ -0,0 +1,246 @@
+#
+# stagetimer.py
+#
+# Timing and progress of the mastering steps.
+#
+# Every step run by add_proc() is a stage. For each stage we keep:
+#
+#  - wall time, and CPU time (user+sys) of the command
+#  - bytes read and written by the command (/proc/<pid>/io, Linux only)
+#  - for ffmpeg: media time and frames processed, and the realtime
+#    factor (media time / wall time)
+#
+# ffmpeg is run with "-progress pipe:1", which writes key=value blocks
+# (frame=, out_time_us=, speed=, ... progress=continue|end) to stdout
+# twice a second. They are parsed as they arrive, and a progress line is
+# printed every PROGRESS_INTERVAL seconds, so that a multi hour run shows
+# where it is.
+#
+# Steps that run in Python (the streaming audio chain, loudness
+# measurement) are timed with stage().
+#
+# The stages of a talk are collected from start_report() until
+# write_report(), which writes them as json, along with the totals per
+# kind of stage - that's what tells whether denoise, composite or stitch
+# is the bottleneck on a machine.
+#
+import contextlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+
+PROGRESS_INTERVAL = 10 # seconds
+
+_lock = threading.Lock()
+_stages = []
+_started = [time.monotonic()]
+
+def start_report():
+    with _lock:
+        del _stages[:]
+        _started[0] = time.monotonic()
+
+def kind(message):
+    # Stages of the same kind, for the totals: the message up to the
+    # first number, e.g. 'Generating segment 3 start=...' => 'Generating segment'
+    return re.sub(r'\s*(\d.*|\.\.\.|\(.*\))$', '', message) or message
+
+def add_stage(stage):
+    with _lock:
+        _stages.append(stage)
+
+def proc_io(pid):
+    # => (bytes read, bytes written) of a running process, or None
+    try:
+        with open(f'/proc/{pid}/io', 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+def media_duration(cmd):
+    # Expected length of the output of an ffmpeg command, from the last
+    # -t option, for the progress percentage. None if there is none.
+    for opt, value in reversed(list(zip(cmd, cmd[1:]))):
+        if opt == '-t':
+            h, m, s = (['0', '0'] + value.split(':'))[-3:]
+            return int(h)*3600 + int(m)*60 + float(s)
+    return None
+
+def hms(seconds):
+    m, s = divmod(seconds, 60)
+    return f'{int(m)//60:d}:{int(m)%60:02d}:{s:04.1f}'
+
+def size(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024 or unit == 'GB':
+            return f'{nbytes:.1f}{unit}' if unit != 'B' else f'{nbytes}B'
+        nbytes /= 1024
+
+class Progress:
+    # Parser for the -progress blocks of ffmpeg
+    def __init__(self, cmd):
+        self.duration = media_duration(cmd)
+        self.values = {}
+        self.frames = 0
+        self.media_time = 0.0
+        self.speed = None
+
+    def feed(self, line):
+        # => True at the end of a block
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            return False
+        self.values[key] = value
+        if key != 'progress':
+            return False
+        try:
+            self.frames = int(self.values.get('frame', self.frames))
+        except ValueError:
+            pass
+        try:
+            # out_time_us is in microseconds (out_time_ms too, despite its name)
+            self.media_time = max(int(self.values.get('out_time_us', 0)) / 1e6, 0.0)
+        except ValueError:
+            pass
+        speed = self.values.get('speed', 'N/A').rstrip('x').strip()
+        self.speed = float(speed) if speed not in ['N/A', ''] else None
+        return True
+
+    def line(self):
+        text = f'  {hms(self.media_time)}'
+        if self.duration:
+            text += f' of {hms(self.duration)} ({min(100 * self.media_time / self.duration, 100):.0f}%)'
+        text += f' frame={self.frames}'
+        if self.speed is not None:
+            text += f' speed={self.speed:.2f}x'
+        return text
+
+def run(message, cmd, verbose=False, log=None, capture_output=False):
+    # Run a step, record it as a stage => CompletedProcess, with stderr
+    # if capture_output. Output goes where add_proc() always sent it: to
+    # the log, to the terminal if verbose, or is kept for the error.
+    is_ffmpeg = cmd[0] == 'ffmpeg'
+    if is_ffmpeg:
+        cmd = cmd[:1] + ['-progress', 'pipe:1'] + cmd[1:]
+    keep_stderr = capture_output or (not log and not verbose)
+    errors = tempfile.TemporaryFile(mode='w+') if keep_stderr else None
+    stderr = errors if keep_stderr else log
+
+    progress = Progress(cmd) if is_ffmpeg else None
+    io = None
+    start = time.monotonic()
+    stdout = log if log else (None if verbose else subprocess.DEVNULL)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE if is_ffmpeg else stdout,
+                            stderr=stderr, text=True)
+    if is_ffmpeg:
+        last_print = start
+        for line in proc.stdout:
+            if not progress.feed(line):
+                continue
+            io = proc_io(proc.pid) or io
+            now = time.monotonic()
+            if now - last_print >= PROGRESS_INTERVAL:
+                print(progress.line(), flush=True)
+                last_print = now
+        proc.stdout.close()
+    # Reap the process ourselves, wait4 gives its resource usage. The io
+    # counters are gone once it exits, so poll them until then.
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        io = proc_io(proc.pid) or io
+        time.sleep(0.1 if is_ffmpeg else 0.5)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.monotonic() - start
+
+    output = None
+    if errors:
+        errors.seek(0)
+        output = errors.read()
+        errors.close()
+    stage = {
+        'stage' : message,
+        'tool' : os.path.basename(cmd[0]),
+        'wall' : round(wall, 3),
+        'cpu' : round(usage.ru_utime + usage.ru_stime, 3),
+        'bytes_read' : io[0] if io else None,
+        'bytes_written' : io[1] if io else None
+    }
+    if progress:
+        stage['media_time'] = round(progress.media_time, 3)
+        stage['frames'] = progress.frames
+        stage['realtime_factor'] = round(progress.media_time / wall, 3) if wall > 0 else None
+    add_stage(stage)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, None, output)
+    print(summary(stage), flush=True)
+    return subprocess.CompletedProcess(cmd, 0, None, output if capture_output else None)
+
+@contextlib.contextmanager
+def stage(message, tool='python', media_time=None):
+    # Time a step that runs in this process. CPU time is of this thread
+    # only, not of any commands it starts.
+    start = time.monotonic()
+    cpu = time.thread_time()
+    yield
+    wall = time.monotonic() - start
+    entry = {
+        'stage' : message,
+        'tool' : tool,
+        'wall' : round(wall, 3),
+        'cpu' : round(time.thread_time() - cpu, 3)
+    }
+    if media_time:
+        entry['media_time'] = round(media_time, 3)
+        entry['realtime_factor'] = round(media_time / wall, 3) if wall > 0 else None
+    add_stage(entry)
+    print(summary(entry), flush=True)
+
+def cached(message):
+    # A step that was up to date
+    add_stage({'stage' : message, 'tool' : None, 'wall' : 0.0, 'cached' : True})
+
+def summary(stage):
+    text = f'  done in {stage["wall"]:.1f}s'
+    if stage.get('cpu') is not None:
+        text += f', cpu {stage["cpu"]:.1f}s'
+    if stage.get('realtime_factor'):
+        text += f', {stage["realtime_factor"]:.2f}x realtime'
+    if stage.get('bytes_read') is not None:
+        text += f', read {size(stage["bytes_read"])} wrote {size(stage["bytes_written"])}'
+    return text
+
+def write_report(report_file, **info):
+    # The stages since start_report(), with totals per kind of stage.
+    # Stages may run in parallel (audio and video), so the wall time of
+    # the report is less than the sum of the stages.
+    with _lock:
+        stages = list(_stages)
+        wall = time.monotonic() - _started[0]
+    totals = {}
+    for s in stages:
+        if s.get('cached'):
+            continue
+        total = totals.setdefault(kind(s['stage']), {'stages' : 0, 'wall' : 0.0, 'cpu' : 0.0})
+        total['stages'] += 1
+        total['wall'] = round(total['wall'] + s['wall'], 3)
+        total['cpu'] = round(total['cpu'] + (s.get('cpu') or 0.0), 3)
+    slowest = max(totals.items(), key=lambda t: t[1]['wall'])[0] if totals else None
+    report = dict(info, **{
+        'wall' : round(wall, 3),
+        'slowest' : slowest,
+        'totals' : totals,
+        'stages' : stages
+    })
+    # write + rename: talks rendered at the same time (render farm) may
+    # write the sources report of their devroom
+    tmp = f'{report_file}.{os.getpid()}.tmp'
+    open(tmp, 'w').write(json.dumps(report, indent=2) + '\n')
+    os.replace(tmp, report_file)
+    return report
@@ -0,0 +1,71 @@
+#
+# stepgraph.py
+#
+# Runs the steps of a talk as a dependency graph, instead of one after
+# the other.
+#
+# Each step names the steps it needs, and how many CPUs it keeps busy
+# (its cost): a stream copy or the audio chain needs about one, an
+# encode all there are. run() starts every step whose dependencies are
+# done, in the order they were added, as long as the running steps fit
+# in the CPU budget. A step costing more than the budget runs, alone.
+#
+# So for a talk, the two source cuts run together, and the whole audio
+# branch runs alongside the video encodes - the talk waits for audio
+# only at the final mux.
+#
+# The steps are functions without arguments, run in threads (the work is
+# done by ffmpeg/sox, or NumPy). What a step returns goes to results, so
+# a step can read the results of the steps it depends on. If a step
+# fails, nothing more is started, the running steps are waited for, and
+# the error is raised.
+#
+import concurrent.futures
+
+class StepGraph:
+    def __init__(self, budget):
+        self.budget = max(1, budget)
+        self.steps = {}
+        self.order = []
+        self.results = {}
+
+    def add(self, name, func, deps=[], cost=1):
+        # Dependencies that are not in the graph are steps not run by
+        # this pipeline, whose outputs are there already
+        if name in self.steps:
+            raise ValueError(f'Duplicate step {name}')
+        deps = [dep for dep in deps if dep in self.steps]
+        self.steps[name] = (func, deps, min(max(cost, 1), self.budget))
+        self.order.append(name)
+        return name
+
+    def run(self):
+        # => {step name : return value}
+        results = self.results
+        pending = list(self.order)
+        running = {}
+        used = 0
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+            while pending or running:
+                if error is None:
+                    for name in list(pending):
+                        func, deps, cost = self.steps[name]
+                        if all([dep in results for dep in deps]) and used + cost <= self.budget:
+                            running[executor.submit(func)] = name
+                            used += cost
+                            pending.remove(name)
+                if not running:
+                    break
+                done, not_done = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    used -= self.steps[name][2]
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        error = error if error else e
+        if error:
+            raise error
+        return results
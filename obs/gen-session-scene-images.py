@@ -4,14 +4,16 @@
 #
 # ./gen-session-scene-images.py --track day1-audi1
 # ./gen-session-scene-images.py --devroom aosp
+# ./gen-session-scene-images.py --all
+#
+# PNGs are only rendered again if their SVG changed since the last run
+# (scene-manifest.json next to obs-scenes.csv records what was rendered).
 #
 # Devrooms have list of session titles.
 # Tracks are exported from website schedule page
 #
+import sys
 import csv
-import cairo
-from pprint import pprint
-import subprocess
 from xml.sax.saxutils import escape
 from pathlib import Path
 import os
@@ -19,38 +21,16 @@ import string
 import argparse
 from datetime import datetime
 import tempfile
+import hashlib
+import json
+import glob
+import concurrent.futures
 
-def get_text_width_mm(text, family='Inter', size=28, dpi=78):
-    # Off-screen SVG surface
-    surface = cairo.SVGSurface(None, 1, 1) # size does not matter
-    ctx = cairo.Context(surface)
-    ctx.select_font_face(family, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
-    ctx.set_font_size(size)
-    xbearing, ybearing, width, height, xadvance, yadvance = ctx.text_extents(text)
-    # Pixel to mm conversion
-    width_mm = width * 25.4 / dpi
-    return width_mm
-
-def span_text(text, size, limit):
-    words = text.split(' ')
-    lines = []
-    this_line = []
-    for word in words:
-        test_line = ' '.join(this_line+[word])
-        tw = get_text_width_mm(test_line, size=size)
-        if tw > limit:
-            partial_line = ' '.join(this_line)
-            lines.append(partial_line)
-            this_line = []
-        this_line.append(word)
-    if len(this_line)>0:
-        lines.append(' '.join(this_line))
-    return lines
+from svgrender import InkscapeRenderer
+from textlayout import span_text
+from talkindex import TalkIndex
 
 def gen_speaker_plus_slides(talk_info, track2dir, output_base_dir, file_prefix):
-    panel_cfg = dict()
-    exec(open('track-lists/panels.map','r').read(), panel_cfg)
-    track2panel_svg = panel_cfg['track2panel_svg']
     template_image_dir = "templates/images/"
     title = talk_info['title'].strip()
 
@@ -129,18 +109,9 @@ def gen_speaker_plus_slides(talk_info, track2dir, output_base_dir, file_prefix):
     template = template.replace('$SPEAKER2-DESIGNATION$', escape(speaker2_designation))
     template = template.replace('$TEMPLATE-IMAGE-DIR$', template_image_dir, -1)
 
-    temp_svg = tempfile.NamedTemporaryFile(mode='w', delete=True)
-    temp_svg.write(template)
-    temp_svg.flush()
-
     output_file1 = os.path.join(track_dir, file_prefix+output_file)
     if talk_info['type']!='Panel Discussion':
-        cmd = ['inkscape', '--export-type=png', '--export-width=1920',
-           '--export-height=1080', '--export-filename', output_file1, temp_svg.name]
-        print(output_file1)
-        subprocess.run(cmd, check=True)
-        # ensure the file actually got created
-        open(output_file1,'r')
+        queue_render(output_file1, svg_text=template)
     else:
         output_file1 = None
 
@@ -156,24 +127,91 @@ def gen_speaker_plus_slides(talk_info, track2dir, output_base_dir, file_prefix):
     template = template.replace('$SPEAKER2-DESIGNATION$', escape(speaker2_designation))
     template = template.replace('$TEMPLATE-IMAGE-DIR$', template_image_dir, -1)
 
-    temp_svg = tempfile.NamedTemporaryFile(mode='w', delete=True)
-    temp_svg.write(template)
-    temp_svg.flush()
-
     output_file2 = os.path.join(track_dir, file_prefix+'qa-'+output_file)
     if talk_info['type']!='Panel Discussion':
-        cmd = ['inkscape', '--export-type=png', '--export-width=1920',
-           '--export-height=1080', '--export-filename', output_file2, temp_svg.name]
+        queue_render(output_file2, svg_text=template)
     else:
-        cmd = ['inkscape', '--export-type=png', '--export-width=1920',
-           '--export-height=1080', '--export-filename', output_file2, track2panel_svg[title]]
-    print(output_file2)
-    subprocess.run(cmd, check=True)
-    open(output_file2,'r')
+        queue_render(output_file2, svg_file=track2panel_svg[title])
 
-    # ensure the file actually got created
     return (title, output_file1, output_file2)
 
+# Images are rendered after all the tracks are processed, so that they
+# can be spread over a pool of renderers - and only those whose SVG
+# changed since the last run are rendered (see render_queued)
+render_queue = []
+
+def queue_render(png_file, svg_text=None, svg_file=None):
+    if svg_text is None:
+        svg_text = open(svg_file, 'r').read()
+    digest = hashlib.sha256(svg_text.encode()).hexdigest()
+    render_queue.append((png_file, svg_file, svg_text if svg_file is None else None, digest))
+
+# One renderer per pool process, started by the pool initializer
+worker_renderer = None
+
+def start_render_worker(shell):
+    global worker_renderer
+    worker_renderer = InkscapeRenderer(1920, 1080, shell=shell)
+    # inkscape --shell exits when its stdin closes, along with the worker
+
+def render_one(png_file, svg_file, svg_text):
+    if svg_file is None:
+        temp_svg = tempfile.NamedTemporaryFile(mode='w', suffix='.svg', delete=True)
+        temp_svg.write(svg_text)
+        temp_svg.flush()
+        svg_file = temp_svg.name
+    worker_renderer.render(svg_file, png_file)
+    return png_file
+
+def render_queued(n_jobs, shell=True, force=False):
+    # The manifest next to each obs-scenes.csv records the hash of the SVG
+    # each PNG was rendered from
+    manifests = {}
+    todo = []
+    for png_file, svg_file, svg_text, digest in render_queue:
+        track_dir = os.path.dirname(png_file)
+        if track_dir not in manifests:
+            manifests[track_dir] = load_manifest(track_dir)
+        name = os.path.basename(png_file)
+        if not force and manifests[track_dir].get(name) == digest and os.path.exists(png_file):
+            continue
+        todo.append((png_file, svg_file, svg_text, digest))
+    print(f'Rendering {len(todo)} of {len(render_queue)} images')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs,
+                                                initializer=start_render_worker,
+                                                initargs=(shell,)) as executor:
+        futures = {}
+        for png_file, svg_file, svg_text, digest in todo:
+            futures[executor.submit(render_one, png_file, svg_file, svg_text)] = digest
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                png_file = future.result()
+            except Exception as e:
+                print(f'FAILED: {e}')
+                failed.append(e)
+                continue
+            print(png_file)
+            track_dir = os.path.dirname(png_file)
+            manifests[track_dir][os.path.basename(png_file)] = futures[future]
+    # Save even on failures, so the next run only retries those
+    for track_dir, manifest in manifests.items():
+        save_manifest(track_dir, manifest)
+    if failed:
+        raise RuntimeError(f'{len(failed)} images failed to render')
+
+def load_manifest(track_dir):
+    try:
+        return json.loads(open(os.path.join(track_dir, 'scene-manifest.json'), 'r').read())
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(track_dir, manifest):
+    fname = os.path.join(track_dir, 'scene-manifest.json')
+    open(fname + '.tmp', 'w').write(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(fname + '.tmp', fname)
+
 def get_track_talks(filename):
     track_sessions = []
     with open(filename, 'r') as csvfile:
@@ -229,6 +267,11 @@ if talk_info:
     talk_info = {}
 
 #print(f'Number of sessions = {len(talks)}')
+talk_index = TalkIndex(talks)
+
+panel_cfg = dict()
+exec(open('track-lists/panels.map','r').read(), panel_cfg)
+track2panel_svg = panel_cfg['track2panel_svg']
 
 # It's a short list, so feed in by hand
 track2dir = {
@@ -242,38 +285,60 @@ track2dir = {
     'FOSS in Science Devroom' : 'science'
 }
 
-def gen_obs_track_images(track_talks, output_track):
-    talk_scene = []
-    missing_talks = []
-    output_base_dir = 'track-ordered'
+def resolve_track_talks(track_talks):
+    # => [(index in the track, title as listed, talk or None)], reporting
+    # anything that wasn't an exact match
+    resolved = []
     for index, talk_title in enumerate(track_talks):
         talk_title = talk_title.strip() # extra whitespace
-        matching_talk = [item for item in talks if item["title"]==talk_title]
-
         if talk_title.startswith('-'):
             print(f'Skipping devroom manager-led section : {talk_title}')
             continue
         elif talk_title.startswith('.'):
             print(f'Skipping special instruction : {talk_title}')
             continue
-        elif len(matching_talk) == 0:
-            # Schedule is entered by hand, so perhaps we're only fed a prefix
-            matching_talk = [item for item in talks if item["title"].startswith(talk_title[:len(talk_title)//2])]
-            if len(matching_talk) == 1:
-                print(f'Resolving "{talk_title}" with partial match!')
-            else:
-                print(f'Missing talk "{talk_title}"')
-                missing_talks.append(talk_title)
-        elif len(matching_talk) != 1:
-            raise ValueError(f"Bad metadata - multiple matches for {talk_title}")
-
-        if len(matching_talk) == 1:
-            title, png_image, png_image_qa = gen_speaker_plus_slides(matching_talk[0], output_track, output_base_dir, '%02d_'%(index+1))
-            talk_scene.append((title, png_image, png_image_qa))
+        talk, how, confidence, candidates = talk_index.resolve(talk_title)
+        if how in ['normalized', 'prefix']:
+            print(f'Resolving "{talk_title}" with {how} match ({confidence}) : "{talk["title"]}"')
+        elif how == 'fuzzy':
+            # only a suggestion, the title in the list needs fixing
+            print(f'Unconfirmed talk "{talk_title}", fuzzy match ({confidence}) :'
+                  f' "{candidates[0]["title"]}"')
+            candidates = candidates[1:]
+            if candidates:
+                print('  others:')
+        elif how == 'ambiguous':
+            print(f'Ambiguous talk "{talk_title}" ({confidence}), candidates:')
+        elif how == 'missing':
+            print(f'Missing talk "{talk_title}"')
+            if candidates:
+                print(f'  closest ({confidence}):')
+        if talk is None:
+            for candidate in candidates:
+                print(f'    "{candidate["title"]}"')
+        resolved.append((index, talk_title, talk))
+    return resolved
+
+def gen_obs_track_images(track_talks, output_track):
+    talk_scene = []
+    missing_talks = []
+    output_base_dir = 'track-ordered'
+    for index, talk_title, talk in resolve_track_talks(track_talks):
+        if talk is None:
+            missing_talks.append(talk_title)
+            continue
+        title, png_image, png_image_qa = gen_speaker_plus_slides(talk, output_track, output_base_dir, '%02d_'%(index+1))
+        talk_scene.append((title, png_image, png_image_qa))
     if len(missing_talks)>0:
-        raise ValueError(f"Missing talks {missing_talks}")
+        raise ValueError(f"Missing (or unconfirmed) talks {missing_talks}")
     return talk_scene
 
+def read_track_talks(output_track):
+    # Schedule export if there is one, otherwise the devroom list
+    if os.path.exists(f'track-lists/{output_track}.csv'):
+        return get_track_talks(f'track-lists/{output_track}.csv')
+    return [ x.strip() for x in open(f'track-lists/{output_track}.txt','r').readlines() ]
+
 def gen_obs_track_images_from_schedule(output_track):
     track_talks = get_track_talks(f'track-lists/{output_track}.csv')
     return gen_obs_track_images(track_talks, output_track)
@@ -282,11 +347,21 @@ def gen_obs_track_images_for_devroom(output_track):
     track_talks = [ x.strip() for x in open(f'track-lists/{output_track}.txt','r').readlines() ]
     return gen_obs_track_images(track_talks, output_track)
 
-parser = argparse.ArgumentParser()
-group = parser.add_mutually_exclusive_group(required=True)
-group.add_argument("--track")
-group.add_argument("--devroom")
-args = parser.parse_args()
+def check_talks(talks):
+    # Check that every title and company fits in the templates, same
+    # limits as gen_speaker_plus_slides()
+    problems = []
+    for talk in talks:
+        title = talk['title'].strip()
+        if len(span_text(title, 28, 460)) > 2:
+            problems.append(f'Too long title: {title}')
+        for speaker in talk['speakers']:
+            if len(span_text(speaker['company'], 24, 120)) > 2:
+                problems.append(f'Company name too long: {speaker["company"]} ({title})')
+    for problem in problems:
+        print(problem)
+    print(f'Checked {len(talks)} talks, {len(problems)} problems')
+    return len(problems) == 0
 
 def generate_scene(track, talk_scene):
     csv_file = open(f"track-ordered/{track}/obs-scenes.csv", "w")
@@ -304,14 +379,49 @@ def generate_scene(track, talk_scene):
             csv_writer.writerow(this_row)
     csv_file.close()
 
-if args.devroom:
-    talk_scene = gen_obs_track_images_for_devroom(args.devroom)
-    generate_scene(args.devroom, talk_scene)
-
-if args.track:
-    talk_scene = gen_obs_track_images_from_schedule(args.track)
-    generate_scene(args.track, talk_scene)
-
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--track", action='append', default=[],
+                        help="Schedule export in track-lists/<track>.csv. Can be repeated.")
+    parser.add_argument("--devroom", action='append', default=[],
+                        help="Talk list in track-lists/<devroom>.txt. Can be repeated.")
+    parser.add_argument("--all", action='store_true', default=False,
+                        help="All tracks (track-lists/*.csv) and devrooms (track-lists/*.txt)")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(),
+                        help="Number of inkscape processes rendering in parallel")
+    parser.add_argument("--force", action='store_true', default=False,
+                        help="Render every image, even if its SVG is unchanged since the last run")
+    parser.add_argument("--check", action='store_true', default=False,
+                        help="Only check that all titles and company names in the CFP fit the templates")
+    parser.add_argument("--resolve", action='store_true', default=False,
+                        help="Only match the talks of the given tracks/devrooms to the CFP, and report")
+    parser.add_argument("--no-shell", action='store_true', default=False,
+                        help="Run one inkscape per image, instead of one inkscape --shell per job")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if check_talks(talks) else 1)
+    if args.all:
+        args.track = sorted([Path(x).stem for x in glob.glob('track-lists/*.csv')])
+        args.devroom = sorted([Path(x).stem for x in glob.glob('track-lists/*.txt')])
+    if not args.track and not args.devroom:
+        parser.error('at least one of --track, --devroom or --all is needed')
+    if args.resolve:
+        unresolved = 0
+        for track in args.devroom + args.track:
+            print(f'== {track}')
+            unresolved += len([x for x in resolve_track_talks(read_track_talks(track)) if x[2] is None])
+        print(f'{unresolved} talks not resolved')
+        sys.exit(0 if unresolved == 0 else 1)
+
+    for devroom in args.devroom:
+        talk_scene = gen_obs_track_images_for_devroom(devroom)
+        generate_scene(devroom, talk_scene)
+
+    for track in args.track:
+        talk_scene = gen_obs_track_images_from_schedule(track)
+        generate_scene(track, talk_scene)
+
+    render_queued(args.jobs, shell=not args.no_shell, force=args.force)
 
 #gen_obs_track_images_for_devroom('aosp')
 #gen_obs_track_images_from_schedule('day2-audi2')
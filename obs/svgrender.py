@@ -0,0 +1,91 @@
+#
+# svgrender.py
+#
+# Render SVGs to PNG with one long running Inkscape.
+#
+# Starting Inkscape takes a second or two, far longer than rendering one
+# scene image. So instead of one "inkscape --export-type=png" per image,
+# a single "inkscape --shell" is kept running and fed export actions,
+# one line per image:
+#
+#   file-open:in.svg;export-filename:out.png;export-width:1920;...;export-do;file-close
+#
+# Inkscape prints a "> " prompt once it is done with a line, so every
+# render waits for that before checking the PNG. Inkscape older than 1.0
+# has no actions in the shell - use shell=False there, which runs one
+# Inkscape per image, as before.
+#
+import os
+import subprocess
+
+PROMPT = b'> '
+
+class InkscapeRenderer:
+    def __init__(self, width=1920, height=1080, shell=True):
+        self.width = width
+        self.height = height
+        self.shell = shell
+        self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _start(self):
+        self.proc = subprocess.Popen(['inkscape', '--shell'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+        self._wait_prompt()
+
+    def _wait_prompt(self):
+        # The prompt has no newline after it, so read what's there
+        # rather than lines
+        fd = self.proc.stdout.fileno()
+        output = b''
+        while not output.endswith(PROMPT):
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise RuntimeError(f'inkscape exited: {output.decode(errors="replace")}')
+            output += chunk
+        return output
+
+    def render(self, svg_file, png_file):
+        # Same as inkscape --export-type=png --export-width --export-height
+        # --export-filename png_file svg_file
+        if os.path.exists(png_file):
+            os.remove(png_file)
+        if not self.shell:
+            subprocess.run(['inkscape', '--export-type=png',
+                            f'--export-width={self.width}',
+                            f'--export-height={self.height}',
+                            '--export-filename', png_file, svg_file], check=True)
+        else:
+            if self.proc is None:
+                self._start()
+            for name in [svg_file, png_file]:
+                if ';' in name or '\n' in name:
+                    raise ValueError(f"Can't pass {name} to the inkscape shell")
+            actions = [f'file-open:{os.path.abspath(svg_file)}',
+                       f'export-filename:{os.path.abspath(png_file)}',
+                       f'export-width:{self.width}',
+                       f'export-height:{self.height}',
+                       'export-type:png',
+                       'export-do',
+                       'file-close']
+            self.proc.stdin.write((';'.join(actions) + '\n').encode())
+            self.proc.stdin.flush()
+            self._wait_prompt()
+        # ensure the file actually got created
+        if not os.path.exists(png_file):
+            raise RuntimeError(f'inkscape did not create {png_file}')
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.proc.stdin.write(b'quit\n')
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc = None
@@ -0,0 +1,116 @@
+#
+# talkindex.py
+#
+# Look up talks from the CFP by title, as typed in the schedule exports
+# and the hand written devroom lists.
+#
+# The index is built once:
+#
+# - normalized title => talks. Normalizing folds case, whitespace and
+#   the quote/dash variants that creep in when titles are copy-pasted
+# - sorted normalized titles, for prefix lookups (bisect)
+# - character trigrams => talks, for titles that were retyped or edited
+#
+# resolve() tries these in order, and says how it matched, with a
+# confidence and the other candidates it considered. A fuzzy match is
+# only a suggestion: a mistyped title may well be close to another talk,
+# so it is returned as a candidate, for the list to be fixed by hand.
+#
+import bisect
+import re
+import unicodedata
+
+# Fuzzy matches need at least this score, and this much of a lead over
+# the next best candidate, to be suggested
+FUZZY_MIN_SCORE = 0.6
+FUZZY_MIN_LEAD = 0.1
+
+TRANSLATE = str.maketrans({
+    '‘' : "'", '’' : "'", '“' : '"', '”' : '"',
+    '–' : '-', '—' : '-', ' ' : ' '
+})
+
+def normalize(title):
+    title = unicodedata.normalize('NFKC', title).translate(TRANSLATE)
+    return re.sub(r'\s+', ' ', title).strip().lower()
+
+def trigrams(text):
+    text = f'  {text} '
+    return set([text[i:i+3] for i in range(len(text) - 2)])
+
+class TalkIndex:
+    def __init__(self, talks):
+        self.talks = talks
+        self.by_title = {}
+        self.by_trigram = {}
+        self.grams = []
+        for idx, talk in enumerate(talks):
+            key = normalize(talk['title'])
+            self.by_title.setdefault(key, []).append(idx)
+            grams = trigrams(key)
+            self.grams.append(grams)
+            for gram in grams:
+                self.by_trigram.setdefault(gram, []).append(idx)
+        self.sorted_titles = sorted(self.by_title.keys())
+
+    def _candidates(self, key):
+        return [self.talks[idx] for idx in self.by_title.get(key, [])]
+
+    def prefix(self, key):
+        # Talks whose normalized title starts with key
+        start = bisect.bisect_left(self.sorted_titles, key)
+        found = []
+        for title in self.sorted_titles[start:]:
+            if not title.startswith(key):
+                break
+            found += [self.talks[idx] for idx in self.by_title[title]]
+        return found
+
+    def fuzzy(self, key, limit=3):
+        # Talks ranked by trigram similarity (Dice coefficient)
+        grams = trigrams(key)
+        shared = {}
+        for gram in grams:
+            for idx in self.by_trigram.get(gram, []):
+                shared[idx] = shared.get(idx, 0) + 1
+        ranked = sorted([(2 * n / (len(grams) + len(self.grams[idx])), idx)
+                         for idx, n in shared.items()], reverse=True)
+        return [(round(score, 3), self.talks[idx]) for score, idx in ranked[:limit]]
+
+    def resolve(self, title):
+        # => (talk or None, how, confidence, other candidates)
+        # how is one of exact, normalized, prefix, fuzzy, ambiguous, missing.
+        # For fuzzy, talk is None and the suggested talk comes first in
+        # the candidates.
+        title = title.strip()
+        key = normalize(title)
+        found = [talk for talk in self._candidates(key) if talk['title'].strip() == title]
+        if len(found) == 1:
+            return found[0], 'exact', 1.0, []
+        if len(found) > 1:
+            return None, 'ambiguous', 1.0, found
+        found = self._candidates(key)
+        if len(found) == 1:
+            return found[0], 'normalized', 1.0, []
+        if len(found) > 1:
+            return None, 'ambiguous', 1.0, found
+        # Schedule is entered by hand, so perhaps we're only fed a prefix
+        for prefix in [key, key[:len(key)//2]]:
+            if not prefix:
+                continue
+            found = self.prefix(prefix)
+            if len(found) == 1:
+                return found[0], 'prefix', round(len(prefix) / len(normalize(found[0]['title'])), 3), []
+            if len(found) > 1:
+                break
+        ranked = self.fuzzy(key)
+        if not ranked:
+            return None, 'missing', 0.0, []
+        best_score, best = ranked[0]
+        others = [talk for score, talk in ranked[1:]]
+        next_score = ranked[1][0] if len(ranked) > 1 else 0.0
+        if best_score >= FUZZY_MIN_SCORE and best_score - next_score >= FUZZY_MIN_LEAD:
+            return None, 'fuzzy', best_score, [best] + others
+        if best_score >= FUZZY_MIN_SCORE:
+            return None, 'ambiguous', best_score, [talk for score, talk in ranked]
+        return None, 'missing', best_score, [talk for score, talk in ranked]
@@ -0,0 +1,75 @@
+#
+# textlayout.py
+#
+# Text measurement and line wrapping for the scene templates.
+#
+# Wrapping a title needs the width of many candidate lines. Each one
+# used to get a fresh cairo surface + context, and every word re-measured
+# the whole line so far. Here:
+#
+# - one context per (family, size, weight) is kept, with its font selected
+# - widths are cached per (string, font), so the same line/word across
+#   the templates, the QA scene and the validation pass is measured once
+# - the break for each line is found by a binary search over how many
+#   words fit, so a line of n words costs log(n) measurements
+#
+# Widths are of the whole line (cairo text extents), as before - not a
+# sum of per word widths, which would differ by kerning and bearings.
+#
+import functools
+import cairo
+
+_contexts = {}
+
+def _context(family, size, weight):
+    key = (family, size, weight)
+    if key not in _contexts:
+        # Off-screen SVG surface, size does not matter
+        surface = cairo.SVGSurface(None, 1, 1)
+        ctx = cairo.Context(surface)
+        ctx.select_font_face(family, cairo.FONT_SLANT_NORMAL, weight)
+        ctx.set_font_size(size)
+        _contexts[key] = (surface, ctx)
+    return _contexts[key][1]
+
+@functools.lru_cache(maxsize=65536)
+def text_width(text, family='Inter', size=28, weight=cairo.FONT_WEIGHT_BOLD):
+    # Width in pixels
+    xbearing, ybearing, width, height, xadvance, yadvance = \
+        _context(family, size, weight).text_extents(text)
+    return width
+
+def text_width_mm(text, family='Inter', size=28, dpi=78, weight=cairo.FONT_WEIGHT_BOLD):
+    # Pixel to mm conversion
+    return text_width(text, family, size, weight) * 25.4 / dpi
+
+def words_that_fit(words, start, size, limit, family='Inter', dpi=78):
+    # Largest k such that words[start:start+k] fit in limit (mm). Line
+    # width grows with the number of words, so binary search.
+    lo, hi = 0, len(words) - start
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        line = ' '.join(words[start:start+mid])
+        if text_width_mm(line, family, size, dpi) > limit:
+            hi = mid - 1
+        else:
+            lo = mid
+    return lo
+
+def span_text(text, size, limit, family='Inter', dpi=78):
+    # Greedy wrap of text into lines no wider than limit (mm). A word
+    # that doesn't fit on a line by itself gets a line of its own - and,
+    # if it's the first word, an empty line before it, as the templates
+    # always had.
+    words = text.split(' ')
+    lines = []
+    start = 0
+    while start < len(words):
+        count = words_that_fit(words, start, size, limit, family, dpi)
+        if count == 0:
+            if start == 0:
+                lines.append('')
+            count = 1
+        lines.append(' '.join(words[start:start+count]))
+        start += count
+    return lines